@@ -0,0 +1,384 @@
+"""
+Non blocking /api/search/ on a tornado IOLoop: the upstream requests go through the
+AsyncHTTPClient, so one process keeps many searches in flight while they wait on the
+search engine instead of holding a worker thread (or process) each.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.http import QueryDict
+from rest_framework.renderers import BrowsableAPIRenderer
+from tornado import gen, web
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from api.cache import cache_key, get_response_cache
+from api.connections import DEFAULT_POOL_SETTINGS, endpoint_host, get_executor, upstream_url
+from api.deadline import DeadlineExceeded, client_header
+from api.metrics import clock, get_histograms, metrics_enabled, millis
+from api.renderers import SEARCH_RENDERER_CLASSES
+from api.replicas import get_replica_router
+from api.serializers import SearchSerializer
+from api.signals import get_index_changes
+from api.utils import compile_json_facet, decode_json_facet, split_facet_params
+from api.views import elasticsearch_body, elasticsearch_data, merge_solr_responses, resolve_solr_facet_api, \
+    search, search_engine_label, search_facets_label, solr_data, solr_params, solr_plans, solr_timing
+
+DEFAULT_ASYNC_SETTINGS = {
+    "MAX_CLIENTS": 100,
+    "CURL": True,
+}
+
+
+def configure_http_client():
+    """
+    Configures the AsyncHTTPClient from settings.SEARCH_ASYNC: the libcurl one, keeping
+    keep-alive connections to the search engines, when pycurl is installed and CURL is on,
+    otherwise tornado's own. At most MAX_CLIENTS upstream requests run at once, the others queue.
+    """
+    config = dict(DEFAULT_ASYNC_SETTINGS)
+    config.update(getattr(settings, "SEARCH_ASYNC", {}))
+    implementation = None
+    if config["CURL"]:
+        try:
+            import pycurl  # noqa
+            implementation = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+        except ImportError:
+            pass
+    AsyncHTTPClient.configure(implementation, max_clients=config["MAX_CLIENTS"])
+
+
+_flights = {}
+
+
+@gen.coroutine
+def fetch_json(search_engine_endpoint, params=None, json_body=None, deadline=None):
+    """
+    The non blocking connections.fetch_json: GET the endpoint (POST when there is a json body)
+    and decode the json response. Identical requests in flight on the loop are sent once and
+    their callers share the decoded response, so it must be treated as read only. A caller
+    joining a flight waits for it until its own deadline.
+    :param deadline: api.deadline.Deadline whose remaining time is the request timeout.
+    :return: (tornado response, decoded json, True when shared with another caller).
+    """
+    url = upstream_url(search_engine_endpoint, sorted((params or {}).items()))
+    body = None if json_body is None else json.dumps(json_body, sort_keys=True)
+    key = url if body is None else url + " " + body
+    singleflight = getattr(settings, "SEARCH_SINGLEFLIGHT", True)
+    if singleflight and key in _flights:
+        flight = _flights[key]
+        if deadline is not None:
+            flight = gen.with_timeout(timedelta(seconds=deadline.remaining()), flight)
+        try:
+            res, decoded = yield flight
+        except gen.TimeoutError:
+            raise DeadlineExceeded("Deadline of {0} ms exceeded waiting for an identical search".format(
+                deadline.budget_ms))
+        raise gen.Return((res, decoded, True))
+
+    config = dict(DEFAULT_POOL_SETTINGS)
+    config.update(getattr(settings, "SEARCH_ENGINE_POOL", {}))
+
+    @gen.coroutine
+    def send(endpoint):
+        connect_timeout, request_timeout = config["CONNECT_TIMEOUT"], config["READ_TIMEOUT"]
+        if deadline is not None:
+            connect_timeout, request_timeout = deadline.timeout(connect_timeout)
+        request = HTTPRequest(upstream_url(endpoint, sorted((params or {}).items())),
+                              method="GET" if body is None else "POST", body=body,
+                              headers=None if body is None else {"Content-Type": "application/json"},
+                              connect_timeout=connect_timeout, request_timeout=request_timeout,
+                              decompress_response=config["COMPRESSION"])
+        try:
+            res = yield AsyncHTTPClient().fetch(request)
+        except HTTPError as e:
+            # 599: no response, here because the request timed out.
+            if deadline is None or e.code != 599 or not deadline.expired():
+                raise
+            raise DeadlineExceeded("Deadline of {0} ms exceeded by {1}".format(
+                deadline.budget_ms, endpoint_host(endpoint)))
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def fetch():
+        replicas = get_replica_router().for_endpoint(search_engine_endpoint)
+        if replicas is None:
+            res = yield send(search_engine_endpoint)
+        else:
+            res = yield fetch_replicas(replicas, send)
+        raise gen.Return((res, json.loads(res.body)))
+
+    if not singleflight:
+        res, decoded = yield fetch()
+        raise gen.Return((res, decoded, False))
+
+    flight = _flights[key] = fetch()
+    try:
+        res, decoded = yield flight
+    finally:
+        del _flights[key]
+    raise gen.Return((res, decoded, False))
+
+
+def failed_over(error):
+    """
+    True when the error of a replica is worth trying another one: not a client error, not an
+    exceeded deadline.
+    """
+    if isinstance(error, DeadlineExceeded):
+        return False
+    return not isinstance(error, HTTPError) or error.code >= 500
+
+
+@gen.coroutine
+def fetch_replicas(replicas, send):
+    """
+    The non blocking api.replicas.ReplicaSet.call: send(endpoint), a coroutine, on the replicas,
+    hedged and failed over on the loop.
+    :return: the first successful response.
+    """
+    candidates = replicas.candidates()
+    answered = []
+
+    @gen.coroutine
+    def attempt(replica, hedge=False):
+        replicas.begin(replica)
+        started = clock()
+        try:
+            res = yield send(replica.endpoint)
+        except Exception as e:
+            replicas.record(replica, clock() - started, not failed_over(e))
+            raise
+        replicas.record(replica, clock() - started, True, hedge_won=hedge and not answered)
+        answered.append(replica)
+        raise gen.Return(res)
+
+    pending = [attempt(candidates.pop(0))]
+    hedging = bool(candidates)
+    error = None
+    while pending:
+        first = Future()
+
+        def settle(future, first=first):
+            future.exception()  # retrieved, the losing attempts fail silently.
+            if not first.done():
+                first.set_result(future)
+
+        for future in pending:
+            future.add_done_callback(settle)
+        try:
+            if hedging and candidates:
+                finished = yield gen.with_timeout(timedelta(seconds=replicas.hedge_delay()), first)
+            else:
+                finished = yield first
+        except gen.TimeoutError:
+            hedging = False
+            if replicas.take_hedge():
+                pending.append(attempt(candidates.pop(0), True))
+            continue
+        pending.remove(finished)
+        if finished.exception() is None:
+            raise gen.Return(finished.result())
+        error = finished.exception()
+        if not pending and candidates and failed_over(error):
+            replicas.failover()
+            pending.append(attempt(candidates.pop(0)))
+    raise error
+
+
+@gen.coroutine
+def solr_fetch(search_engine_endpoint, params, facet_api="legacy", deadline=None):
+    """
+    The non blocking views.solr_fetch.
+    """
+    if facet_api != "json":
+        result = yield fetch_json(search_engine_endpoint, params, deadline=deadline)
+        raise gen.Return(result)
+
+    json_params, specs = compile_json_facet(params, getattr(settings, "SEARCH_SOLR_JSON_FACET_OPTIONS", {}))
+    res, solr_response, shared = yield fetch_json(search_engine_endpoint, json_params, deadline=deadline)
+    if specs:
+        solr_response = dict(solr_response, facet_counts=decode_json_facet(solr_response.get("facets", {}), specs))
+    raise gen.Return((res, solr_response, shared))
+
+
+@gen.coroutine
+def solr(validated_data):
+    """
+    views.solr with the upstream request(s), the concurrent parallel facets too, on the loop.
+    """
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+    deadline = validated_data.get("deadline")
+    parallel_facets = validated_data.get("parallel_facets")
+    if parallel_facets is None:
+        parallel_facets = getattr(settings, "SEARCH_PARALLEL_FACETS", False)
+    solr_facet_api = resolve_solr_facet_api(validated_data)
+
+    params = solr_params(validated_data)
+    hm_plan, time_plan = solr_plans(validated_data, params)
+
+    if parallel_facets:
+        started = clock()
+        sub_requests = split_facet_params(params)
+        results = yield [solr_fetch(search_engine_endpoint, sub_params, solr_facet_api, deadline)
+                         for label, sub_params in sub_requests]
+        results = zip([label for label, sub_params in sub_requests], results)
+        solr_response = merge_solr_responses([body for label, (res, body, shared) in results])
+        solr_response["solr_request"] = [res.effective_url for label, (res, body, shared) in results]
+        timing = {
+            "label": "parallel.elapsed",
+            "millis": millis(clock() - started),
+            "subs": [
+                solr_timing(res.request_time, body, label="async.fetch.elapsed." + label)
+                for label, (res, body, shared) in results
+            ]
+        }
+        shared = any(shared for label, (res, body, shared) in results)
+    else:
+        res, solr_response, shared = yield solr_fetch(search_engine_endpoint, params, solr_facet_api, deadline)
+        timing = solr_timing(res.request_time, solr_response, label="async.fetch.elapsed")
+        solr_response = dict(solr_response, solr_request=res.effective_url)
+
+    data = solr_data(validated_data, solr_response, timing, hm_plan, time_plan)
+    timing["singleflight"] = {"shared": shared}
+    raise gen.Return(data)
+
+
+@gen.coroutine
+def elasticsearch(validated_data):
+    """
+    views.elasticsearch with the _search request on the loop.
+    """
+    body, time_facet, hm_grid = elasticsearch_body(validated_data)
+    res, es_response, shared = yield fetch_json(validated_data.get("search_engine_endpoint"), json_body=body,
+                                                deadline=validated_data.get("deadline"))
+
+    data = elasticsearch_data(validated_data, es_response, time_facet, hm_grid)
+    data["timing"] = {
+        "label": "async.fetch.elapsed",
+        "millis": millis(res.request_time),
+        "subs": [{
+            "label": "took",
+            "millis": es_response.get("took")
+        }],
+        "timed_out": es_response.get("timed_out"),
+        "singleflight": {"shared": shared}
+    }
+    raise gen.Return(data)
+
+
+def runs_on_executor(validated_data):
+    """
+    Federated, a.hm.time and original response searches keep their blocking views.search code
+    and run on the executor, off the loop.
+    """
+    return validated_data.get("search_engine_shards") or validated_data["query"].a_hm_time or \
+        validated_data.get("return_search_engine_original_response")
+
+
+@gen.coroutine
+def search_async(serializer):
+    """
+    views.search for a validated SearchSerializer without blocking the loop.
+    """
+    validated_data = serializer.validated_data
+    if runs_on_executor(validated_data):
+        data = yield IOLoop.current().run_in_executor(get_executor(), search, serializer)
+        raise gen.Return(data)
+
+    search_engine = validated_data.get("search_engine")
+    response_cache = get_response_cache()
+    key = None
+    data = None
+    if response_cache:
+        key = cache_key(serializer, response_cache.prefix)
+        data = response_cache.get(key)
+    cache_hit = data is not None
+
+    if not cache_hit:
+        if search_engine == "solr":
+            data = yield solr(validated_data)
+        else:
+            data = yield elasticsearch(validated_data)
+        if key and not data.get("partialResults"):
+            response_cache.set(key, search_engine, data)
+
+    if key:
+        data = dict(data)
+        data["timing"] = dict(data.get("timing", {}))
+        data["timing"]["cache"] = dict(response_cache.stats(), hit=cache_hit)
+
+    raise gen.Return(data)
+
+
+def negotiate_renderer(accept, format_suffix=None):
+    """
+    The search renderer for the format param or the Accept header, json by default.
+    """
+    renderers = [renderer() for renderer in SEARCH_RENDERER_CLASSES if renderer is not BrowsableAPIRenderer]
+    if format_suffix:
+        for renderer in renderers:
+            if renderer.format == format_suffix:
+                return renderer
+    media_types = [media_type.split(";")[0].strip() for media_type in (accept or "").split(",")]
+    for media_type in media_types:
+        for renderer in renderers:
+            if renderer.media_type == media_type:
+                return renderer
+    return renderers[0]
+
+
+def poll_index_changes():
+    """
+    Polls the index changes of api.signals every POLL_SECONDS on the executor, so the blocking
+    django cache read (memcached, redis) stays off the loop; the cache getters then skip theirs.
+    Call it on the loop of the server.
+    :return: the started PeriodicCallback.
+    """
+    changes = get_index_changes()
+    changes.background = True
+    loop = IOLoop.current()
+    timer = PeriodicCallback(lambda: loop.run_in_executor(get_executor(), changes.poll_now),
+                             max(changes.poll_seconds, 0.1) * 1000)
+    timer.start()
+    return timer
+
+
+class SearchHandler(web.RequestHandler):
+    """
+    GET /api/search/ like views.Search, but non blocking. The response is rendered by the same
+    renderers and the latency observed in the same histograms as the "total" stage.
+    """
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    def write_data(self, data, status=200):
+        renderer = negotiate_renderer(self.request.headers.get("Accept"), self.get_query_argument("format", None))
+        self.set_status(status)
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type += "; charset=" + renderer.charset
+        self.set_header("Content-Type", content_type)
+        self.finish(renderer.render(data, renderer.media_type))
+
+    @gen.coroutine
+    def get(self):
+        started = clock()
+        client = self.request.headers.get(client_header())
+        serializer = SearchSerializer(data=QueryDict(self.request.query), context={"client": client})
+        if not serializer.is_valid():
+            self.write_data(serializer.errors, status=400)
+            return
+
+        try:
+            data = yield search_async(serializer)
+        except DeadlineExceeded as e:
+            self.write_data({"search_engine": [str(e)]}, status=504)
+            return
+        self.write_data(data)
+        if metrics_enabled():
+            get_histograms().observe("total", search_engine_label(serializer.validated_data),
+                                     search_facets_label(serializer.validated_data), clock() - started)
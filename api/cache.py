@@ -0,0 +1,179 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+DEFAULT_CACHE_SETTINGS = {
+    "ENABLED": True,
+    "BACKEND": "local",  # "local" (per process) or "django" (shared through django.core.cache)
+    "CACHE_ALIAS": "default",
+    "KEY_PREFIX": "search",
+    "TTL": {"solr": 60, "elasticsearch": 60},
+    "MAX_ENTRIES": 1000,
+    "MAX_BYTES": 64 * 1024 * 1024,
+}
+# a complete response answers the search whatever its deadline, partial ones are not cached.
+UNKEYED_FIELDS = ("deadline_ms",)
+
+
+def canonical_query(serializer):
+    """
+    Every field of the serializer with the validated value or None, sorted by name,
+    so equivalent requests produce the same cache key regardless of order or omitted defaults.
+    The fields in UNKEYED_FIELDS don't change the results and are left out.
+    :param serializer: a valid SearchSerializer.
+    :return: list of (field, value) pairs.
+    """
+    validated_data = serializer.validated_data
+    return sorted((name, validated_data.get(name)) for name in serializer.fields if name not in UNKEYED_FIELDS)
+
+
+def cache_key(serializer, prefix="search"):
+    canonical = json.dumps(canonical_query(serializer), separators=(",", ":"), default=str)
+    return "{0}:{1}".format(prefix, hashlib.sha1(canonical).hexdigest())
+
+
+class LocalBackend(object):
+    """
+    In process LRU bounded by entry count and by the serialized size of the entries.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, size, value = entry
+            if expires < time.time():
+                self._bytes -= size
+                return None
+            self._entries[key] = entry  # most recently used goes last.
+            return value
+
+    def set(self, key, value, ttl, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (time.time() + ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+            }
+
+
+class DjangoBackend(object):
+    """
+    Shares entries between workers through a django.core.cache backend. Eviction is
+    delegated to that backend (e.g. OPTIONS.MAX_ENTRIES of LocMemCache or memcached LRU).
+    """
+
+    def __init__(self, alias="default"):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl, size):
+        self.cache.set(key, value, ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {}
+
+
+class ResponseCache(object):
+    """
+    Caches the shaped search responses keyed by the canonical validated query.
+    """
+
+    def __init__(self, backend, ttl=None, prefix="search"):
+        self.backend = backend
+        self.ttl = ttl or {}
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_CACHE_SETTINGS)
+        config.update(getattr(settings, "SEARCH_RESPONSE_CACHE", {}))
+        if config["BACKEND"] == "django":
+            backend = DjangoBackend(config["CACHE_ALIAS"])
+        else:
+            backend = LocalBackend(config["MAX_ENTRIES"], config["MAX_BYTES"])
+        return cls(backend, ttl=config["TTL"], prefix=config["KEY_PREFIX"])
+
+    def ttl_for(self, search_engine):
+        return self.ttl.get(search_engine, 0)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, search_engine, value):
+        ttl = self.ttl_for(search_engine)
+        if ttl <= 0:
+            return
+        size = len(json.dumps(value, default=str))
+        self.backend.set(key, value, ttl, size)
+
+    def stats(self):
+        with self._lock:
+            data = {"hits": self.hits, "misses": self.misses}
+        data.update(self.backend.stats())
+        return data
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Process wide ResponseCache configured by settings.SEARCH_RESPONSE_CACHE, None when disabled.
+    """
+    global _cache
+    if not getattr(settings, "SEARCH_RESPONSE_CACHE", DEFAULT_CACHE_SETTINGS).get("ENABLED", True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache.from_settings()
+    return _cache
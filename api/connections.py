@@ -0,0 +1,251 @@
+import json
+import threading
+import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+from requests.packages.urllib3.util.retry import Retry
+
+from api.deadline import DeadlineExceeded
+from api.metrics import stage
+from api.replicas import get_replica_router
+from api.singleflight import SingleFlight
+
+DEFAULT_POOL_SETTINGS = {
+    "POOL_CONNECTIONS": 10,
+    "POOL_MAXSIZE": 20,
+    "MAX_RETRIES": 2,
+    "BACKOFF_FACTOR": 0.1,
+    "CONNECT_TIMEOUT": 3.05,
+    "READ_TIMEOUT": 60,
+    "KEEP_ALIVE": True,
+    "COMPRESSION": True,
+}
+
+
+def endpoint_host(search_engine_endpoint):
+    """
+    http://54.221.223.91:8983/solr/hypermap2/select to http://54.221.223.91:8983
+    :param search_engine_endpoint: full endpoint url.
+    :return: scheme and netloc, the key of the pooled session.
+    """
+    parts = urlparse.urlsplit(search_engine_endpoint)
+    return "{0}://{1}".format(parts.scheme, parts.netloc.lower())
+
+
+class SearchRetry(Retry):
+    """
+    Retries like Retry, but never a read timeout: the engine is slow rather than flaky, asking
+    again only adds load and multiplies the time a worker waits.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        return super(SearchRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+
+
+class SessionPool(object):
+    """
+    Keeps one keep-alive requests.Session per search engine host, so consecutive
+    searches reuse the TCP/TLS connections instead of handshaking on every call.
+    With compression the responses are asked for gzipped, otherwise uncompressed.
+    Safe to share across worker threads.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=20, max_retries=2, backoff_factor=0.1,
+                 connect_timeout=3.05, read_timeout=60, keep_alive=True, compression=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = (connect_timeout, read_timeout)
+        self.keep_alive = keep_alive
+        self.compression = compression
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_POOL_SETTINGS)
+        config.update(getattr(settings, "SEARCH_ENGINE_POOL", {}))
+        return cls(
+            pool_connections=config["POOL_CONNECTIONS"],
+            pool_maxsize=config["POOL_MAXSIZE"],
+            max_retries=config["MAX_RETRIES"],
+            backoff_factor=config["BACKOFF_FACTOR"],
+            connect_timeout=config["CONNECT_TIMEOUT"],
+            read_timeout=config["READ_TIMEOUT"],
+            keep_alive=config["KEEP_ALIVE"],
+            compression=config["COMPRESSION"],
+        )
+
+    def _new_session(self):
+        retries = SearchRetry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=[502, 503, 504],
+            method_whitelist=frozenset(["GET", "HEAD"]),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        session.headers["Accept-Encoding"] = "gzip, deflate" if self.compression else "identity"
+        return session
+
+    def session_for(self, search_engine_endpoint):
+        """
+        :param search_engine_endpoint: full endpoint url.
+        :return: the pooled session of the endpoint host, created on first use.
+        """
+        host = endpoint_host(search_engine_endpoint)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                self.misses += 1
+                session = self._new_session()
+                self._sessions[host] = session
+            else:
+                self.hits += 1
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Drop in replacement of requests.request using the pooled session of the url host.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hosts": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Process wide SessionPool configured by settings.SEARCH_ENGINE_POOL.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SessionPool.from_settings()
+    return _pool
+
+
+_flights = SingleFlight()
+
+
+def get_flights():
+    return _flights
+
+
+def upstream_url(search_engine_endpoint, params):
+    """
+    :return: the final url requests would send for the endpoint and params.
+    """
+    return requests.Request("GET", search_engine_endpoint, params=params).prepare().url
+
+
+def fetch_json(search_engine_endpoint, params=None, json_body=None, deadline=None):
+    """
+    GET the endpoint (POST when there is a json body) through the pooled sessions and
+    decode the json response. Identical requests already in flight (settings.SEARCH_SINGLEFLIGHT)
+    are not sent again, their callers share the decoded response, so it must be treated as read only.
+    The request to an endpoint replicated in settings.SEARCH_REPLICAS goes to its replicas,
+    hedged and failed over by api.replicas.
+    :param deadline: api.deadline.Deadline whose remaining time is the read timeout, and the
+    longest wait for an identical request in flight.
+    :return: (response, decoded json, True when shared with another caller).
+    """
+    def send(endpoint):
+        pool = get_pool()
+        kwargs = {"params": params}
+        if deadline is not None:
+            kwargs["timeout"] = deadline.timeout(pool.timeout[0])
+        try:
+            if json_body is not None:
+                return pool.post(endpoint, json=json_body, **kwargs)
+            return pool.get(endpoint, **kwargs)
+        except requests.exceptions.Timeout:
+            if deadline is None:
+                raise
+            raise DeadlineExceeded("Deadline of {0} ms exceeded by {1}".format(
+                deadline.budget_ms, endpoint_host(endpoint)))
+
+    def send_replica(endpoint):
+        res = send(endpoint)
+        if res.status_code >= 500:
+            res.raise_for_status()
+        return res
+
+    def fetch():
+        replicas = get_replica_router().for_endpoint(search_engine_endpoint)
+        if replicas is None:
+            res = send(search_engine_endpoint)
+        else:
+            res = replicas.call(send_replica)
+        with stage("decode"):
+            return res, res.json()
+
+    if not getattr(settings, "SEARCH_SINGLEFLIGHT", True):
+        res, body = fetch()
+        return res, body, False
+
+    key = upstream_url(search_engine_endpoint, sorted((params or {}).items()))
+    if json_body is not None:
+        key += " " + json.dumps(json_body, sort_keys=True)
+    (res, body), shared = _flights.do(key, fetch, deadline)
+    return res, body, shared
+
+
+DEFAULT_PARALLEL_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Process wide thread pool, bounded by settings.SEARCH_PARALLEL_WORKERS, running the
+    concurrent upstream sub requests.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "SEARCH_PARALLEL_WORKERS", DEFAULT_PARALLEL_WORKERS))
+    return _executor
@@ -0,0 +1,87 @@
+from django.conf import settings
+
+from api.metrics import clock
+
+DEFAULT_DEADLINE_SETTINGS = {
+    "DEFAULT_MS": None,
+    "MAX_MS": None,
+    "HEADROOM_MS": 100,
+    "CLIENT_HEADER": "X-Search-Client",
+    "CLIENTS": {},
+}
+
+
+class DeadlineExceeded(Exception):
+    """
+    The search engine did not answer within the deadline of the search.
+    """
+
+
+class Deadline(object):
+    """
+    Time budget of one search, from its validation on. The search engine is given the budget
+    less headroom_ms (solr timeAllowed, elasticsearch timeout), kept for the network, decoding
+    and shaping, and answers with what it found by then. The remaining budget is the read
+    timeout of the upstream requests, in case it does not.
+    """
+
+    def __init__(self, budget_ms, headroom_ms=100):
+        self.budget_ms = budget_ms
+        self.headroom_ms = headroom_ms
+        self.expires = clock() + budget_ms / 1000.0
+
+    @classmethod
+    def from_settings(cls, requested_ms=None, client=None):
+        """
+        The deadline of a search: requested_ms, else the default of the client in CLIENTS, else
+        DEFAULT_MS, capped at MAX_MS. None when there is none.
+        """
+        config = dict(DEFAULT_DEADLINE_SETTINGS)
+        config.update(getattr(settings, "SEARCH_DEADLINE", {}))
+        budget_ms = requested_ms or config["CLIENTS"].get(client) or config["DEFAULT_MS"]
+        if not budget_ms:
+            return None
+        if config["MAX_MS"]:
+            budget_ms = min(budget_ms, config["MAX_MS"])
+        return cls(budget_ms, headroom_ms=config["HEADROOM_MS"])
+
+    @property
+    def engine_ms(self):
+        """
+        Milliseconds the search engine is allowed. Depends on the budget only, not on the time
+        left, so identical searches with the same budget still send identical requests.
+        """
+        return max(1, self.budget_ms - self.headroom_ms)
+
+    def expired(self):
+        return clock() >= self.expires
+
+    def remaining(self):
+        """
+        :return: seconds left, raises DeadlineExceeded when there are none.
+        """
+        remaining = self.expires - clock()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline of {0} ms exceeded".format(self.budget_ms))
+        return remaining
+
+    def timeout(self, connect_timeout):
+        """
+        requests (connect, read) timeout of an upstream request sent now.
+        """
+        remaining = self.remaining()
+        return min(connect_timeout, remaining), remaining
+
+
+def client_header():
+    """
+    The header naming the client, e.g. X-Search-Client.
+    """
+    return getattr(settings, "SEARCH_DEADLINE", {}).get("CLIENT_HEADER", DEFAULT_DEADLINE_SETTINGS["CLIENT_HEADER"])
+
+
+def request_client(request):
+    """
+    The client of a django request, named by its client_header(), or None.
+    """
+    return request.META.get("HTTP_" + client_header().upper().replace("-", "_"))
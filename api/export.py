@@ -0,0 +1,50 @@
+import csv
+import json
+
+
+class _Line(object):
+    """
+    File like object handing back what csv.writer writes, so rows can be yielded one by one.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def csv_rows(docs, fields):
+    """
+    Encodes docs as csv lines with a header row of fields, the docs missing a field get an
+    empty cell.
+    :param docs: iterable of dicts.
+    :param fields: columns to export.
+    :return: generator of csv lines.
+    """
+    writer = csv.writer(_Line())
+    yield writer.writerow([_csv_value(field) for field in fields])
+    for doc in docs:
+        yield writer.writerow([_csv_value(doc.get(field)) for field in fields])
+
+
+def ndjson_rows(docs):
+    """
+    :param docs: iterable of dicts.
+    :return: generator of newline delimited json lines.
+    """
+    for doc in docs:
+        yield json.dumps(doc) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_rows, "text/csv"),
+    "ndjson": (ndjson_rows, "application/x-ndjson"),
+}
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+def pairs(alternating):
+    """
+    ["bob", 3, "al", 2] to [("bob", 3), ("al", 2)], the solr facet list format.
+    """
+    return zip(alternating[::2], alternating[1::2])
+
+
+def unpairs(label_counts):
+    alternating = []
+    for label, count in label_counts:
+        alternating.extend([label, count])
+    return alternating
+
+
+def merge_counts(facets, limit=None):
+    """
+    Sums the counts of the same label across shards and keeps the top limit.
+    Like any distributed top-k this is exact only when every shard returned the label.
+    :param facets: solr alternating label/count lists.
+    :return: alternating label/count list sorted by count descending.
+    """
+    totals = OrderedDict()
+    for facet in facets:
+        for label, count in pairs(facet):
+            totals[label] = totals.get(label, 0) + count
+    merged = sorted(totals.items(), key=lambda label_count: -label_count[1])
+    if limit:
+        merged = merged[:limit]
+    return unpairs(merged)
+
+
+def merge_time(time_facets):
+    """
+    Sums a.time bucket counts. Shards have to share start, end and gap, the buckets
+    are sorted by their ISO-8601 label which is chronological.
+    """
+    merged = dict(time_facets[0])
+    totals = {}
+    for time_facet in time_facets:
+        for label, count in pairs(time_facet.get("counts") or []):
+            totals[label] = totals.get(label, 0) + count
+    merged["counts"] = unpairs(sorted(totals.items()))
+    return merged
+
+
+def _add_grids(left, right):
+    """
+    Adds two solr counts_ints2D grids cell by cell, a null grid or row is all zeros.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    grid = []
+    for left_row, right_row in zip(left, right):
+        if left_row is None:
+            grid.append(right_row)
+        elif right_row is None:
+            grid.append(left_row)
+        else:
+            grid.append([a + b for a, b in zip(left_row, right_row)])
+    return grid
+
+
+def merge_heatmaps(heatmaps):
+    """
+    Adds solr heatmap facets cell by cell. Every heatmap has to cover the same grid,
+    i.e. same gridLevel, columns, rows and bounds.
+    :param heatmaps: solr alternating key/value heatmap lists.
+    :return: (merged heatmap, list of heatmaps skipped because their grid differs).
+    """
+    first = OrderedDict(pairs(heatmaps[0]))
+    grid_keys = ("gridLevel", "columns", "rows", "minX", "maxX", "minY", "maxY")
+    counts = first.get("counts_ints2D")
+    skipped = []
+    for heatmap in heatmaps[1:]:
+        other = OrderedDict(pairs(heatmap))
+        if any(other.get(key) != first.get(key) for key in grid_keys):
+            skipped.append(heatmap)
+            continue
+        counts = _add_grids(counts, other.get("counts_ints2D"))
+    first["counts_ints2D"] = counts
+    return unpairs(first.items()), skipped
+
+
+def merge_docs(docs_lists, sort_key=None, reverse=False, limit=None):
+    """
+    Merge sorts the docs of every shard. Without a sort key the shards are interleaved.
+    """
+    if not docs_lists:
+        return []
+    if sort_key is None:
+        merged = []
+        for position in range(max(len(docs) for docs in docs_lists)):
+            merged.extend(docs[position] for docs in docs_lists if position < len(docs))
+    else:
+        merged = sorted((doc for docs in docs_lists for doc in docs), key=sort_key, reverse=reverse)
+    if limit:
+        merged = merged[:limit]
+    return merged
@@ -0,0 +1,343 @@
+import bisect
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from api.federation import pairs
+from api.renderers import heatmap_grid
+from api.signals import get_index_changes, search_index_changed
+from api.utils import parse_lat_lon_box
+
+DEFAULT_HEATMAP_CACHE_SETTINGS = {
+    "ENABLED": True,
+    "TTL": 60,
+    "MAX_BYTES": 32 * 1024 * 1024,
+    "ALIGN": 16,
+    "MAX_CELLS": 100000,
+}
+
+HEATMAP_PARAMS = ("facet.heatmap", "facet.heatmap.geom", "facet.heatmap.gridLevel", "facet.heatmap.distErr")
+EPSILON = 1e-9
+
+
+def _floor(value):
+    return int(math.floor(value + EPSILON))
+
+
+def _ceil(value):
+    return int(math.ceil(value - EPSILON))
+
+
+class HeatmapCache(object):
+    """
+    Solr heatmap grids by (filter set, grid level, aligned region). Solr grids of every level
+    are aligned on the world, so a cached block answers any viewport inside it at its level,
+    and coarser levels whose cells are whole multiples of its cells by summing them.
+
+    The grid level of a distErr request is not known before asking solr, it is learned:
+    solr picks coarser levels for larger distErr, so a distErr between two observed ones
+    that got the same level gets that level too. Cell sizes are learned from the responses.
+    """
+
+    def __init__(self, ttl=60, max_bytes=32 * 1024 * 1024, align=16, max_cells=100000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.align = align
+        self.max_cells = max_cells
+        self._blocks = OrderedDict()  # (filters, level, column, row) -> (expires, grid), least recently used first.
+        self._cells = {}  # (scope, level) -> (cell width, cell height) in degrees.
+        self._levels = {}  # scope -> sorted [(distErr, level)]
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_HEATMAP_CACHE_SETTINGS)
+        config.update(getattr(settings, "SEARCH_HEATMAP_CACHE", {}))
+        return cls(ttl=config["TTL"], max_bytes=config["MAX_BYTES"], align=config["ALIGN"],
+                   max_cells=config["MAX_CELLS"])
+
+    def level_for(self, scope, dist_err):
+        """
+        :return: the grid level solr picks for dist_err, None while unknown.
+        """
+        with self._lock:
+            observed = self._levels.get(scope, [])
+            position = bisect.bisect_left(observed, (dist_err,))
+            if position < len(observed) and observed[position][0] == dist_err:
+                return observed[position][1]
+            if 0 < position < len(observed) and observed[position - 1][1] == observed[position][1]:
+                return observed[position][1]
+        return None
+
+    def region(self, scope, level, box):
+        """
+        Global cells of the level intersecting the box.
+        :param box: (min_lat, min_lon, max_lat, max_lon)
+        :return: (column, row, end column, end row), ends exclusive and rows from the north, or
+        None while the cell size of the level is unknown.
+        """
+        cell = self._cells.get((scope, level))
+        if cell is None:
+            return None
+        width, height = cell
+        min_lat, min_lon, max_lat, max_lon = box
+        columns, rows = _world_cells(cell)
+        return (max(0, _floor((min_lon + 180.0) / width)), max(0, _floor((90.0 - max_lat) / height)),
+                min(columns, _ceil((max_lon + 180.0) / width)), min(rows, _ceil((90.0 - min_lat) / height)))
+
+    def aligned(self, scope, level, region):
+        """
+        The region grown to multiples of align cells, what is fetched on a miss so that
+        panning nearby is a hit, unless that grows past max_cells.
+        """
+        columns, rows = _world_cells(self._cells[(scope, level)])
+        column, row, end_column, end_row = region
+        grown = (column - column % self.align, row - row % self.align,
+                 min(columns, _ceil(float(end_column) / self.align) * self.align),
+                 min(rows, _ceil(float(end_row) / self.align) * self.align))
+        if (grown[2] - grown[0]) * (grown[3] - grown[1]) > self.max_cells:
+            return region
+        return grown
+
+    def geom(self, scope, level, region):
+        """
+        facet.heatmap.geom selecting exactly the cells of the region: its box inset by a
+        quarter cell, so no neighbouring cell touches it.
+        """
+        width, height = self._cells[(scope, level)]
+        column, row, end_column, end_row = region
+        return "[{0},{1} TO {2},{3}]".format(
+            90.0 - end_row * height + height / 4, -180.0 + column * width + width / 4,
+            90.0 - row * height - height / 4, -180.0 + end_column * width - width / 4)
+
+    def learn(self, scope, heatmap, dist_err=None):
+        """
+        Records the cell size of the heatmap level, and the level solr picked for dist_err.
+        """
+        facet = dict(pairs(heatmap))
+        level = facet["gridLevel"]
+        cell = ((facet["maxX"] - facet["minX"]) / facet["columns"], (facet["maxY"] - facet["minY"]) / facet["rows"])
+        with self._lock:
+            self._cells.setdefault((scope, level), cell)
+            if dist_err is not None:
+                observed = self._levels.setdefault(scope, [])
+                if (dist_err, level) not in observed:
+                    bisect.insort(observed, (dist_err, level))
+
+    def store(self, filters, heatmap):
+        """
+        Keeps the grid of a solr heatmap response as a block of global cells.
+        :param filters: the filter set, its first item is the scope (endpoint, field).
+        """
+        scope = filters[0]
+        facet = dict(pairs(heatmap))
+        level = facet["gridLevel"]
+        width, height = self._cells[(scope, level)]
+        grid = heatmap_grid(facet.get("counts_ints2D"), facet["rows"], facet["columns"])
+        if grid.nbytes > self.max_bytes:
+            return
+        key = (filters, level, int(round((facet["minX"] + 180.0) / width)), int(round((90.0 - facet["maxY"]) / height)))
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1].nbytes
+            self._blocks[key] = (time.time() + self.ttl, grid)
+            self.bytes += grid.nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._blocks.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def lookup(self, filters, level, region, count=True):
+        """
+        The solr heatmap of the region at the level, sliced from a cached block of the level
+        or summed from a block of a finer level. None on a miss.
+        """
+        scope = filters[0]
+        width, height = self._cells[(scope, level)]
+        column, row, end_column, end_row = region
+        now = time.time()
+        with self._lock:
+            grid = None
+            for key, (expires, block) in list(self._blocks.items()):
+                block_filters, block_level, block_column, block_row = key
+                if block_filters != filters or block_level < level:
+                    continue
+                if expires < now:
+                    del self._blocks[key]
+                    self.bytes -= block.nbytes
+                    continue
+                ratio = _cell_ratio((width, height), self._cells[(scope, block_level)])
+                if ratio is None:
+                    continue
+                ratio_x, ratio_y = ratio
+                left, top = column * ratio_x - block_column, row * ratio_y - block_row
+                right, bottom = end_column * ratio_x - block_column, end_row * ratio_y - block_row
+                if left < 0 or top < 0 or right > block.shape[1] or bottom > block.shape[0]:
+                    continue
+                grid = block[top:bottom, left:right]
+                if ratio != (1, 1):
+                    grid = grid.reshape(end_row - row, ratio_y, end_column - column, ratio_x).sum(axis=(1, 3))
+                self._blocks[key] = self._blocks.pop(key)  # most recently used goes last.
+                break
+            if count:
+                if grid is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        if grid is None:
+            return None
+        return solr_heatmap(level, (width, height), region, grid)
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def clear(self, endpoint=None):
+        """
+        Invalidation, e.g. after reindexing: every block, or the blocks of one endpoint.
+        Learned levels and cell sizes only depend on the index schema and are kept.
+        """
+        with self._lock:
+            for key in list(self._blocks):
+                if endpoint is None or key[0][0][0] == endpoint:
+                    self.bytes -= self._blocks.pop(key)[1].nbytes
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": float(self.hits) / requests if requests else 0.0,
+                "blocks": len(self._blocks),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+            }
+
+
+def _world_cells(cell):
+    width, height = cell
+    return int(round(360.0 / width)), int(round(180.0 / height))
+
+
+def _cell_ratio(coarse, fine):
+    """
+    :return: (x, y) whole number of fine cells per coarse cell, None when not whole.
+    """
+    ratio = []
+    for coarse_side, fine_side in zip(coarse, fine):
+        value = coarse_side / fine_side
+        if abs(value - round(value)) > 1e-6 or round(value) < 1:
+            return None
+        ratio.append(int(round(value)))
+    return tuple(ratio)
+
+
+def solr_heatmap(level, cell, region, grid):
+    """
+    A grid of global cells in the solr heatmap facet format, with its null rows and null grid.
+    """
+    width, height = cell
+    column, row, end_column, end_row = region
+    counts = [values if any(values) else None for values in grid.tolist()]
+    if not any(counts):
+        counts = None
+    return [
+        "gridLevel", level,
+        "columns", end_column - column,
+        "rows", end_row - row,
+        "minX", -180.0 + column * width,
+        "maxX", -180.0 + end_column * width,
+        "minY", 90.0 - end_row * height,
+        "maxY", 90.0 - row * height,
+        "counts_ints2D", counts
+    ]
+
+
+class HeatmapPlan(object):
+    """
+    How the heatmap of one solr request is answered: from the cache, in which case its params
+    are removed from the request, or from solr, with a grown aligned geom when the level is known.
+    """
+
+    def __init__(self, cache, filters, params):
+        self.cache = cache
+        self.filters = filters
+        self.heatmap = None
+        self.region = None
+        scope = filters[0]
+        self.level = params.get("facet.heatmap.gridLevel")
+        self.dist_err = None
+        if self.level is None:
+            self.dist_err = float(params["facet.heatmap.distErr"])
+            self.level = cache.level_for(scope, self.dist_err)
+        if self.level is not None:
+            self.region = cache.region(scope, self.level, parse_lat_lon_box(params["facet.heatmap.geom"]))
+        if self.region is None:
+            cache.miss()
+            return
+
+        self.heatmap = cache.lookup(filters, self.level, self.region)
+        if self.heatmap is not None:
+            for name in HEATMAP_PARAMS:
+                params.pop(name, None)
+        else:
+            params["facet.heatmap.geom"] = cache.geom(scope, self.level, cache.aligned(scope, self.level, self.region))
+            params["facet.heatmap.gridLevel"] = self.level
+            params.pop("facet.heatmap.distErr", None)
+
+    @property
+    def hit(self):
+        return self.heatmap is not None
+
+    def resolve(self, heatmap, store=True):
+        """
+        :param heatmap: the solr heatmap facet of the request, None on a hit.
+        :param store: False for partial results, returned as solr answered them, grown region included.
+        :return: the heatmap of the requested region.
+        """
+        if self.heatmap is not None:
+            return self.heatmap
+        if not store:
+            return heatmap
+        self.cache.learn(self.filters[0], heatmap, self.dist_err)
+        self.cache.store(self.filters, heatmap)
+        if self.region is None:
+            return heatmap
+        return self.cache.lookup(self.filters, self.level, self.region, count=False) or heatmap
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_heatmap_cache():
+    """
+    Process wide HeatmapCache configured by settings.SEARCH_HEATMAP_CACHE, None when disabled.
+    Index changes published by other processes are applied to it first.
+    """
+    global _cache
+    if not getattr(settings, "SEARCH_HEATMAP_CACHE", DEFAULT_HEATMAP_CACHE_SETTINGS).get("ENABLED", True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = HeatmapCache.from_settings()
+    get_index_changes().poll()
+    return _cache
+
+
+def _invalidate(sender, endpoint=None, since=None, **kwargs):
+    if _cache is not None:
+        _cache.clear(endpoint)
+
+
+search_index_changed.connect(_invalidate, dispatch_uid="api.heatmap_cache")
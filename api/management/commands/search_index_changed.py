@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.signals import get_index_changes
+from api.utils import parse_datetime
+
+
+class Command(BaseCommand):
+    help = "Drops the cached time histogram buckets and heatmaps of a reindexed endpoint in every api process."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--endpoint", help="the search_engine_endpoint reindexed, every endpoint by default")
+        parser.add_argument("--since", help="only the buckets ending after this time, e.g. 2016-05-01T00:00:00Z")
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            try:
+                since = parse_datetime(options["since"])
+            except ValueError as e:
+                raise CommandError("--since: {0}".format(e))
+        get_index_changes().publish(options["endpoint"], since)
+        self.stdout.write("Published the index change of {0}{1}.".format(
+            options["endpoint"] or "every endpoint", " since {0}".format(since.isoformat()) if since else ""))
@@ -0,0 +1,98 @@
+import glob
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.slowlog import DEFAULT_SLOW_QUERY_LOG_SETTINGS
+
+SORT_KEYS = {
+    "total": lambda row: row["total_ms"],
+    "p95": lambda row: row["p95_ms"],
+    "count": lambda row: row["count"],
+}
+
+
+def read_records(paths):
+    for path in paths:
+        with open(path) as lines:
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def weighted_percentile(samples, percentile):
+    """
+    :param samples: (value, weight) pairs.
+    :return: the smallest value whose cumulative weight reaches percentile of the total.
+    """
+    samples = sorted(samples)
+    target = sum(weight for value, weight in samples) * percentile
+    cumulative = 0.0
+    for value, weight in samples:
+        cumulative += weight
+        if cumulative >= target:
+            return value
+    return samples[-1][0] if samples else None
+
+
+def aggregate(records):
+    """
+    Rows by query signature with the estimated searches, their total, mean, p95 and max latency,
+    the mean upstream QTime and response bytes. Sampled records count for their weight.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get("signature") or "", []).append(record)
+    rows = []
+    for signature, group in groups.items():
+        weights = [record.get("weight", 1) for record in group]
+        count = sum(weights)
+        total = sum(record["latency_ms"] * weight for record, weight in zip(group, weights))
+        qtimes = [record["qtime"] for record in group if record.get("qtime") is not None]
+        sizes = [record["bytes"] for record in group if record.get("bytes") is not None]
+        rows.append({
+            "signature": signature,
+            "records": len(group),
+            "slow": sum(1 for record in group if record.get("slow")),
+            "count": count,
+            "total_ms": total,
+            "mean_ms": total / count,
+            "p95_ms": weighted_percentile(zip([record["latency_ms"] for record in group], weights), 0.95),
+            "max_ms": max(record["latency_ms"] for record in group),
+            "qtime_ms": sum(qtimes) / float(len(qtimes)) if qtimes else None,
+            "bytes": sum(sizes) // len(sizes) if sizes else None,
+        })
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Top query parameter combinations of the slow query log by total time, p95 or frequency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*",
+                            help="slow query log files, SEARCH_SLOW_QUERY_LOG PATH and its rotated files by default")
+        parser.add_argument("--top", type=int, default=20)
+        parser.add_argument("--by", choices=sorted(SORT_KEYS), default="total")
+        parser.add_argument("--json", action="store_true", help="print the rows as json")
+
+    def handle(self, *args, **options):
+        paths = options["paths"]
+        if not paths:
+            path = dict(DEFAULT_SLOW_QUERY_LOG_SETTINGS, **getattr(settings, "SEARCH_SLOW_QUERY_LOG", {}))["PATH"]
+            paths = sorted(glob.glob(path + ".*")) + glob.glob(path)
+        rows = aggregate(read_records(paths))
+        rows.sort(key=SORT_KEYS[options["by"]], reverse=True)
+        rows = rows[:options["top"]]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(rows, indent=2, sort_keys=True))
+            return
+        self.stdout.write("{0:>9} {1:>7} {2:>12} {3:>9} {4:>9} {5:>9} {6:>9} {7:>10}  {8}".format(
+            "searches", "slow", "total ms", "mean ms", "p95 ms", "max ms", "qtime ms", "bytes", "signature"))
+        for row in rows:
+            self.stdout.write("{0:>9.0f} {1:>7} {2:>12.0f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9} {7:>10}  {8}".format(
+                row["count"], row["slow"], row["total_ms"], row["mean_ms"], row["p95_ms"], row["max_ms"],
+                "-" if row["qtime_ms"] is None else "{0:.1f}".format(row["qtime_ms"]),
+                "-" if row["bytes"] is None else row["bytes"], row["signature"]))
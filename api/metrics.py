@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+DEFAULT_METRICS_SETTINGS = {
+    "ENABLED": True,
+    "BUCKETS": (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
+METRIC_NAME = "hhypermap_search_stage_seconds"
+
+
+def monotonic_clock():
+    """
+    time.monotonic, on python 2 clock_gettime(CLOCK_MONOTONIC) through ctypes, otherwise time.time.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or "libc.so.6").clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+        def monotonic():
+            timespec = Timespec()
+            if clock_gettime(1, ctypes.byref(timespec)):  # CLOCK_MONOTONIC on linux
+                raise OSError("clock_gettime failed")
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
+
+
+clock = monotonic_clock()
+
+
+def millis(elapsed):
+    """
+    :param elapsed: seconds or a timedelta.
+    :return: float milliseconds, what the timing nodes report.
+    """
+    if hasattr(elapsed, "total_seconds"):
+        elapsed = elapsed.total_seconds()
+    return round(elapsed * 1000, 3)
+
+
+class Stages(object):
+    """
+    Seconds spent in every stage of one request, summed when a stage runs more than once,
+    and the labels of its latency histograms. A stage nested in another one (decode in upstream)
+    is not counted in the outer one too: the stages add up to at most the total.
+    """
+
+    def __init__(self):
+        self.started = clock()
+        self.durations = OrderedDict()
+        self.labels = {}
+        self.open = []  # the running _Stage, innermost last
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def server_timing(self, total):
+        """
+        Server-Timing header value, durations in milliseconds.
+        """
+        entries = list(self.durations.items()) + [("total", total)]
+        return ", ".join("{0};dur={1:.3f}".format(name, seconds * 1000) for name, seconds in entries)
+
+
+class _Stage(object):
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.started = clock()
+        self.nested = 0.0
+        self.stages.open.append(self)
+
+    def __exit__(self, *exc_info):
+        self.stages.open.pop()
+        seconds = clock() - self.started
+        self.stages.add(self.name, seconds - self.nested)
+        if self.stages.open:
+            self.stages.open[-1].nested += seconds
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+_local = threading.local()
+
+
+def stage(name):
+    """
+    with stage("params"): ... times the block into the stages of the current request, a no-op
+    outside of one (metrics disabled, worker threads).
+    """
+    stages = getattr(_local, "stages", None)
+    if stages is None:
+        return _NO_STAGE
+    return _Stage(stages, name)
+
+
+def record(name, started):
+    """
+    Adds the time since started, a clock() value, to the stage of the current request.
+    """
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        stages.add(name, clock() - started)
+
+
+def set_labels(**labels):
+    """
+    Labels the latency histograms of the current request, e.g. engine="solr", facets="time+hm".
+    Only labelled requests are observed.
+    """
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        stages.labels.update(labels)
+
+
+class LatencyHistograms(object):
+    """
+    Cumulative latency histograms by (stage, engine, facets), rendered in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_METRICS_SETTINGS["BUCKETS"]):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # (stage, engine, facets) -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_METRICS_SETTINGS)
+        config.update(getattr(settings, "SEARCH_METRICS", {}))
+        return cls(buckets=config["BUCKETS"])
+
+    def observe(self, stage_name, engine, facets, seconds):
+        with self._lock:
+            series = self._series.get((stage_name, engine, facets))
+            if series is None:
+                series = self._series[(stage_name, engine, facets)] = [0] * (len(self.buckets) + 1) + [0.0]
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[position] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def prometheus(self):
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        lines = [
+            "# HELP {0} Seconds spent per stage of the api requests.".format(METRIC_NAME),
+            "# TYPE {0} histogram".format(METRIC_NAME),
+        ]
+        for (stage_name, engine, facets), values in series:
+            labels = 'stage="{0}",engine="{1}",facets="{2}"'.format(stage_name, engine, facets)
+            for bound, count in zip(self.buckets, values):
+                lines.append('{0}_bucket{{{1},le="{2!r}"}} {3}'.format(METRIC_NAME, labels, bound, count))
+            lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(METRIC_NAME, labels, values[-2]))
+            lines.append("{0}_sum{{{1}}} {2!r}".format(METRIC_NAME, labels, values[-1]))
+            lines.append("{0}_count{{{1}}} {2}".format(METRIC_NAME, labels, values[-2]))
+        return "\n".join(lines) + "\n"
+
+
+_histograms = None
+_histograms_lock = threading.Lock()
+
+
+def get_histograms():
+    """
+    Process wide LatencyHistograms configured by settings.SEARCH_METRICS.
+    """
+    global _histograms
+    if _histograms is None:
+        with _histograms_lock:
+            if _histograms is None:
+                _histograms = LatencyHistograms.from_settings()
+    return _histograms
+
+
+def metrics_enabled():
+    return getattr(settings, "SEARCH_METRICS", DEFAULT_METRICS_SETTINGS).get("ENABLED", True)
+
+
+class TimingMiddleware(object):
+    """
+    Times the stages of every request, adds them as a Server-Timing header and observes the
+    labelled ones in the latency histograms. The DRF rendering is timed as the "render" stage.
+    Not used at all when settings.SEARCH_METRICS is disabled.
+    """
+
+    def __init__(self):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        _local.stages = Stages()
+
+    def process_template_response(self, request, response):
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            rendering = clock()
+            response.add_post_render_callback(lambda rendered: stages.add("render", clock() - rendering))
+        return response
+
+    def process_response(self, request, response):
+        stages = getattr(_local, "stages", None)
+        _local.stages = None
+        if stages is None:
+            return response
+        total = clock() - stages.started
+        response["Server-Timing"] = stages.server_timing(total)
+        response["Timing-Allow-Origin"] = "*"
+        if stages.labels:
+            engine = stages.labels.get("engine", "")
+            facets = stages.labels.get("facets", "")
+            histograms = get_histograms()
+            for name, seconds in list(stages.durations.items()) + [("total", total)]:
+                histograms.observe(name, engine, facets, seconds)
+        return response
@@ -0,0 +1,154 @@
+import datetime
+
+from api import utils
+
+WORLD = (-90.0, -180.0, 90.0, 180.0)
+DEFAULT_TIME_FACET_DAYS = 90
+GAP_UNITS = {
+    "YEARS": "years",
+    "MONTHS": "months",
+    "WEEKS": "weeks",
+    "DAYS": "days",
+    "HOURS": "hours",
+    "MINUTES": "minutes",
+    "SECONDS": "seconds",
+}
+
+
+class CompiledQuery(object):
+    """
+    The parsed form of a validated search, built once by the serializer and read by the
+    solr and elasticsearch compilers, so no query string is parsed twice per request.
+    Immutable: use replace() to derive a changed copy.
+
+    q_time: (start, end) datetimes, either can be None for open ended, or None.
+    q_geo: (min_lat, min_lon, max_lat, max_lon) or None.
+    a_time: resolved (start, end) of the time facet or None when not faceting by time.
+    a_time_gap: solr gap of the time facet, e.g. +1DAYS.
+    a_hm: (min_lat, min_lon, max_lat, max_lon) of the heatmap region or None when not faceting.
+    a_hm_time: ((start, end), ...) time buckets of the heatmap stack or None.
+    """
+    __slots__ = ("q_time", "q_geo", "a_time", "a_time_gap", "a_hm", "a_hm_time")
+
+    def __init__(self, q_time=None, q_geo=None, a_time=None, a_time_gap=None, a_hm=None, a_hm_time=None):
+        for name, value in zip(self.__slots__, (q_time, q_geo, a_time, a_time_gap, a_hm, a_hm_time)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledQuery is immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("CompiledQuery is immutable, use replace()")
+
+    def replace(self, **changes):
+        values = dict((name, getattr(self, name)) for name in self.__slots__)
+        values.update(changes)
+        return CompiledQuery(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledQuery) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        return "CompiledQuery({0})".format(", ".join(
+            "{0}={1!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+    def __reduce__(self):
+        # __slots__ without __dict__ and a blocking __setattr__ need explicit pickling (django cache).
+        return CompiledQuery, tuple(getattr(self, name) for name in self.__slots__)
+
+
+def resolve_time_range(time_range, now=None):
+    """
+    :param time_range: (start, end) as parsed by utils.parse_datetime_range or None.
+    :return: (start, end), open ends default to 90 days ago and now.
+    """
+    now = now or datetime.datetime.utcnow()
+    start, end = time_range or (None, None)
+    if not start:
+        start = now - datetime.timedelta(days=DEFAULT_TIME_FACET_DAYS)
+    if not end:
+        end = now
+    return start, end
+
+
+def resolve_time_facet(time_range, time_gap, time_limit, now=None, natural_gaps=None):
+    """
+    The range and gap of the time facet: open ends default to 90 days ago and now.
+    Without time_gap the gap is planned from time_limit and both ends are snapped out to it,
+    otherwise only the defaulted ends are. Either way the defaults, that move with now, are on
+    the gap grid, so consecutive requests are identical and share their buckets.
+    :param time_range: (start, end) as parsed by utils.parse_datetime_range or None.
+    :param time_gap: (quantity, unit) as parsed by utils.parse_ISO8601 or None.
+    :param natural_gaps: the gaps the plan picks from, as in utils.compute_gap.
+    :return: ((start, end), solr's format gap)
+    """
+    start, end = resolve_time_range(time_range, now)
+    if time_gap:
+        gap = utils.iso8601_to_solr_gap(*time_gap)
+    else:
+        gap = utils.compute_gap(start, end, time_limit, natural_gaps)
+    given_start, given_end = time_range or (None, None)
+    if not (time_gap and given_start):
+        start = utils.snap_to_gap(start, gap)
+    if not (time_gap and given_end):
+        end = utils.snap_to_gap(end, gap, ceil=True)
+    return (start, end), gap
+
+
+def time_buckets(start, end, time_gap, max_buckets=None):
+    """
+    [start, end) divided by the gap, calendar aware, the last bucket ends at end.
+    :param time_gap: (quantity, unit) as parsed by utils.parse_ISO8601.
+    :param max_buckets: stop after one bucket more than this.
+    :return: ((start, end), ...)
+    """
+    from dateutil.relativedelta import relativedelta
+
+    quantity, unit = time_gap
+    step = relativedelta(**{GAP_UNITS[unit[0]]: quantity})
+    buckets = []
+    bucket_start = start
+    while bucket_start < end:
+        # from start every time, so month ends do not drift.
+        bucket_end = min(start + step * (len(buckets) + 1), end)
+        buckets.append((bucket_start, bucket_end))
+        if max_buckets is not None and len(buckets) > max_buckets:
+            break
+        bucket_start = bucket_end
+    return tuple(buckets)
+
+
+def compile_query(q_time=None, q_geo=None, a_time_limit=0, a_time_filter=None, a_time_gap=None,
+                  a_hm_limit=0, a_hm_filter=None, a_hm_time_gap=None, a_hm_time_max=None, natural_gaps=None):
+    """
+    Builds the CompiledQuery from already parsed values.
+    :param q_time: parsed (start, end) or None.
+    :param q_geo: parsed corners or None.
+    :param a_time_filter: parsed (start, end) or None.
+    :param a_time_gap: parsed (quantity, unit) or None.
+    :param a_hm_filter: parsed corners or None.
+    :param a_hm_time_gap: parsed (quantity, unit) or None, the heatmap stack buckets over
+    a_time_filter, q_time or 90 days.
+    :param a_hm_time_max: at most one more bucket than this is compiled.
+    :param natural_gaps: the gaps the time facet plan picks from, e.g. utils.ELASTICSEARCH_GAPS.
+    """
+    a_time = None
+    gap = None
+    if a_time_limit > 0:
+        a_time, gap = resolve_time_facet(a_time_filter or q_time, a_time_gap, a_time_limit,
+                                          natural_gaps=natural_gaps)
+    a_hm = None
+    a_hm_time = None
+    if a_hm_limit > 0:
+        a_hm = a_hm_filter or WORLD
+        if a_hm_time_gap:
+            start, end = resolve_time_range(a_time_filter or q_time)
+            a_hm_time = time_buckets(start, end, a_hm_time_gap, a_hm_time_max)
+    return CompiledQuery(q_time=q_time, q_geo=q_geo, a_time=a_time, a_time_gap=gap, a_hm=a_hm, a_hm_time=a_hm_time)
@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+
+import base64
+import calendar
+import datetime
+
+import msgpack
+import numpy
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+
+from api.federation import pairs
+from api.utils import parse_datetime
+
+# smallest little endian type holding the heatmap counts, signed ones when some are negative (deltas).
+HEATMAP_DTYPES = [(numpy.dtype("u1"), "uint8"), (numpy.dtype("<u2"), "uint16le"), (numpy.dtype("<u4"), "uint32le")]
+HEATMAP_SIGNED_DTYPES = [(numpy.dtype("i1"), "int8"), (numpy.dtype("<i2"), "int16le"), (numpy.dtype("<i4"), "int32le"),
+                         (numpy.dtype("<i8"), "int64le")]
+SOLR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def epoch_millis(value):
+    """
+    :param value: datetime or ISO-8601 string as returned by solr, e.g. 2013-03-01T00:00:00Z.
+    :return: milliseconds since the epoch, UTC.
+    """
+    if not isinstance(value, datetime.datetime):
+        try:
+            value = datetime.datetime.strptime(value, SOLR_DATE_FORMAT)
+        except ValueError:
+            value = parse_datetime(value)
+    return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+
+
+def epoch_millis_list(labels):
+    """
+    epoch_millis of many ISO-8601 UTC labels, parsed by numpy in one go.
+    """
+    try:
+        return numpy.array([label.rstrip("Z") for label in labels], dtype="datetime64[ms]").astype("int64").tolist()
+    except ValueError:
+        return [epoch_millis(label) for label in labels]
+
+
+def _plain(value):
+    """
+    Text keys and values, timedelta as float milliseconds and datetimes as epoch milliseconds,
+    so the python 2 str are not packed as msgpack binaries.
+    """
+    if isinstance(value, dict):
+        return dict((_plain(key), _plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds() * 1000
+    if isinstance(value, datetime.datetime):
+        return epoch_millis(value)
+    return value
+
+
+def columnar_counts(facet):
+    """
+    ["bob", 3, "al", 2] to {"labels": ["bob", "al"], "counts": [3, 2]}.
+    """
+    return {"labels": facet[::2], "counts": facet[1::2]}
+
+
+def columnar_time(a_time):
+    columns = {
+        "start": epoch_millis(a_time["start"]) if a_time.get("start") else None,
+        "end": epoch_millis(a_time["end"]) if a_time.get("end") else None,
+        "gap": _plain(a_time.get("gap")),
+    }
+    counts = a_time.get("counts") or []
+    columns["labels"] = epoch_millis_list(counts[::2])
+    columns["counts"] = counts[1::2]
+    return columns
+
+
+def heatmap_grid(counts, rows, columns):
+    """
+    The solr counts_ints2D grid, with its null grid or null rows, as a rows x columns
+    uint32 array, row major from north to south.
+    """
+    grid = numpy.zeros((rows, columns), dtype=HEATMAP_DTYPES[-1][0])
+    for row, values in enumerate(counts or []):
+        if values is not None:
+            grid[row] = values
+    return grid
+
+
+def pack_grid(grid):
+    """
+    :return: (buffer of the grid in the smallest type of HEATMAP_DTYPES or HEATMAP_SIGNED_DTYPES, dtype name)
+    """
+    smallest, largest = (grid.min(), grid.max()) if grid.size else (0, 0)
+    for dtype, name in HEATMAP_DTYPES if smallest >= 0 else HEATMAP_SIGNED_DTYPES:
+        if numpy.iinfo(dtype).min <= smallest and largest <= numpy.iinfo(dtype).max:
+            return grid.astype(dtype).tobytes(), name
+
+
+def columnar_heatmap(a_hm, encode_buffer):
+    heatmap = dict((_plain(key), value) for key, value in pairs(a_hm))
+    counts = heatmap.pop("counts_ints2D", None)
+    buffer, heatmap["dtype"] = pack_grid(heatmap_grid(counts, heatmap["rows"], heatmap["columns"]))
+    heatmap["counts"] = encode_buffer(buffer)
+    return heatmap
+
+
+def columnar_heatmap_stack(a_hm_time, encode_buffer):
+    stack = dict((_plain(key), _plain(value)) for key, value in a_hm_time.items() if key != "counts")
+    for key in ("start", "end"):
+        stack[key] = epoch_millis(a_hm_time[key])
+    stack["frames"] = epoch_millis_list(a_hm_time["frames"])
+    stack["counts"] = encode_buffer(base64.b64decode(a_hm_time["counts"]))
+    return stack
+
+
+def columnar(data, encode_buffer):
+    """
+    Reshapes a search response for the columnar formats: a.user and a.text as parallel
+    labels/counts arrays, a.time buckets as epoch milliseconds, a.hm as a packed buffer
+    with its dimensions, the a.hm.time stack buffer unwrapped from base64 and timing millis
+    as numbers. Anything else, like validation errors, keeps its shape.
+    :param encode_buffer: how the packed heatmap bytes are written, e.g. base64 in json.
+    """
+    if not isinstance(data, dict):
+        return _plain(data)
+    shaped = {}
+    for key, value in data.items():
+        if key == "d.docs":
+            shaped[key] = value  # decoded json, already text.
+        elif key in ("a.user", "a.text") and isinstance(value, list):
+            shaped[key] = columnar_counts(value)
+        elif key == "a.time" and isinstance(value, dict):
+            shaped[key] = columnar_time(value)
+        elif key == "a.hm" and isinstance(value, list):
+            shaped[key] = columnar_heatmap(value, encode_buffer)
+        elif key == "a.hm.time" and isinstance(value, dict):
+            shaped[key] = columnar_heatmap_stack(value, encode_buffer)
+        else:
+            shaped[_plain(key)] = _plain(value)
+    return shaped
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    The columnar shape as json, the heatmap buffer base64 encoded.
+    """
+    media_type = "application/vnd.hhypermap.columnar+json"
+    format = "columnar"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is not None:
+            data = columnar(data, base64.b64encode)
+        return super(ColumnarJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+
+def _msgpack_default(obj):
+    # lazy translations of the validation messages.
+    return "{0}".format(obj)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    The columnar shape as MessagePack, the heatmap buffer as a bin.
+    """
+    media_type = "application/x-msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(columnar(data, bytes), use_bin_type=True, default=_msgpack_default)
+
+
+SEARCH_RENDERER_CLASSES = list(api_settings.DEFAULT_RENDERER_CLASSES) + [ColumnarJSONRenderer, MessagePackRenderer]
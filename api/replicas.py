@@ -0,0 +1,365 @@
+import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from api.deadline import DeadlineExceeded
+from api.metrics import clock
+
+DEFAULT_REPLICA_SETTINGS = {
+    "INDEXES": {},
+    "HEDGE_DELAY_MS": None,
+    "HEDGE_PERCENTILE": 0.95,
+    "DEFAULT_HEDGE_DELAY_MS": 100,
+    "MIN_HEDGE_DELAY_MS": 5,
+    "HEDGE_BUDGET": 0.1,
+    "HEDGE_WORKERS": 32,
+    "WINDOW": 20,
+    "MIN_REQUESTS": 10,
+    "ERROR_RATIO": 0.5,
+    "SLOW_MS": 2000,
+    "OPEN_SECONDS": 10,
+}
+METRIC_PREFIX = "hhypermap_search_replica"
+# latencies kept per replica set for the hedge delay percentile, recomputed every DELAY_REFRESH requests.
+LATENCY_SAMPLES = 1000
+DELAY_REFRESH = 50
+MIN_DELAY_SAMPLES = 20
+# most hedges in a row after a quiet period.
+HEDGE_BURST = 10
+EWMA_WEIGHT = 0.2
+# fraction of the requests sent to a random healthy replica, so the latency of all of them stays known.
+EXPLORE_RATIO = 0.05
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    Health of one replica out of its last window requests: an error or an answer slower than
+    slow_ms is a failure. At error_ratio failures, once there are min_requests, it opens and the
+    replica gets no traffic for open_seconds. Then one trial request is let through (half open),
+    closing it again on success. Not thread safe, ReplicaSet holds the lock.
+    """
+
+    def __init__(self, window=20, min_requests=10, error_ratio=0.5, slow_ms=2000, open_seconds=10):
+        self.min_requests = min_requests
+        self.error_ratio = error_ratio
+        self.slow = slow_ms / 1000.0
+        self.open_seconds = open_seconds
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if clock() - self.opened_at < self.open_seconds:
+            return OPEN
+        return HALF_OPEN
+
+    def available(self):
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self.trial)
+
+    def begin(self):
+        if self.state == HALF_OPEN:
+            self.trial = True
+
+    def record(self, seconds, ok):
+        failed = not ok or seconds > self.slow
+        if self.opened_at is not None:
+            if self.state == HALF_OPEN and self.trial:
+                self.trial = False
+                if failed:
+                    self.opened_at = clock()
+                else:
+                    self.opened_at = None
+                    self.outcomes.clear()
+            return
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= self.min_requests and \
+                sum(self.outcomes) >= self.error_ratio * len(self.outcomes):
+            self.opened_at = clock()
+            self.opened += 1
+
+    def error_ratio_now(self):
+        return sum(self.outcomes) / float(len(self.outcomes)) if self.outcomes else 0.0
+
+
+class Replica(object):
+
+    def __init__(self, endpoint, breaker):
+        self.endpoint = endpoint
+        self.breaker = breaker
+        self.ewma = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedges_won = 0
+
+    def score(self):
+        """
+        Expected wait on this replica, lower is better. Unmeasured replicas go first.
+        """
+        return (self.ewma or 0.0) * (1 + self.in_flight)
+
+    def stats(self):
+        return {
+            "endpoint": self.endpoint,
+            "state": self.breaker.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_ratio": round(self.breaker.error_ratio_now(), 3),
+            "ewma_ms": None if self.ewma is None else round(self.ewma * 1000, 3),
+            "in_flight": self.in_flight,
+            "hedges_won": self.hedges_won,
+            "opened": self.breaker.opened,
+        }
+
+
+class ReplicaSet(object):
+    """
+    Equivalent endpoints of one logical index. Every request goes to the better of two random
+    healthy replicas by latency and load, a few to any healthy one. When it has not answered
+    after the hedge delay, the observed hedge_percentile latency unless hedge_delay_ms is set,
+    a duplicate goes to the next replica and the first answer wins. Hedges are bounded to a
+    hedge_budget fraction of the requests, 0 for none. Failed attempts fail over to the next
+    replica. When every breaker is open the replica closest to its trial is used anyway.
+    """
+
+    def __init__(self, endpoint, replicas, hedge_delay_ms=None, hedge_percentile=0.95, default_hedge_delay_ms=100,
+                 min_hedge_delay_ms=5, hedge_budget=0.1, breaker_options=None):
+        self.endpoint = endpoint
+        self.replicas = [Replica(replica, CircuitBreaker(**(breaker_options or {}))) for replica in replicas]
+        self.fixed_delay = None if hedge_delay_ms is None else hedge_delay_ms / 1000.0
+        self.hedge_percentile = hedge_percentile
+        self.min_delay = min_hedge_delay_ms / 1000.0
+        self.delay = default_hedge_delay_ms / 1000.0
+        self.hedge_budget = hedge_budget
+        self.tokens = HEDGE_BURST if hedge_budget else 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.failovers = 0
+
+    def candidates(self):
+        """
+        :return: the replicas in the order to try them, the primary first.
+        """
+        with self._lock:
+            self.requests += 1
+            self.tokens = min(HEDGE_BURST, self.tokens + self.hedge_budget)
+            healthy = [replica for replica in self.replicas if replica.breaker.available()]
+            if not healthy:
+                return [min(self.replicas, key=lambda replica: replica.breaker.opened_at)]
+            healthy.sort(key=Replica.score)
+            if len(healthy) > 1 and random.random() < EXPLORE_RATIO:
+                first = random.choice(healthy)
+            elif len(healthy) > 2:
+                first = min(random.sample(healthy, 2), key=Replica.score)
+            else:
+                return healthy
+            healthy.remove(first)
+            healthy.insert(0, first)
+            return healthy
+
+    def hedge_delay(self):
+        return self.fixed_delay if self.fixed_delay is not None else self.delay
+
+    def take_hedge(self):
+        """
+        :return: True when the hedge budget allows one more hedge, which is then counted.
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+
+    def failover(self):
+        with self._lock:
+            self.failovers += 1
+
+    def begin(self, replica):
+        with self._lock:
+            replica.breaker.begin()
+            replica.in_flight += 1
+            replica.requests += 1
+
+    def record(self, replica, seconds, ok, hedge_won=False):
+        with self._lock:
+            replica.in_flight -= 1
+            replica.breaker.record(seconds, ok)
+            if not ok:
+                replica.errors += 1
+                return
+            replica.ewma = seconds if replica.ewma is None else \
+                EWMA_WEIGHT * seconds + (1 - EWMA_WEIGHT) * replica.ewma
+            if hedge_won:
+                replica.hedges_won += 1
+            self.latencies.append(seconds)
+            self.recorded += 1
+            if len(self.latencies) >= MIN_DELAY_SAMPLES and self.recorded % DELAY_REFRESH == 0:
+                ordered = sorted(self.latencies)
+                self.delay = max(self.min_delay, ordered[int(len(ordered) * self.hedge_percentile) - 1])
+
+    def call(self, send):
+        """
+        Runs send(endpoint) on the replicas, hedged and failed over, on the hedge executor.
+        send raises on failures, e.g. responses with a 5xx status. The hedges losing the race
+        are not cancelled, their outcome still counts for their replica. An exceeded deadline
+        is not failed over.
+        :return: the first successful result.
+        """
+        executor = get_hedge_executor()
+        candidates = self.candidates()
+        answered = threading.Event()
+
+        def attempt(replica, hedge=False):
+            self.begin(replica)
+            started = clock()
+            try:
+                result = send(replica.endpoint)
+            except Exception:
+                self.record(replica, clock() - started, False)
+                raise
+            self.record(replica, clock() - started, True, hedge_won=hedge and not answered.is_set())
+            answered.set()
+            return result
+
+        futures = {executor.submit(attempt, candidates.pop(0))}
+        hedging = bool(candidates)
+        error = None
+        while futures:
+            # a failover may have taken the last candidate, there is nothing left to hedge with.
+            done, futures = wait(futures, timeout=self.hedge_delay() if hedging and candidates else None,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                hedging = False
+                if self.take_hedge():
+                    futures.add(executor.submit(attempt, candidates.pop(0), True))
+                continue
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not futures and candidates and not isinstance(error, DeadlineExceeded):
+                self.failover()
+                futures.add(executor.submit(attempt, candidates.pop(0)))
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return {
+                "endpoint": self.endpoint,
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "failovers": self.failovers,
+                "hedge_delay_ms": round(self.hedge_delay() * 1000, 3),
+                "replicas": [replica.stats() for replica in self.replicas],
+            }
+
+
+class ReplicaRouter(object):
+    """
+    The ReplicaSet of every logical endpoint of settings.SEARCH_REPLICAS INDEXES.
+    """
+
+    def __init__(self, indexes, **options):
+        self.sets = dict((endpoint, ReplicaSet(endpoint, replicas, **options))
+                         for endpoint, replicas in indexes.items())
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_REPLICA_SETTINGS)
+        config.update(getattr(settings, "SEARCH_REPLICAS", {}))
+        return cls(
+            config["INDEXES"],
+            hedge_delay_ms=config["HEDGE_DELAY_MS"],
+            hedge_percentile=config["HEDGE_PERCENTILE"],
+            default_hedge_delay_ms=config["DEFAULT_HEDGE_DELAY_MS"],
+            min_hedge_delay_ms=config["MIN_HEDGE_DELAY_MS"],
+            hedge_budget=config["HEDGE_BUDGET"],
+            breaker_options={
+                "window": config["WINDOW"],
+                "min_requests": config["MIN_REQUESTS"],
+                "error_ratio": config["ERROR_RATIO"],
+                "slow_ms": config["SLOW_MS"],
+                "open_seconds": config["OPEN_SECONDS"],
+            },
+        )
+
+    def for_endpoint(self, search_engine_endpoint):
+        """
+        :return: the ReplicaSet of the endpoint, None when it is not replicated.
+        """
+        return self.sets.get(search_engine_endpoint)
+
+    def stats(self):
+        return [self.sets[endpoint].stats() for endpoint in sorted(self.sets)]
+
+    def prometheus(self):
+        """
+        Per replica counters and gauges in the Prometheus text format, empty without replicas.
+        """
+        lines = []
+        for stats in self.stats():
+            index = 'index="{0}"'.format(stats["endpoint"])
+            for name in ("requests", "hedges", "failovers"):
+                lines.append("{0}_set_{1}_total{{{2}}} {3}".format(METRIC_PREFIX, name, index, stats[name]))
+            lines.append("{0}_hedge_delay_seconds{{{1}}} {2!r}".format(
+                METRIC_PREFIX, index, stats["hedge_delay_ms"] / 1000.0))
+            for replica in stats["replicas"]:
+                labels = '{0},replica="{1}"'.format(index, replica["endpoint"])
+                for name in ("requests", "errors", "hedges_won"):
+                    lines.append("{0}_{1}_total{{{2}}} {3}".format(METRIC_PREFIX, name, labels, replica[name]))
+                lines.append("{0}_open{{{1}}} {2}".format(METRIC_PREFIX, labels, int(replica["state"] != CLOSED)))
+                if replica["ewma_ms"] is not None:
+                    lines.append("{0}_latency_ewma_seconds{{{1}}} {2!r}".format(
+                        METRIC_PREFIX, labels, replica["ewma_ms"] / 1000.0))
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_replica_router():
+    """
+    Process wide ReplicaRouter configured by settings.SEARCH_REPLICAS.
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ReplicaRouter.from_settings()
+    return _router
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_hedge_executor():
+    """
+    Threads running the replica attempts, apart from connections.get_executor so the parallel
+    facet and a.hm.time requests running there never wait on their own pool.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = dict(DEFAULT_REPLICA_SETTINGS)
+                config.update(getattr(settings, "SEARCH_REPLICAS", {}))
+                _executor = ThreadPoolExecutor(max_workers=config["HEDGE_WORKERS"])
+    return _executor
@@ -1,13 +1,48 @@
 import re
 from . import utils
+from .deadline import Deadline
+from .query import compile_query
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import URLValidator
 from rest_framework import serializers
 
+SEARCH_ENGINES = ["solr", "elasticsearch"]
+DEFAULT_HM_TIME_MAX_FRAMES = 100
+# a stored field name, no solr functions, transformers or local params in d_docs_fields.
+FIELD_NAME = re.compile(r"^[A-Za-z_][\w.]*$")
 
 
-class SearchSerializer(serializers.Serializer):
+
+def parse_docs_fields(value):
+    """
+    Would be for example: id,title,layer_date
+    Returns ["id", "title", "layer_date"], the fields have to be in settings.SEARCH_DOCS_FIELDS when set.
+    """
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    known = getattr(settings, "SEARCH_DOCS_FIELDS", None)
+    for field in fields:
+        if not FIELD_NAME.match(field):
+            raise serializers.ValidationError("{0} is not a field name".format(field))
+        if known is not None and field not in known:
+            raise serializers.ValidationError("{0} is not a field of the documents".format(field))
+    return fields or None
+
+
+def search_engines(attrs):
+    """
+    The engines a search runs on: search_engine and those of the federated search_engine_shards.
+    """
+    return [attrs.get("search_engine")] + [search_engine for search_engine, _ in attrs.get("search_engine_shards") or []]
+
+
+class QuerySerializer(serializers.Serializer):
+    """
+    The search engine and the q.* constraints shared by the search and the export endpoints.
+    """
     search_engine = serializers.ChoiceField(
         help_text="Where will be running the search.",
-        choices=["solr", "elasticsearch"]
+        choices=SEARCH_ENGINES
     )
     search_engine_endpoint = serializers.URLField(
         required=True,
@@ -34,6 +69,84 @@ class SearchSerializer(serializers.Serializer):
         required=False,
         help_text="Constrains docs by matching exactly a certain user."
     )
+    normalize_filters = serializers.IntegerField(
+        required=False,
+        help_text="When 1 q.time and q.geo are grown out to the server time and geo grids before searching solr, "
+                  "so nearby searches reuse its cached filters. Only for clients tolerating the looser filters. "
+                  "Defaults to the server setting."
+    )
+
+    def validate_q_time(self, value):
+        """
+        Would be for example: [2013-03-01 TO 2013-04-01T00:00:00] and/or [* TO *]
+        Returns a valid sorl value. [2013-03-01T00:00:00Z TO 2013-04-01T00:00:00Z] and/or [* TO *]
+        """
+        if value:
+            try:
+                start, end = self.parsed("q_time", utils.parse_datetime_range(value))
+                left = '*'
+                if start:
+                    left = start.isoformat() + 'Z'
+                right = '*'
+                if end:
+                    right = end.isoformat() + 'Z'
+                return "[{0} TO {1}]".format(left, right)
+            except Exception as e:
+                raise serializers.ValidationError(e.message)
+
+        return value
+
+    def validate_q_geo(self, value):
+        """
+        Would be for example: [-90,-180 TO 90,180]
+        """
+        if value:
+            try:
+                self.parsed("q_geo", utils.parse_lat_lon_box(value))
+            except Exception as e:
+                raise serializers.ValidationError(e.message)
+
+        return value
+
+    def parsed(self, field_name, value=None):
+        """
+        Remembers the parsed value of a field while validating, so it is parsed only once.
+        Without value returns the remembered one.
+        """
+        if not hasattr(self, "_parsed"):
+            self._parsed = {}
+        if value is not None:
+            self._parsed[field_name] = value
+        return self._parsed.get(field_name)
+
+    def validate(self, attrs):
+        """
+        Adds the CompiledQuery of the search as "query", what the search engine compilers read.
+        The time facet of a search on elasticsearch is planned with the gaps it counts like solr.
+        """
+        on_elasticsearch = "elasticsearch" in search_engines(attrs)
+        attrs["query"] = compile_query(
+            q_time=self.parsed("q_time"),
+            q_geo=self.parsed("q_geo"),
+            a_time_limit=attrs.get("a_time_limit", 0),
+            a_time_filter=self.parsed("a_time_filter"),
+            a_time_gap=self.parsed("a_time_gap"),
+            a_hm_limit=attrs.get("a_hm_limit", 0),
+            a_hm_filter=self.parsed("a_hm_filter"),
+            a_hm_time_gap=self.parsed("a_hm_time_gap"),
+            a_hm_time_max=getattr(settings, "SEARCH_HM_TIME_MAX_FRAMES", DEFAULT_HM_TIME_MAX_FRAMES),
+            natural_gaps=utils.ELASTICSEARCH_GAPS if on_elasticsearch else None,
+        )
+        query = attrs["query"]
+        if query.a_time_gap and on_elasticsearch:
+            try:
+                utils.gap_to_elasticsearch(query.a_time_gap, query.a_time[0])
+            except Exception as e:
+                raise serializers.ValidationError({"a_time_gap": [e.message]})
+        return attrs
+
+
+class SearchSerializer(QuerySerializer):
     d_docs_limit = serializers.IntegerField(
         required=False,
         help_text="How many documents to return.",
@@ -46,6 +159,12 @@ class SearchSerializer(serializers.Serializer):
         default="score",
         choices=["score", "time", "distance"]
     )
+    d_docs_fields = serializers.CharField(
+        required=False,
+        help_text="Comma separated fields of the documents to return, e.g. id,title,layer_date. Defaults to "
+                  "every stored field, large geometries and abstracts included. The id, and layer_date when "
+                  "sorting by time, are always returned."
+    )
     a_time_limit = serializers.IntegerField(
         required=False,
         help_text="Non-0 triggers time/date range faceting. This value is the maximum number of time ranges to "
@@ -83,6 +202,19 @@ class SearchSerializer(serializers.Serializer):
                   "than the most recent request. Ignores a.hm.limit."
     )
 
+    a_hm_time_gap = serializers.CharField(
+        required=False,
+        help_text="Non-empty returns a.hm.time, a stack of heatmaps, one per consecutive time interval of this gap "
+                  "over a.time.filter, q.time or otherwise 90 days. Same ISO-8601 duration subset as a.time.gap."
+    )
+    a_hm_time_encoding = serializers.ChoiceField(
+        required=False,
+        help_text="How the a.hm.time counts are packed: 'raw' frames or 'delta', every frame but the first as "
+                  "its difference from the previous one.",
+        default="raw",
+        choices=["raw", "delta"]
+    )
+
     a_text_limit = serializers.IntegerField(
         required=False,
         help_text="Returns the most frequently occurring words. WARNING: There is usually a significant performance "
@@ -99,56 +231,172 @@ class SearchSerializer(serializers.Serializer):
         help_text="Returns te original search engine response.",
         default=0
     )
+    search_engine_shards = serializers.ListField(
+        required=False,
+        child=serializers.CharField(),
+        help_text="Federated search. More endpoints searched together with search_engine_endpoint as engine:url, "
+                  "e.g. solr:http://host:8983/solr/2016/select. Repeat the parameter for every shard."
+    )
+    parallel_facets = serializers.IntegerField(
+        required=False,
+        help_text="When 1 the docs and every facet are requested as concurrent sub requests, "
+                  "so the response is not as slow as the sum of its facets. Defaults to the server setting."
+    )
+    solr_facet_api = serializers.ChoiceField(
+        required=False,
+        help_text="How solr facets are requested: 'legacy' facet.* params or a single 'json' facet computed "
+                  "in one pass by the JSON Facet API. Defaults to the server setting.",
+        choices=["legacy", "json"]
+    )
+    search_engine_debug = serializers.IntegerField(
+        required=False,
+        help_text="When 1 solr adds its debug=timing breakdown to the timing of the response. Defaults to the "
+                  "server setting, off for lean upstream responses. Always on for the original response."
+    )
+    deadline_ms = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Time budget of the search in milliseconds. The search engine returns what it found by then, "
+                  "flagged partialResults, and the search fails with 504 when it does not answer in time. "
+                  "Defaults to the budget of the X-Search-Client header client, else the server one."
+    )
 
+    def validate_d_docs_fields(self, value):
+        return parse_docs_fields(value)
 
+    def validate_search_engine_shards(self, value):
+        """
+        Would be for example: ["solr:http://host:8983/solr/2016/select", "elasticsearch:http://host:9200/2015/_search"]
+        Returns [("solr", "http://host:8983/solr/2016/select"), ("elasticsearch", "http://host:9200/2015/_search")]
+        """
+        shards = []
+        for shard in value or []:
+            search_engine, _, endpoint = shard.partition(":")
+            if search_engine not in SEARCH_ENGINES:
+                raise serializers.ValidationError(
+                    "Shard {0} must start with one of {1}".format(shard, ", ".join(SEARCH_ENGINES)))
+            try:
+                URLValidator()(endpoint)
+            except DjangoValidationError:
+                raise serializers.ValidationError("Shard {0} is not a valid URL".format(shard))
+            shards.append((search_engine, endpoint))
+        return shards
 
+    def validate_a_time_filter(self, value):
+        """
+        Would be for example: [2013-03-01 TO 2013-04-01:00:00:00] and/or [* TO *]
+        """
+        if value:
+            try:
+                self.parsed("a_time_filter", utils.parse_datetime_range(value))
+            except Exception as e:
+                raise serializers.ValidationError(e.message)
 
-    def validate_q_time(self, value):
+        return value
+
+    def validate_a_time_gap(self, value):
         """
-        Would be for example: [2013-03-01 TO 2013-04-01T00:00:00] and/or [* TO *]
-        Returns a valid sorl value. [2013-03-01T00:00:00Z TO 2013-04-01T00:00:00Z] and/or [* TO *]
+        Would be for example: P1D or PT6H
         """
         if value:
             try:
-                start, end = utils.parse_datetime_range(value)
-                left = '*'
-                if start:
-                    left = start.isoformat() + 'Z'
-                right = '*'
-                if end:
-                    right = end.isoformat() + 'Z'
-                return "[{0} TO {1}]".format(left, right)
+                self.parsed("a_time_gap", utils.parse_ISO8601(value))
             except Exception as e:
                 raise serializers.ValidationError(e.message)
 
         return value
 
-    def validate_q_geo(self, value):
+    def validate_a_hm_time_gap(self, value):
         """
-        Would be for example: [-90,-180 TO 90,180]
+        Would be for example: P1D or PT6H
         """
         if value:
             try:
-                utils.parse_geo_box(value)
+                self.parsed("a_hm_time_gap", utils.parse_ISO8601(value))
             except Exception as e:
                 raise serializers.ValidationError(e.message)
 
         return value
 
-    def validate_a_time_filter(self, value):
+    def validate_a_hm_filter(self, value):
         """
-        Would be for example: [2013-03-01 TO 2013-04-01:00:00:00] and/or [* TO *]
+        Would be for example: [-90,-180 TO 90,180]
         """
         if value:
             try:
-                utils.parse_datetime_range(value)
+                self.parsed("a_hm_filter", utils.parse_lat_lon_box(value))
             except Exception as e:
                 raise serializers.ValidationError(e.message)
 
         return value
 
+    def validate(self, attrs):
+        """
+        Adds the Deadline of the search, or None, as "deadline". The client is the "client" of the
+        serializer context.
+        """
+        attrs = super(SearchSerializer, self).validate(attrs)
+        attrs["deadline"] = Deadline.from_settings(attrs.get("deadline_ms"), self.context.get("client"))
+        a_hm_time = attrs["query"].a_hm_time
+        max_frames = getattr(settings, "SEARCH_HM_TIME_MAX_FRAMES", DEFAULT_HM_TIME_MAX_FRAMES)
+        if attrs.get("a_hm_time_gap") and a_hm_time is None:
+            raise serializers.ValidationError({"a_hm_time_gap": ["A heatmap stack needs a_hm_limit."]})
+        if a_hm_time is not None and len(a_hm_time) > max_frames:
+            raise serializers.ValidationError(
+                {"a_hm_time_gap": ["More than {0} heatmaps, use a larger gap.".format(max_frames)]})
+        return attrs
+
 
 
+class ExportSerializer(QuerySerializer):
+    d_docs_limit = serializers.IntegerField(
+        required=False,
+        help_text="How many documents to export. 0 exports every matching document.",
+        default=0,
+        min_value=0
+    )
+    d_docs_page_size = serializers.IntegerField(
+        required=False,
+        help_text="How many documents to fetch from the search engine per page while streaming.",
+        min_value=1,
+        max_value=10000
+    )
+    d_docs_fields = serializers.CharField(
+        required=False,
+        help_text="Comma separated fields of the documents to export, e.g. id,title,layer_date, the csv columns. "
+                  "Defaults to every stored field, the csv columns to the server setting of the search engine. "
+                  "The id is always exported."
+    )
+    export_format = serializers.ChoiceField(
+        required=False,
+        help_text="text/csv with a header row or newline delimited json.",
+        default="csv",
+        choices=["csv", "ndjson"]
+    )
+
+    def validate_d_docs_fields(self, value):
+        return parse_docs_fields(value)
+
+
+class TileSerializer(QuerySerializer):
+    a_hm_limit = serializers.IntegerField(
+        required=False,
+        help_text="Soft maximum on the number of heatmap cells fetched for the tile. Defaults to the server setting.",
+        min_value=1,
+        max_value=65536
+    )
+    a_hm_gridlevel = serializers.IntegerField(
+        required=False,
+        help_text="To explicitly specify the grid level of the tile heatmap. Ignores a.hm.limit.",
+        min_value=1
+    )
+    max_count = serializers.IntegerField(
+        required=False,
+        help_text="Count of the hottest colour, the tile maximum by default. Give neighbouring tiles the same value "
+                  "so their colours match.",
+        min_value=1
+    )
+
 
 class Timing(serializers.Serializer):
     label = serializers.CharField()
@@ -157,6 +405,7 @@ class Timing(serializers.Serializer):
 
 class SearchResponse(serializers.Serializer):
     a_matchDocs = serializers.IntegerField(default=0)
+    partialResults = serializers.BooleanField(default=False)
     d_docs = serializers.ListField(required=False)
     timing = Timing(required=False)
 
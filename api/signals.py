@@ -0,0 +1,111 @@
+import threading
+
+from django.conf import settings
+from django.dispatch import Signal
+
+from api.metrics import clock
+
+# Sent after documents of a search engine endpoint were (re)indexed, so the caches holding
+# counts of that endpoint drop them: endpoint None means every endpoint, since (a datetime)
+# limits the time histogram invalidation to the buckets from that time on.
+search_index_changed = Signal(providing_args=["endpoint", "since"])
+
+DEFAULT_INDEX_CHANGES_SETTINGS = {
+    "CACHE_ALIAS": "default",
+    "KEY_PREFIX": "search_index_changed",
+    "POLL_SECONDS": 1,
+    "TTL": 24 * 60 * 60,
+}
+
+
+class IndexChanges(object):
+    """
+    Carries search_index_changed across the api processes, whose caches are their own: publish
+    records a change in the django cache, every process sends the signal for the changes it
+    has not seen yet when it polls, at most every poll_seconds. Only a cache shared by the
+    processes (memcached, redis, database) reaches them all. Changes are kept for ttl seconds,
+    the longest any cached count lives anyway.
+    """
+
+    def __init__(self, cache_alias="default", key_prefix="search_index_changed", poll_seconds=1, ttl=24 * 60 * 60):
+        from django.core.cache import caches
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+        self.poll_seconds = poll_seconds
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._seen = None
+        self._polled = None
+        self.background = False  # True when poll_now runs on a timer, poll is then a no-op.
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_INDEX_CHANGES_SETTINGS)
+        config.update(getattr(settings, "SEARCH_INDEX_CHANGES", {}))
+        return cls(
+            cache_alias=config["CACHE_ALIAS"],
+            key_prefix=config["KEY_PREFIX"],
+            poll_seconds=config["POLL_SECONDS"],
+            ttl=config["TTL"],
+        )
+
+    def _key(self, sequence):
+        return "{0}:{1}".format(self.key_prefix, sequence)
+
+    def publish(self, endpoint=None, since=None):
+        """
+        Records a change for every process and sends search_index_changed in this one.
+        """
+        self.cache.add(self._key("sequence"), 0, timeout=None)
+        sequence = self.cache.incr(self._key("sequence"))
+        self.cache.set(self._key(sequence), (endpoint, since), self.ttl)
+        search_index_changed.send(sender=self.__class__, endpoint=endpoint, since=since)
+
+    def poll(self):
+        """
+        Sends search_index_changed for the changes published since the last poll, by this process
+        too, at most every poll_seconds. Nothing when polled in the background.
+        """
+        if not self.background:
+            self._poll(throttle=True)
+
+    def poll_now(self):
+        """
+        poll without the throttle, what a background timer calls.
+        """
+        self._poll(throttle=False)
+
+    def _poll(self, throttle):
+        # the first poll only notes where the changes are, the caches of a new process are empty.
+        if throttle and self._polled is not None and clock() - self._polled < self.poll_seconds:
+            return
+        with self._lock:
+            if throttle and self._polled is not None and clock() - self._polled < self.poll_seconds:
+                return
+            self._polled = clock()
+            sequence = self.cache.get(self._key("sequence")) or 0
+            seen, self._seen = self._seen, sequence
+            if seen is None or sequence <= seen:
+                return
+            changes = self.cache.get_many([self._key(number) for number in range(seen + 1, sequence + 1)])
+        for number in range(seen + 1, sequence + 1):
+            change = changes.get(self._key(number))
+            if change is not None:
+                endpoint, since = change
+                search_index_changed.send(sender=self.__class__, endpoint=endpoint, since=since)
+
+
+_changes = None
+_changes_lock = threading.Lock()
+
+
+def get_index_changes():
+    """
+    Process wide IndexChanges configured by settings.SEARCH_INDEX_CHANGES.
+    """
+    global _changes
+    if _changes is None:
+        with _changes_lock:
+            if _changes is None:
+                _changes = IndexChanges.from_settings()
+    return _changes
@@ -0,0 +1,75 @@
+import threading
+
+from api.deadline import DeadlineExceeded
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls sharing a key: the first caller runs the function and
+    the duplicates arriving while it is in flight wait for and share its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.waiters = 0
+        self.max_waiters = 0
+
+    def do(self, key, fn, deadline=None):
+        """
+        :param key: identity of the call, e.g. the final upstream url.
+        :param fn: callable without arguments.
+        :param deadline: api.deadline.Deadline of the caller, a duplicate waits for the flight at
+        most until it expires, then raises DeadlineExceeded. The flight itself goes on.
+        :return: (result of fn, True when shared from another caller's flight).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.waiters += 1
+
+        if not leader:
+            if deadline is None:
+                call.event.wait()
+            elif not call.event.wait(deadline.remaining()):
+                raise DeadlineExceeded("Deadline of {0} ms exceeded waiting for an identical search".format(
+                    deadline.budget_ms))
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self.max_waiters = max(self.max_waiters, call.waiters)
+            call.event.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "waiters": self.waiters,
+                "max_waiters": self.max_waiters,
+            }
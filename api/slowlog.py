@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from api.metrics import clock
+
+DEFAULT_SLOW_QUERY_LOG_SETTINGS = {
+    "ENABLED": False,
+    "PATH": os.path.join("logs", "slow_queries.ndjson"),
+    "THRESHOLD_MS": 1000,
+    "SAMPLE_RATE": 0.01,
+    "MAX_BYTES": 16 * 1024 * 1024,
+    "BACKUP_COUNT": 5,
+}
+# params whose values differ between otherwise identical searches, left out of the signature.
+VALUE_FREE_PARAMS = ("q_time", "q_geo", "q_text", "q_user", "a_time_filter", "a_hm_filter")
+
+
+def query_signature(query):
+    """
+    The parameter combination of a normalized query: the names of the constraints and the values
+    of everything else, e.g. "a_hm_limit=1000&a_time_limit=100&q_geo&search_engine=solr".
+    :param query: dict of the non empty validated params.
+    """
+    return "&".join(name if name in VALUE_FREE_PARAMS else u"{0}={1}".format(name, query[name])
+                    for name in sorted(query))
+
+
+class SlowQueryLog(object):
+    """
+    Writes one json record per line for the searches slower than threshold_ms and a sample_rate
+    fraction of the others, to a file rotated at max_bytes. A sampled record weighs
+    1 / sample_rate, the searches it stands for.
+    """
+
+    def __init__(self, path, threshold_ms=1000, sample_rate=0.01, max_bytes=16 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.logger = logging.Logger("api.slowlog")
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.addHandler(handler)
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_SLOW_QUERY_LOG_SETTINGS)
+        config.update(getattr(settings, "SEARCH_SLOW_QUERY_LOG", {}))
+        return cls(
+            config["PATH"],
+            threshold_ms=config["THRESHOLD_MS"],
+            sample_rate=config["SAMPLE_RATE"],
+            max_bytes=config["MAX_BYTES"],
+            backup_count=config["BACKUP_COUNT"],
+        )
+
+    def weight(self, latency_ms):
+        """
+        :return: the weight of the record of a search taking latency_ms, 0 when it is not logged.
+        """
+        if latency_ms >= self.threshold_ms:
+            return 1
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 1.0 / self.sample_rate
+        return 0
+
+    def log(self, record, latency_ms):
+        weight = self.weight(latency_ms)
+        if weight:
+            record = dict(record, latency_ms=round(latency_ms, 3), weight=weight,
+                          slow=latency_ms >= self.threshold_ms)
+            self.logger.info(json.dumps(record, sort_keys=True, separators=(",", ":"), default=str))
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_slow_query_log():
+    """
+    Process wide SlowQueryLog configured by settings.SEARCH_SLOW_QUERY_LOG.
+    """
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                _log = SlowQueryLog.from_settings()
+    return _log
+
+
+_local = threading.local()
+
+
+def annotate(**fields):
+    """
+    Adds fields to the slow query record of the current request, e.g. the upstream url and QTime.
+    Only annotated requests are logged.
+    """
+    record = getattr(_local, "record", None)
+    if record is not None:
+        record.update(fields)
+
+
+class SlowQueryMiddleware(object):
+    """
+    Logs the annotated requests to the slow query log with their total latency and response bytes.
+    Not used at all when settings.SEARCH_SLOW_QUERY_LOG is disabled.
+    """
+
+    def __init__(self):
+        if not getattr(settings, "SEARCH_SLOW_QUERY_LOG", DEFAULT_SLOW_QUERY_LOG_SETTINGS).get("ENABLED", False):
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        _local.record = {}
+        _local.started = clock()
+
+    def process_response(self, request, response):
+        record = getattr(_local, "record", None)
+        _local.record = None
+        if not record:
+            return response
+        latency_ms = (clock() - _local.started) * 1000
+        record.update({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "path": request.path,
+            "status": response.status_code,
+            "bytes": None if response.streaming else len(response.content),
+        })
+        get_slow_query_log().log(record, latency_ms)
+        return response
@@ -1,3 +1,1453 @@
-from django.test import TestCase
+import base64
+import datetime
+import gzip
+import io
+import json
+import os
+import pickle
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
 
-# Create your tests here.
+import msgpack
+import numpy
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from django.core.management import call_command
+from django.core.urlresolvers import resolve
+from django.test import SimpleTestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ValidationError
+
+from api import async_search, cache, federation, metrics, replicas, signals, utils, views
+from api.connections import SearchRetry, SessionPool, endpoint_host
+from api.deadline import Deadline, DeadlineExceeded
+from api.export import csv_rows
+from api.heatmap_cache import HeatmapCache, HeatmapPlan, solr_heatmap
+from api.query import CompiledQuery, compile_query, resolve_time_facet, time_buckets
+from api.renderers import ColumnarJSONRenderer, MessagePackRenderer, columnar_heatmap_stack
+from api.serializers import ExportSerializer, SearchSerializer
+from api.signals import IndexChanges, search_index_changed
+from api.singleflight import SingleFlight
+from api.tiles import colorize, encode_png, is_tile, resample, tile_box, tile_geom
+from api.time_cache import TimeHistogramCache, TimeHistogramPlan
+from api.slowlog import SlowQueryLog
+
+SOLR_ENDPOINT = "http://localhost:8983/solr/hypermap/select"
+ES_ENDPOINT = "http://localhost:9200/hypermap/_search"
+
+
+def search_serializer(**params):
+    serializer = SearchSerializer(data=dict({"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT},
+                                            **params))
+    serializer.is_valid(raise_exception=True)
+    return serializer
+
+
+class SolrFiltersTest(SimpleTestCase):
+    q_time = "[2016-05-01T10:20:30Z TO 2016-05-02T00:00:00Z]"
+    q_geo = "[-10.123,-20.456 TO 30,40]"
+
+    def fq(self, **params):
+        return views.solr_params(search_serializer(q_time=self.q_time, q_geo=self.q_geo, q_user="alice",
+                                                   **params).validated_data)["fq"]
+
+    def test_default_fq_are_unchanged(self):
+        self.assertEqual(self.fq(), ["{!field f=layer_originator tag=layer_originator}alice",
+                                     "layer_date:" + self.q_time, "bbox:" + self.q_geo])
+
+    @override_settings(SEARCH_SOLR_FILTERS={"UNCACHED_OFF_GRID": True, "UNCACHED": ("user",)})
+    def test_uncached_filters(self):
+        self.assertEqual(self.fq(), ["{!field f=layer_originator tag=layer_originator cache=false cost=0}alice",
+                                     "{!cache=false cost=10}layer_date:" + self.q_time,
+                                     "{!cache=false cost=100}bbox:" + self.q_geo])
+
+    @override_settings(SEARCH_SOLR_FILTERS={"UNCACHED_OFF_GRID": True})
+    def test_normalized_filters_are_cached(self):
+        self.assertEqual(self.fq(normalize_filters=1), ["{!field f=layer_originator tag=layer_originator}alice",
+                                                        "layer_date:[2016-05-01T10:20:00Z TO 2016-05-02T00:00:00Z]",
+                                                        "bbox:[-10.13,-20.46 TO 30.0,40.0]"])
+
+
+class JsonFacetTest(SimpleTestCase):
+
+    def compile(self):
+        validated_data = search_serializer(q_time="[2016-01-01 TO 2016-01-04]", a_time_limit=3, a_hm_limit=100,
+                                           a_text_limit=5, a_user_limit=5).validated_data
+        json_params, specs = utils.compile_json_facet(views.solr_params(validated_data))
+        return validated_data, json_params, specs
+
+    def test_legacy_facet_params_compile_to_one_json_facet(self):
+        validated_data, json_params, specs = self.compile()
+        self.assertFalse([name for name in json_params if name == "facet" or name.startswith(("facet.", "f."))])
+        facets = json.loads(json_params["json.facet"])
+        self.assertEqual(facets["range_layer_date"], {"type": "range", "field": "layer_date", "gap": "+1DAYS",
+                                                      "start": "2016-01-01T00:00:00Z", "end": "2016-01-04T00:00:00Z"})
+        self.assertEqual(facets["heatmap_bbox"]["geom"], "[-90,-180 TO 90,180]")
+        self.assertEqual(facets["field_title"], {"type": "terms", "field": "title", "limit": 5, "mincount": 0})
+        self.assertEqual(facets["field_layer_originator"]["domain"], {"excludeTags": "layer_originator"})
+
+    def test_decoded_response_shapes_like_the_legacy_one(self):
+        validated_data, json_params, specs = self.compile()
+        facets = {
+            "count": 3,
+            "range_layer_date": {"buckets": [{"val": "2016-01-01T00:00:00Z", "count": 2},
+                                             {"val": "2016-01-02T00:00:00Z", "count": 0},
+                                             {"val": "2016-01-03T00:00:00Z", "count": 1}]},
+            "heatmap_bbox": {"gridLevel": 1, "columns": 2, "rows": 1, "minX": -180.0, "maxX": 180.0,
+                             "minY": -90.0, "maxY": 90.0, "counts_ints2D": [[2, 1]]},
+            "field_title": {"buckets": [{"val": "roads", "count": 2}, {"val": "rivers", "count": 1}]},
+            "field_layer_originator": {"buckets": []},
+        }
+        legacy = {
+            "facet_ranges": {"layer_date": {"start": "2016-01-01T00:00:00Z", "end": "2016-01-04T00:00:00Z",
+                                            "gap": "+1DAYS", "counts": ["2016-01-01T00:00:00Z", 2,
+                                                                        "2016-01-02T00:00:00Z", 0,
+                                                                        "2016-01-03T00:00:00Z", 1]}},
+            "facet_heatmaps": {"bbox": ["gridLevel", 1, "columns", 2, "rows", 1, "minX", -180.0, "maxX", 180.0,
+                                        "minY", -90.0, "maxY", 90.0, "counts_ints2D", [[2, 1]]]},
+            "facet_fields": {"title": ["roads", 2, "rivers", 1], "layer_originator": []},
+        }
+        self.assertEqual(utils.decode_json_facet(facets, specs), legacy)
+        response = {"response": {"numFound": 3, "docs": []}}
+        self.assertEqual(
+            views.solr_data(validated_data, dict(response, facet_counts=utils.decode_json_facet(facets, specs)),
+                            {}, None, None),
+            views.solr_data(validated_data, dict(response, facet_counts=legacy), {}, None, None))
+
+    def test_empty_facets_decode_to_empty_counts(self):
+        validated_data, json_params, specs = self.compile()
+        facet_counts = utils.decode_json_facet({"count": 0}, specs)
+        self.assertEqual(facet_counts["facet_ranges"]["layer_date"]["counts"], [])
+        self.assertEqual(facet_counts["facet_fields"], {"title": [], "layer_originator": []})
+        self.assertEqual(dict(federation.pairs(facet_counts["facet_heatmaps"]["bbox"]))["counts_ints2D"], None)
+
+
+SEARCH_DATA = {
+    "a.matchDocs": 3,
+    "d.docs": [{"id": "1", "title": "roads"}, {"id": "2", "title": "rivers"}],
+    "a.time": {"start": "2016-01-01T00:00:00Z", "end": "2016-01-03T00:00:00Z", "gap": "+1DAYS",
+               "counts": ["2016-01-01T00:00:00Z", 2, "2016-01-02T00:00:00Z", 1]},
+    "a.hm": ["gridLevel", 1, "columns", 3, "rows", 2, "minX", -180.0, "maxX", 180.0, "minY", -90.0, "maxY", 90.0,
+             "counts_ints2D", [None, [0, 300, 1]]],
+    "a.user": ["alice", 2, "bob", 1],
+    "a.text": ["roads", 2],
+}
+
+
+def from_columnar(shaped, decode_buffer):
+    """
+    The json response shape back out of a columnar one.
+    """
+    data = dict(shaped)
+    for key in ("a.user", "a.text"):
+        data[key] = federation.unpairs(zip(shaped[key]["labels"], shaped[key]["counts"]))
+    a_time = shaped["a.time"]
+    label = lambda millis: (utils.EPOCH + datetime.timedelta(milliseconds=millis)).isoformat() + "Z"
+    data["a.time"] = {"start": label(a_time["start"]), "end": label(a_time["end"]), "gap": a_time["gap"],
+                      "counts": federation.unpairs(zip([label(millis) for millis in a_time["labels"]],
+                                                       a_time["counts"]))}
+    a_hm = dict(shaped["a.hm"])
+    dtype = {"uint8": "u1", "uint16le": "<u2", "uint32le": "<u4"}[a_hm.pop("dtype")]
+    grid = numpy.frombuffer(decode_buffer(a_hm.pop("counts")), dtype=dtype).reshape(a_hm["rows"], a_hm["columns"])
+    a_hm["counts_ints2D"] = [row if any(row) else None for row in grid.tolist()]
+    data["a.hm"] = federation.unpairs((name, a_hm[name]) for name in (
+        "gridLevel", "columns", "rows", "minX", "maxX", "minY", "maxY", "counts_ints2D"))
+    return data
+
+
+class RenderersTest(SimpleTestCase):
+
+    def test_columnar_json_decodes_to_the_json_response(self):
+        expected = json.loads(JSONRenderer().render(SEARCH_DATA))
+        shaped = json.loads(ColumnarJSONRenderer().render(SEARCH_DATA))
+        self.assertEqual(shaped["a.hm"]["dtype"], "uint16le")
+        self.assertEqual(from_columnar(shaped, base64.b64decode), expected)
+
+    def test_msgpack_decodes_to_the_json_response(self):
+        expected = json.loads(JSONRenderer().render(SEARCH_DATA))
+        shaped = msgpack.unpackb(MessagePackRenderer().render(SEARCH_DATA), raw=False)
+        self.assertIsInstance(shaped["a.hm"]["counts"], bytes)
+        self.assertEqual(from_columnar(shaped, bytes), expected)
+
+    def test_errors_keep_their_shape(self):
+        errors = {"a_time_gap": ["Does not match the pattern: P1X"]}
+        self.assertEqual(msgpack.unpackb(MessagePackRenderer().render(errors), raw=False), errors)
+
+
+class DocsFieldsTest(SimpleTestCase):
+
+    def test_projection_reaches_solr_fl(self):
+        params = views.solr_params(search_serializer(d_docs_limit=10, d_docs_sort="time",
+                                                     d_docs_fields="title, layer_date,abstract").validated_data)
+        self.assertEqual(params["fl"], "id,layer_date,title,abstract")
+        self.assertNotIn("fl", views.solr_params(search_serializer(d_docs_limit=10).validated_data))
+
+    def test_projection_reaches_elasticsearch_source(self):
+        validated_data = search_serializer(search_engine="elasticsearch", search_engine_endpoint=ES_ENDPOINT,
+                                           d_docs_limit=10, d_docs_fields="title").validated_data
+        body, time_facet, hm_grid = views.elasticsearch_body(validated_data)
+        self.assertEqual(body["_source"], ["id", "title"])
+
+    def test_malformed_fields_are_rejected(self):
+        for fields in ("title,score()", "[explain]", "{!func}title"):
+            serializer = SearchSerializer(data={"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT,
+                                                "d_docs_fields": fields})
+            self.assertFalse(serializer.is_valid())
+            self.assertIn("d_docs_fields", serializer.errors)
+
+    @override_settings(SEARCH_DOCS_FIELDS=["id", "title", "layer_date"])
+    def test_unknown_fields_are_rejected(self):
+        serializer = SearchSerializer(data={"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT,
+                                            "d_docs_fields": "title,secret"})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors["d_docs_fields"], ["secret is not a field of the documents"])
+        self.assertEqual(search_serializer(d_docs_fields="title").validated_data["d_docs_fields"], ["title"])
+
+
+class SlowQueryLogTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "slow_queries.ndjson")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_slow_searches_are_always_logged(self):
+        log = SlowQueryLog(self.path, threshold_ms=100, sample_rate=0)
+        log.log({"signature": "a"}, 150)
+        log.log({"signature": "b"}, 50)
+        self.assertEqual([(record["signature"], record["weight"], record["slow"]) for record in self.records()],
+                         [("a", 1, True)])
+
+    def test_sampled_fast_searches_are_not_slow(self):
+        # with every search sampled the weight of the fast ones is 1 as well.
+        log = SlowQueryLog(self.path, threshold_ms=100, sample_rate=1)
+        log.log({"signature": "fast"}, 50)
+        log.log({"signature": "slow"}, 100)
+        self.assertEqual([(record["signature"], record["weight"], record["slow"]) for record in self.records()],
+                         [("fast", 1.0, False), ("slow", 1, True)])
+
+
+class TimeGapTest(SimpleTestCase):
+
+    def test_snap_to_gap(self):
+        date = datetime.datetime(2016, 5, 17, 13, 45)
+        self.assertEqual(utils.snap_to_gap(date, "+1DAYS"), datetime.datetime(2016, 5, 17))
+        self.assertEqual(utils.snap_to_gap(date, "+1DAYS", ceil=True), datetime.datetime(2016, 5, 18))
+        self.assertEqual(utils.snap_to_gap(date, "+6HOURS"), datetime.datetime(2016, 5, 17, 12))
+        self.assertEqual(utils.snap_to_gap(date, "+7DAYS"), datetime.datetime(2016, 5, 16))  # a monday
+        self.assertEqual(utils.snap_to_gap(date, "+3MONTHS"), datetime.datetime(2016, 4, 1))
+        self.assertEqual(utils.snap_to_gap(date, "+10YEARS", ceil=True), datetime.datetime(2020, 1, 1))
+
+    def test_snap_to_gap_keeps_bucket_starts(self):
+        date = datetime.datetime(2016, 1, 1)
+        self.assertEqual(utils.snap_to_gap(date, "+1YEARS", ceil=True), date)
+
+    def test_snap_to_gap_past_the_last_date(self):
+        date = datetime.datetime(9999, 1, 1, 12)
+        self.assertEqual(utils.snap_to_gap(date, "+1DAYS", ceil=True), datetime.datetime(9999, 1, 2))
+        self.assertEqual(utils.snap_to_gap(date, "+5YEARS", ceil=True), datetime.datetime.max)
+        self.assertEqual(utils.snap_to_gap(date, "+7DAYS", ceil=True), datetime.datetime(9999, 1, 4))
+
+    def test_compute_gap_finest_natural_gap(self):
+        start = datetime.datetime(2016, 1, 1)
+        self.assertEqual(utils.compute_gap(start, datetime.datetime(2016, 1, 2), 100), "+15MINUTES")
+        self.assertEqual(utils.compute_gap(start, datetime.datetime(2016, 1, 2), 24), "+1HOURS")
+        self.assertEqual(utils.compute_gap(start, datetime.datetime(2017, 1, 1), 12), "+1MONTHS")
+        self.assertEqual(utils.compute_gap(start, datetime.datetime(2017, 1, 1), 5), "+3MONTHS")
+
+    def test_compute_gap_whole_date_range(self):
+        gap = utils.compute_gap(datetime.datetime(1, 1, 1), datetime.datetime(9999, 1, 1), 5)
+        self.assertEqual(gap, "+2000YEARS")
+
+    def test_search_over_the_whole_date_range(self):
+        serializer = SearchSerializer(data={"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT,
+                                            "q_time": "[0001-01-01 TO 9999-01-01]", "a_time_limit": 5})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        query = serializer.validated_data["query"]
+        self.assertEqual(query.a_time, (datetime.datetime(1, 1, 1), datetime.datetime.max))
+        self.assertEqual(query.a_time_gap, "+2000YEARS")
+
+
+def es_seconds(duration):
+    return int(duration.lstrip("+")[:-1]) * {"d": 86400, "h": 3600, "m": 60, "s": 1}[duration[-1]]
+
+
+def es_bucket_start(date, interval):
+    """
+    The key of the elasticsearch date_histogram bucket holding date.
+    """
+    calendar = interval.get("calendar_interval")
+    if calendar:
+        months = {"1M": 1, "1q": 3, "1y": 12}[calendar]
+        elapsed = date.year * 12 + date.month - 1
+        elapsed -= elapsed % months
+        return datetime.datetime(elapsed // 12, elapsed % 12 + 1, 1)
+    seconds = es_seconds(interval["fixed_interval"])
+    offset = es_seconds(interval.get("offset", "0s"))
+    elapsed = int((date - utils.EPOCH).total_seconds()) - offset
+    return utils.EPOCH + datetime.timedelta(seconds=elapsed - elapsed % seconds + offset)
+
+
+class ElasticsearchGapTest(SimpleTestCase):
+
+    def assertSameBuckets(self, **params):
+        query = search_serializer(search_engine="elasticsearch", search_engine_endpoint=ES_ENDPOINT,
+                                  **params).validated_data["query"]
+        (start, end), gap = query.a_time, query.a_time_gap
+        interval = utils.gap_to_elasticsearch(gap, start)
+        step = utils.solr_gap_delta(gap)
+        solr_starts = []
+        while start < end:
+            solr_starts.append(start)
+            start += step
+        self.assertEqual([es_bucket_start(date, interval) for date in solr_starts], solr_starts)
+        return gap
+
+    def test_planned_gaps_bucket_like_solr(self):
+        for q_time, a_time_limit, expected_gap in [("[2016-01-01T05:00:00 TO 2016-01-03T07:00:00]", 10, "+6HOURS"),
+                                                   ("[2016-01-01 TO 2016-03-01]", 10, "+7DAYS"),
+                                                   ("[2015-12-20 TO 2016-12-01]", 12, "+1MONTHS"),
+                                                   ("[2015-12-20 TO 2016-12-01]", 5, "+3MONTHS"),
+                                                   ("[2010-06-01 TO 2016-02-01]", 10, "+1YEARS")]:
+            self.assertEqual(self.assertSameBuckets(q_time=q_time, a_time_limit=a_time_limit), expected_gap)
+
+    def test_given_gap_and_start_bucket_like_solr(self):
+        # a wednesday start, the weeks of solr start on wednesdays too.
+        self.assertSameBuckets(a_time_filter="[2016-05-04T10:00:00 TO 2016-06-01T00:00:00]", a_time_gap="P1W",
+                               a_time_limit=100)
+        self.assertSameBuckets(a_time_filter="[2016-05-04T10:20:00 TO 2016-05-05T00:00:00]", a_time_gap="PT90M",
+                               a_time_limit=100)
+
+    def test_week_interval_is_offset_to_monday(self):
+        self.assertEqual(utils.gap_to_elasticsearch("+7DAYS", datetime.datetime(2016, 5, 16)),
+                         {"fixed_interval": "7d", "offset": "+4d"})
+        self.assertEqual(utils.gap_to_elasticsearch("+1DAYS", datetime.datetime(2016, 5, 16)),
+                         {"fixed_interval": "1d"})
+
+    def test_planner_picks_gaps_elasticsearch_counts(self):
+        self.assertEqual(utils.compute_gap(datetime.datetime(2000, 1, 1), datetime.datetime(2016, 1, 1), 10),
+                         "+2YEARS")
+        self.assertEqual(self.assertSameBuckets(q_time="[2000-01-01 TO 2016-01-01]", a_time_limit=10), "+1YEARS")
+        self.assertEqual(self.assertSameBuckets(q_time="[2016-01-01 TO 2018-01-01]", a_time_limit=5), "+1YEARS")
+        self.assertEqual(self.assertSameBuckets(q_time="[0001-01-01 TO 9999-01-01]", a_time_limit=5), "+1YEARS")
+
+    def test_federated_search_with_an_elasticsearch_shard(self):
+        query = search_serializer(q_time="[2000-01-01 TO 2016-01-01]", a_time_limit=10,
+                                  search_engine_shards=["elasticsearch:" + ES_ENDPOINT]).validated_data["query"]
+        self.assertEqual(query.a_time_gap, "+1YEARS")
+
+    def test_gaps_elasticsearch_cannot_count_are_rejected(self):
+        for params in [{"a_time_gap": "P6M"}, {"a_time_gap": "P2Y"},
+                       {"a_time_gap": "P1M", "a_time_filter": "[2016-05-15 TO 2016-09-01]"}]:
+            serializer = SearchSerializer(data=dict({"search_engine": "elasticsearch",
+                                                     "search_engine_endpoint": ES_ENDPOINT, "a_time_limit": 100},
+                                                    **params))
+            self.assertFalse(serializer.is_valid())
+            self.assertIn("a_time_gap", serializer.errors)
+        self.assertEqual(search_serializer(a_time_gap="P6M", a_time_limit=100).validated_data["query"].a_time_gap,
+                         "+6MONTHS")
+
+
+class FederatedSortTest(SimpleTestCase):
+
+    def setUp(self):
+        self.search_shard = views.search_shard
+        self.shards = {}
+
+        def search_shard(search_engine, validated_data):
+            self.shards[validated_data["search_engine_endpoint"]] = validated_data
+            docs = {
+                SOLR_ENDPOINT: [{"id": "s1", "score": 9.0}, {"id": "s2", "score": 2.0}],
+                ES_ENDPOINT: [{"_id": "e1", "_score": 5.0}, {"_id": "e2", "_score": 4.0}],
+            }[validated_data["search_engine_endpoint"]]
+            return {"a.matchDocs": len(docs), "d.docs": docs}, None, 0.01
+        views.search_shard = search_shard
+
+    def tearDown(self):
+        views.search_shard = self.search_shard
+
+    def test_score_sort_merges_on_the_shard_scores(self):
+        serializer = search_serializer(q_text="lake", d_docs_limit=3, d_docs_sort="score",
+                                       search_engine_shards=["elasticsearch:" + ES_ENDPOINT])
+        data = views.federated(serializer)
+        self.assertEqual([doc.get("id", doc.get("_id")) for doc in data["d.docs"]], ["s1", "e1", "e2"])
+        self.assertEqual(data["a.matchDocs"], 4)
+
+    def test_score_sort_asks_solr_for_the_score(self):
+        views.federated(search_serializer(q_text="lake", d_docs_sort="score", d_docs_fields="title",
+                                          search_engine_shards=["elasticsearch:" + ES_ENDPOINT]))
+        params = views.solr_params(self.shards[SOLR_ENDPOINT])
+        self.assertEqual(params["fl"], "id,title,score")
+        self.assertEqual(views.solr_params(dict(self.shards[SOLR_ENDPOINT], d_docs_fields=None))["fl"], "*,score")
+
+    def test_single_engine_searches_keep_their_fields(self):
+        self.assertNotIn("fl", views.solr_params(search_serializer(q_text="lake").validated_data))
+
+
+class IndexChangesTest(SimpleTestCase):
+
+    def setUp(self):
+        from django.core.cache import caches
+        caches["default"].clear()
+        self.received = []
+        search_index_changed.connect(self.receive, dispatch_uid="api.tests")
+
+    def tearDown(self):
+        search_index_changed.disconnect(dispatch_uid="api.tests")
+
+    def receive(self, sender, endpoint=None, since=None, **kwargs):
+        self.received.append((endpoint, since))
+
+    def test_other_processes_receive_the_published_changes(self):
+        # two instances on the same cache stand for two processes.
+        reindex, worker = IndexChanges(poll_seconds=0), IndexChanges(poll_seconds=0)
+        worker.poll()
+        since = datetime.datetime(2016, 5, 1)
+        reindex.publish(SOLR_ENDPOINT, since)
+        reindex.publish()
+        self.assertEqual(self.received, [(SOLR_ENDPOINT, since), (None, None)])
+        del self.received[:]
+        worker.poll()
+        self.assertEqual(self.received, [(SOLR_ENDPOINT, since), (None, None)])
+        del self.received[:]
+        worker.poll()
+        self.assertEqual(self.received, [])
+
+    def test_first_poll_skips_older_changes(self):
+        IndexChanges().publish(SOLR_ENDPOINT)
+        del self.received[:]
+        IndexChanges(poll_seconds=0).poll()
+        self.assertEqual(self.received, [])
+
+    def test_polls_are_throttled(self):
+        reindex, worker = IndexChanges(), IndexChanges(poll_seconds=3600)
+        worker.poll()
+        reindex.publish(SOLR_ENDPOINT)
+        del self.received[:]
+        worker.poll()
+        self.assertEqual(self.received, [])
+
+    def test_async_server_polls_on_the_executor(self):
+        reindex, worker = IndexChanges(), IndexChanges(poll_seconds=0.05)
+        worker.poll()
+        changes, signals._changes = signals._changes, worker
+        loop = IOLoop()
+        try:
+            loop.make_current()
+            timer = async_search.poll_index_changes()
+            reindex.publish(SOLR_ENDPOINT)
+            del self.received[:]
+            worker.poll()  # the loop thread leaves it to the timer.
+            self.assertEqual(self.received, [])
+            loop.run_sync(lambda: gen.sleep(0.3))
+            timer.stop()
+        finally:
+            signals._changes = changes
+            IOLoop.clear_current()
+            loop.close()
+        self.assertEqual(self.received, [(SOLR_ENDPOINT, None)])
+
+    def test_management_command_publishes(self):
+        call_command("search_index_changed", endpoint=SOLR_ENDPOINT, since="2016-05-01T00:00:00Z",
+                     stdout=open(os.devnull, "w"))
+        self.assertEqual(self.received, [(SOLR_ENDPOINT, datetime.datetime(2016, 5, 1))])
+
+    def test_time_cache_invalidation(self):
+        cache = TimeHistogramCache()
+        days = [datetime.datetime(2016, 4, 29) + datetime.timedelta(days=day) for day in range(4)]
+        for endpoint in (SOLR_ENDPOINT, ES_ENDPOINT):
+            cache.set((endpoint,), "+1DAYS", [(day, 10) for day in days])
+        cache.invalidate(SOLR_ENDPOINT, since=datetime.datetime(2016, 5, 1))
+        self.assertEqual(cache.get((SOLR_ENDPOINT,), "+1DAYS", days), [10, 10])
+        self.assertEqual(cache.get((ES_ENDPOINT,), "+1DAYS", days), [10, 10, 10, 10])
+        cache.invalidate()
+        self.assertEqual(cache.get((ES_ENDPOINT,), "+1DAYS", days), [])
+
+
+class ExportTest(SimpleTestCase):
+
+    def export_data(self, **params):
+        serializer = ExportSerializer(data=dict({"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT},
+                                                **params))
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def test_csv_keeps_fields_missing_from_the_first_doc(self):
+        docs = [{"id": "1", "title": "a"}, {"id": "2", "title": "b", "abstract": u"caf\xe9"}]
+        self.assertEqual("".join(csv_rows(docs, ["id", "title", "abstract"])),
+                         "id,title,abstract\r\n1,a,\r\n2,b,caf\xc3\xa9\r\n")
+
+    def test_csv_header_without_docs(self):
+        self.assertEqual(list(csv_rows([], ["id"])), ["id\r\n"])
+
+    def test_export_fields(self):
+        self.assertEqual(views.export_fields(self.export_data()), views.DEFAULT_EXPORT_FIELDS["solr"])
+        self.assertEqual(views.export_fields(self.export_data(d_docs_fields="title,abstract")),
+                         ["id", "title", "abstract"])
+        self.assertEqual(views.export_fields(self.export_data(search_engine="elasticsearch",
+                                                              search_engine_endpoint=ES_ENDPOINT,
+                                                              d_docs_fields="title")), ["_id", "title"])
+        with self.assertRaises(ValidationError):
+            self.export_data(d_docs_fields="title,{!func}x")
+
+
+class SingleFlightTest(SimpleTestCase):
+
+    def test_concurrent_calls_share_the_leader_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return {"numFound": 1}
+
+        threads = [threading.Thread(target=lambda: results.append(flights.do("key", fetch))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()["waiters"] < 2:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for result, shared in results), [False, True, True])
+        self.assertTrue(all(result is results[0][0] for result, shared in results))
+        self.assertEqual(flights.stats()["in_flight"], 0)
+
+    def test_duplicate_waits_until_its_own_deadline(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=lambda: flights.do("key", lambda: release.wait(5)))
+        leader.start()
+        while flights.stats()["in_flight"] < 1:
+            release.wait(0.01)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                flights.do("key", lambda: None, Deadline(50))
+        finally:
+            release.set()
+            leader.join()
+
+    def test_async_duplicate_waits_until_its_own_deadline(self):
+        params = {"q": "*:*"}
+        key = async_search.upstream_url(SOLR_ENDPOINT, sorted(params.items()))
+        async_search._flights[key] = Future()
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                IOLoop().run_sync(lambda: async_search.fetch_json(SOLR_ENDPOINT, params, deadline=Deadline(50)))
+        finally:
+            del async_search._flights[key]
+
+    def test_errors_reach_every_caller_and_are_not_kept(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError("down")
+
+        with self.assertRaises(ValueError):
+            flights.do("key", fail)
+        self.assertEqual(flights.do("key", lambda: 1), (1, False))
+
+
+class FakeResponse(object):
+    url = SOLR_ENDPOINT + "?q=*:*"
+    elapsed = datetime.timedelta(milliseconds=5)
+
+
+class SharedResponseTest(SimpleTestCase):
+
+    def setUp(self):
+        self.fetch_json = views.fetch_json
+        self.solr_response = {"responseHeader": {"QTime": 3}, "response": {"numFound": 2, "docs": [{"id": "1"}]}}
+        views.fetch_json = lambda endpoint, params=None, json_body=None, deadline=None: \
+            (FakeResponse(), self.solr_response, True)
+
+    def tearDown(self):
+        views.fetch_json = self.fetch_json
+
+    def test_solr_leaves_the_shared_response_alone(self):
+        data = views.solr(search_serializer(d_docs_limit=1))
+        self.assertEqual(data["a.matchDocs"], 2)
+        self.assertNotIn("solr_request", self.solr_response)
+
+    def test_original_response_carries_the_request(self):
+        data = views.solr(search_serializer(return_search_engine_original_response=1))
+        self.assertEqual(data["solr_request"], FakeResponse.url)
+        self.assertNotIn("solr_request", self.solr_response)
+
+
+class StagesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = metrics.clock
+        self.now = [0.0]
+        metrics.clock = lambda: self.now[0]
+        metrics._local.stages = metrics.Stages()
+
+    def tearDown(self):
+        metrics.clock = self.clock
+        metrics._local.stages = None
+
+    def test_nested_stage_is_not_counted_in_the_outer_one(self):
+        with metrics.stage("upstream"):
+            self.now[0] += 0.030
+            with metrics.stage("decode"):
+                self.now[0] += 0.010
+        durations = metrics._local.stages.durations
+        self.assertAlmostEqual(durations["upstream"], 0.030)
+        self.assertAlmostEqual(durations["decode"], 0.010)
+
+
+class FakeTime(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class ResponseCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.time = cache.time
+        cache.time = FakeTime()
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def test_equivalent_queries_share_a_key(self):
+        self.assertEqual(cache.cache_key(search_serializer(q_text="*:*", d_docs_limit=10)),
+                         cache.cache_key(search_serializer(d_docs_limit=10, q_text="*:*", deadline_ms=500)))
+        self.assertNotEqual(cache.cache_key(search_serializer(d_docs_limit=10)),
+                            cache.cache_key(search_serializer(d_docs_limit=11)))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        backend = cache.LocalBackend(max_entries=2)
+        backend.set("a", 1, 60, 1)
+        backend.set("b", 2, 60, 1)
+        backend.get("a")
+        backend.set("c", 3, 60, 1)
+        self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), (1, None, 3))
+        self.assertEqual(backend.stats(), {"entries": 2, "bytes": 2, "evictions": 1})
+
+    def test_bytes_bound_evicts_and_skips_oversized_entries(self):
+        backend = cache.LocalBackend(max_bytes=10)
+        backend.set("a", 1, 60, 6)
+        backend.set("b", 2, 60, 6)
+        backend.set("huge", 3, 60, 11)
+        self.assertEqual((backend.get("a"), backend.get("b"), backend.get("huge")), (None, 2, None))
+        self.assertEqual(backend.stats()["bytes"], 6)
+
+    def test_expired_entry_is_dropped(self):
+        backend = cache.LocalBackend()
+        backend.set("a", 1, 60, 5)
+        cache.time.now += 61
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual(backend.stats(), {"entries": 0, "bytes": 0, "evictions": 0})
+
+    def test_engine_without_ttl_is_not_cached(self):
+        responses = cache.ResponseCache(cache.LocalBackend(), ttl={"solr": 60})
+        responses.set("solr", "solr", {"a.matchDocs": 1})
+        responses.set("es", "elasticsearch", {"a.matchDocs": 1})
+        self.assertEqual(responses.get("solr"), {"a.matchDocs": 1})
+        self.assertIsNone(responses.get("es"))
+        self.assertEqual((responses.stats()["hits"], responses.stats()["misses"]), (1, 1))
+
+
+class FederationMergeTest(SimpleTestCase):
+
+    def test_counts_are_summed_and_cut_to_the_top(self):
+        merged = federation.merge_counts([["bob", 3, "al", 2], ["al", 4, "eve", 1]], limit=2)
+        self.assertEqual(merged, ["al", 6, "bob", 3])
+
+    def test_time_buckets_are_summed_in_time_order(self):
+        merged = federation.merge_time([
+            {"start": "2000-01-01T00:00:00Z", "gap": "+1YEAR", "counts": ["2000-01-01T00:00:00Z", 1]},
+            {"start": "2000-01-01T00:00:00Z", "gap": "+1YEAR",
+             "counts": ["2001-01-01T00:00:00Z", 2, "2000-01-01T00:00:00Z", 3]},
+        ])
+        self.assertEqual(merged["gap"], "+1YEAR")
+        self.assertEqual(merged["counts"], ["2000-01-01T00:00:00Z", 4, "2001-01-01T00:00:00Z", 2])
+
+    def test_heatmaps_of_the_same_grid_are_added_cell_by_cell(self):
+        grid = ["gridLevel", 2, "columns", 2, "rows", 2, "minX", -180, "maxX", 180, "minY", -90, "maxY", 90]
+        other_grid = ["gridLevel", 3, "columns", 4, "rows", 2, "minX", -180, "maxX", 180, "minY", -90, "maxY", 90]
+        merged, skipped = federation.merge_heatmaps([
+            grid + ["counts_ints2D", [[1, 2], None]],
+            grid + ["counts_ints2D", [[1, 1], [0, 5]]],
+            grid + ["counts_ints2D", None],
+            other_grid + ["counts_ints2D", [[9, 9, 9, 9], None]],
+        ])
+        self.assertEqual(dict(federation.pairs(merged))["counts_ints2D"], [[2, 3], [0, 5]])
+        self.assertEqual(skipped, [other_grid + ["counts_ints2D", [[9, 9, 9, 9], None]]])
+
+    def test_docs_are_interleaved_without_sort_key(self):
+        merged = federation.merge_docs([[{"id": "a1"}, {"id": "a2"}, {"id": "a3"}], [{"id": "b1"}]], limit=3)
+        self.assertEqual([doc["id"] for doc in merged], ["a1", "b1", "a2"])
+
+    def test_docs_are_merge_sorted_by_sort_key(self):
+        merged = federation.merge_docs([[{"id": "a", "score": 3.0}, {"id": "b", "score": 1.0}],
+                                        [{"id": "c", "score": 2.0}]],
+                                       sort_key=lambda doc: doc["score"], reverse=True)
+        self.assertEqual([doc["id"] for doc in merged], ["a", "c", "b"])
+
+
+def world_heatmap(level, cell):
+    """
+    A solr heatmap of the whole world whose cell counts are their row major positions.
+    """
+    columns, rows = int(360 / cell), int(180 / cell)
+    return solr_heatmap(level, (cell, cell), (0, 0, columns, rows), numpy.arange(rows * columns).reshape(rows, columns))
+
+
+class HeatmapPlanTest(SimpleTestCase):
+    filters = (("solr", "bbox"), "q_text:*")
+
+    def heatmap_params(self, **params):
+        return dict({"facet.heatmap": "bbox", "facet.heatmap.geom": "[-10,-10 TO 40,80]"}, **params)
+
+    def test_learned_level_is_answered_from_the_cache(self):
+        cache = HeatmapCache(align=4)
+        params = self.heatmap_params(**{"facet.heatmap.distErr": "5.0"})
+        plan = HeatmapPlan(cache, self.filters, params)
+        self.assertFalse(plan.hit)
+        self.assertEqual(params["facet.heatmap.distErr"], "5.0")
+        plan.resolve(world_heatmap(2, 45.0))
+
+        params = self.heatmap_params(**{"facet.heatmap.distErr": "5.0"})
+        plan = HeatmapPlan(cache, self.filters, params)
+        self.assertTrue(plan.hit)
+        self.assertFalse(any(name.startswith("facet.heatmap") for name in params))
+        heatmap = dict(federation.pairs(plan.resolve(None)))
+        # cells 3 to 6 of rows 1 and 2 of the 8 x 4 world grid.
+        self.assertEqual((heatmap["minX"], heatmap["maxX"], heatmap["minY"], heatmap["maxY"]), (-45.0, 90.0, -45.0, 45.0))
+        self.assertEqual(heatmap["counts_ints2D"], [[11, 12, 13], [19, 20, 21]])
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_coarser_level_is_summed_from_a_finer_block(self):
+        cache = HeatmapCache()
+        cache.learn(self.filters[0], world_heatmap(2, 45.0))
+        cache.learn(self.filters[0], world_heatmap(3, 22.5))
+        cache.store(self.filters, world_heatmap(3, 22.5))
+        params = self.heatmap_params(**{"facet.heatmap.gridLevel": 2, "facet.heatmap.geom": "[46,-179 TO 89,-136]"})
+        heatmap = dict(federation.pairs(HeatmapPlan(cache, self.filters, params).resolve(None)))
+        self.assertEqual(heatmap["counts_ints2D"], [[0 + 1 + 16 + 17]])
+
+    def test_miss_fetches_the_aligned_region_of_the_known_level(self):
+        cache = HeatmapCache(align=4)
+        cache.learn(self.filters[0], world_heatmap(2, 45.0), 5.0)
+        params = self.heatmap_params(**{"facet.heatmap.distErr": "5.0"})
+        plan = HeatmapPlan(cache, self.filters, params)
+        self.assertFalse(plan.hit)
+        self.assertEqual(params["facet.heatmap.gridLevel"], 2)
+        self.assertNotIn("facet.heatmap.distErr", params)
+        self.assertEqual(utils.parse_lat_lon_box(params["facet.heatmap.geom"]), (-78.75, -168.75, 78.75, 168.75))
+
+
+class TimeHistogramPlanTest(SimpleTestCase):
+    filters = (SOLR_ENDPOINT, "q_text:*")
+    now = datetime.datetime(2016, 5, 3, 12)
+
+    def time_params(self, end="2016-05-04T00:00:00Z"):
+        return {"facet.range": "layer_date", "f.layer_date.facet.range.start": "2016-05-01T00:00:00Z",
+                "f.layer_date.facet.range.end": end, "f.layer_date.facet.range.gap": "+1DAYS"}
+
+    def test_closed_buckets_are_cached_and_the_open_one_fetched(self):
+        cache = TimeHistogramCache()
+        params = self.time_params()
+        plan = TimeHistogramPlan(cache, self.filters, params, now=self.now)
+        self.assertFalse(plan.hit)
+        self.assertEqual(params, self.time_params())
+        plan.resolve({"end": "2016-05-04T00:00:00Z", "counts": [
+            "2016-05-01T00:00:00Z", 1, "2016-05-02T00:00:00Z", 2, "2016-05-03T00:00:00Z", 3]})
+
+        params = self.time_params()
+        plan = TimeHistogramPlan(cache, self.filters, params, now=self.now)
+        self.assertFalse(plan.hit)
+        self.assertEqual(params["f.layer_date.facet.range.start"], "2016-05-03T00:00:00Z")
+        date_facet = plan.resolve({"end": "2016-05-04T00:00:00Z", "counts": ["2016-05-03T00:00:00Z", 4]})
+        self.assertEqual(date_facet["start"], "2016-05-01T00:00:00Z")
+        self.assertEqual(date_facet["counts"], [
+            "2016-05-01T00:00:00Z", 1, "2016-05-02T00:00:00Z", 2, "2016-05-03T00:00:00Z", 4])
+
+    def test_range_of_closed_buckets_is_a_hit(self):
+        cache = TimeHistogramCache()
+        cache.set(self.filters, "+1DAYS", [(datetime.datetime(2016, 5, 1), 1), (datetime.datetime(2016, 5, 2), 2)])
+        params = self.time_params(end="2016-05-03T00:00:00Z")
+        plan = TimeHistogramPlan(cache, self.filters, params, now=self.now)
+        self.assertTrue(plan.hit)
+        self.assertEqual(params, {})
+        self.assertEqual(plan.resolve(None), {"start": "2016-05-01T00:00:00Z", "end": "2016-05-03T00:00:00Z",
+                                              "gap": "+1DAYS",
+                                              "counts": ["2016-05-01T00:00:00Z", 1, "2016-05-02T00:00:00Z", 2]})
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = replicas.clock
+        self.now = [0.0]
+        replicas.clock = lambda: self.now[0]
+
+    def tearDown(self):
+        replicas.clock = self.clock
+
+    def test_opens_on_errors_then_closes_after_a_good_trial(self):
+        breaker = replicas.CircuitBreaker(window=4, min_requests=4, error_ratio=0.5, open_seconds=10)
+        for ok in (True, False, True):
+            breaker.record(0.01, ok)
+        self.assertEqual(breaker.state, replicas.CLOSED)
+        breaker.record(3.0, True)  # slower than slow_ms counts as a failure.
+        self.assertEqual((breaker.state, breaker.opened), (replicas.OPEN, 1))
+        self.assertFalse(breaker.available())
+
+        self.now[0] += 10
+        self.assertEqual(breaker.state, replicas.HALF_OPEN)
+        breaker.begin()
+        self.assertFalse(breaker.available())  # a single trial at a time.
+        breaker.record(0.01, False)
+        self.assertEqual(breaker.state, replicas.OPEN)
+
+        self.now[0] += 10
+        breaker.begin()
+        breaker.record(0.01, True)
+        self.assertEqual((breaker.state, breaker.error_ratio_now()), (replicas.CLOSED, 0.0))
+
+
+class ReplicaSetTest(SimpleTestCase):
+
+    def setUp(self):
+        self.explore_ratio = replicas.EXPLORE_RATIO
+        replicas.EXPLORE_RATIO = 0
+
+    def tearDown(self):
+        replicas.EXPLORE_RATIO = self.explore_ratio
+
+    def test_failed_replica_is_failed_over(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_budget=0)
+
+        def send(endpoint):
+            if endpoint == "a":
+                raise IOError("connection refused")
+            return endpoint
+
+        self.assertEqual(replica_set.call(send), "b")
+        stats = replica_set.stats()
+        self.assertEqual(stats["failovers"], 1)
+        self.assertEqual([replica["errors"] for replica in stats["replicas"]], [1, 0])
+
+    def test_failover_to_a_last_replica_slower_than_the_hedge_delay(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_delay_ms=20)
+        slow = threading.Event()
+
+        def send(endpoint):
+            if endpoint == "a":
+                raise IOError("connection refused")
+            slow.wait(0.1)
+            return endpoint
+
+        self.assertEqual(replica_set.call(send), "b")
+        self.assertEqual((replica_set.stats()["failovers"], replica_set.stats()["hedges"]), (1, 0))
+
+    def test_async_failover_to_a_last_replica_slower_than_the_hedge_delay(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_delay_ms=20)
+
+        @gen.coroutine
+        def send(endpoint):
+            if endpoint == "a":
+                raise IOError("connection refused")
+            yield gen.sleep(0.1)
+            raise gen.Return(endpoint)
+
+        self.assertEqual(IOLoop().run_sync(lambda: async_search.fetch_replicas(replica_set, send)), "b")
+        self.assertEqual((replica_set.stats()["failovers"], replica_set.stats()["hedges"]), (1, 0))
+
+    def test_exceeded_deadline_is_not_failed_over(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_budget=0)
+        sent = []
+
+        def send(endpoint):
+            sent.append(endpoint)
+            raise DeadlineExceeded("Deadline of 10 ms exceeded by a")
+
+        with self.assertRaises(DeadlineExceeded):
+            replica_set.call(send)
+        self.assertEqual(sent, ["a"])
+
+    def test_slow_replica_is_hedged(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_delay_ms=10)
+        answered = threading.Event()
+
+        def send(endpoint):
+            if endpoint == "a":
+                answered.wait(5)
+            else:
+                answered.set()
+            return endpoint
+
+        self.assertEqual(replica_set.call(send), "b")
+        stats = replica_set.stats()
+        self.assertEqual(stats["hedges"], 1)
+        self.assertEqual([replica["hedges_won"] for replica in stats["replicas"]], [0, 1])
+
+    def test_no_hedges_without_budget(self):
+        replica_set = replicas.ReplicaSet(SOLR_ENDPOINT, ["a", "b"], hedge_delay_ms=1, hedge_budget=0)
+        slow = threading.Event()
+        self.assertEqual(replica_set.call(lambda endpoint: slow.wait(0.05) or endpoint), "a")
+        self.assertEqual(replica_set.stats()["hedges"], 0)
+
+
+class SessionPoolTest(SimpleTestCase):
+
+    def test_one_session_per_host(self):
+        pool = SessionPool()
+        session = pool.session_for(SOLR_ENDPOINT)
+        self.assertIs(pool.session_for("http://LOCALHOST:8983/solr/other/select"), session)
+        self.assertIsNot(pool.session_for(ES_ENDPOINT), session)
+        self.assertEqual(pool.stats(), {"hosts": 2, "hits": 1, "misses": 2})
+        pool.close()
+        self.assertEqual(pool.stats()["hosts"], 0)
+
+    def test_session_settings(self):
+        session = SessionPool(max_retries=3, keep_alive=False, compression=False).session_for(SOLR_ENDPOINT)
+        self.assertEqual(session.headers["Connection"], "close")
+        self.assertEqual(session.headers["Accept-Encoding"], "identity")
+        retries = session.get_adapter(SOLR_ENDPOINT).max_retries
+        self.assertIsInstance(retries, SearchRetry)
+        self.assertEqual(retries.total, 3)
+
+    def test_endpoint_host(self):
+        self.assertEqual(endpoint_host("https://Search.example.com:8443/solr/hypermap/select?q=*"),
+                         "https://search.example.com:8443")
+
+
+def fake_solr(params):
+    """
+    A solr response to params: 3 matching docs and a count for every facet asked for.
+    """
+    rows = int(params.get("rows", 0))
+    response = {"responseHeader": {"QTime": 1},
+                "response": {"numFound": 3, "docs": [{"id": str(number)} for number in range(min(rows, 3))]}}
+    if params.get("facet") != "on":
+        return response
+    facet_counts = {"facet_ranges": {}, "facet_heatmaps": {}, "facet_fields": {}}
+    range_field = params.get("facet.range")
+    if range_field:
+        prefix = "f.{0}.facet.range.".format(range_field)
+        facet_counts["facet_ranges"][range_field] = {
+            "start": params[prefix + "start"], "end": params[prefix + "end"], "gap": params[prefix + "gap"],
+            "counts": [params[prefix + "start"], 3]}
+    if params.get("facet.heatmap"):
+        facet_counts["facet_heatmaps"][params["facet.heatmap"]] = [
+            "gridLevel", 1, "columns", 2, "rows", 1, "minX", -180.0, "maxX", 180.0, "minY", -90.0, "maxY", 90.0,
+            "counts_ints2D", [[2, 1]]]
+    for facet_field in params.get("facet.field", []):
+        field = facet_field.split("}")[-1]
+        facet_counts["facet_fields"][field] = [field + "_value", 3]
+    response["facet_counts"] = facet_counts
+    return response
+
+
+class FakeSolrTestCase(SimpleTestCase):
+    """
+    Searches answered by fake_solr instead of the search engine, without the caches.
+    """
+
+    def setUp(self):
+        self.fetch_json = views.fetch_json
+        self.sent = []
+
+        def fetch_json(endpoint, params=None, json_body=None, deadline=None):
+            self.sent.append(params)
+            return FakeResponse(), fake_solr(params), False
+
+        views.fetch_json = fetch_json
+        self.settings = override_settings(SEARCH_TIME_CACHE={"ENABLED": False},
+                                          SEARCH_HEATMAP_CACHE={"ENABLED": False},
+                                          SEARCH_RESPONSE_CACHE={"ENABLED": False},
+                                          SEARCH_SLOW_QUERY_LOG={"ENABLED": False})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        views.fetch_json = self.fetch_json
+
+
+FACETED = {"q_time": "[2016-01-01 TO 2016-01-04]", "d_docs_limit": 2, "a_time_limit": 3, "a_hm_limit": 100,
+           "a_text_limit": 5, "a_user_limit": 5}
+
+
+class ParallelFacetsTest(FakeSolrTestCase):
+
+    def test_sub_requests_split_the_facets(self):
+        params = views.solr_params(search_serializer(**FACETED).validated_data)
+        sub_requests = dict(utils.split_facet_params(params))
+        self.assertEqual(sorted(sub_requests), ["docs", "facet.field.layer_originator", "facet.field.title",
+                                                "facet.heatmap.bbox", "facet.range.layer_date"])
+        self.assertFalse([name for name in sub_requests["docs"] if name.startswith(("facet", "f."))])
+        self.assertEqual(sub_requests["docs"]["rows"], 2)
+        self.assertEqual(sub_requests["facet.field.title"]["rows"], 0)
+        self.assertEqual(sub_requests["facet.field.title"]["f.title.facet.limit"], 5)
+        self.assertNotIn("f.title.facet.limit", sub_requests["facet.field.layer_originator"])
+
+    def test_parallel_search_answers_like_the_serial_one(self):
+        serial = views.solr(search_serializer(parallel_facets=0, **FACETED))
+        self.assertEqual(len(self.sent), 1)
+        parallel = views.solr(search_serializer(parallel_facets=1, **FACETED))
+        self.assertEqual(len(self.sent), 6)
+        for data in (serial, parallel):
+            data.pop("timing")
+        self.assertTrue(set(["a.time", "a.hm", "a.user", "a.text", "d.docs"]) <= set(serial))
+        self.assertEqual(parallel, serial)
+
+    def test_partial_sub_response_makes_the_merged_one_partial(self):
+        merged = views.merge_solr_responses([{"responseHeader": {"QTime": 1}, "response": {"numFound": 3}},
+                                             {"responseHeader": {"partialResults": True},
+                                              "facet_counts": {"facet_fields": {"title": ["a", 1]}}}])
+        self.assertTrue(merged["responseHeader"]["partialResults"])
+        self.assertEqual(merged["facet_counts"], {"facet_fields": {"title": ["a", 1]}})
+
+
+class BatchTest(FakeSolrTestCase):
+
+    def post(self, items):
+        return self.client.post("/api/search/batch/", json.dumps(items), content_type="application/json")
+
+    def test_items_are_answered_in_order_with_their_status(self):
+        response = self.post([
+            {"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT, "d_docs_limit": 1},
+            {"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT, "a_time_gap": "P1X"},
+            {"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT, "a_text_limit": 5},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)
+        self.assertEqual([result["status"] for result in results], [200, 400, 200])
+        self.assertEqual(results[0]["data"]["d.docs"], [{"id": "0"}])
+        self.assertIn("a_time_gap", results[1]["errors"])
+        self.assertEqual(results[2]["data"]["a.text"], ["title_value", 3])
+
+    def test_failed_search_is_a_502_item(self):
+        views.fetch_json = lambda *args, **kwargs: 1 / 0
+        results = json.loads(self.post([{"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT}]).content)
+        self.assertEqual(results[0], {"status": 502, "errors": {"search_engine": ["ZeroDivisionError: integer "
+                                                                                 "division or modulo by zero"]}})
+
+    @override_settings(SEARCH_BATCH_MAX_ITEMS=1)
+    def test_body_must_be_a_bounded_array(self):
+        self.assertEqual(self.post({"search_engine": "solr"}).status_code, 400)
+        item = {"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT}
+        self.assertEqual(self.post([item, item]).status_code, 400)
+        self.assertEqual(self.post([]).content, b"[]")
+
+
+class FakeRaw(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self, chunk_size, decode_content=True):
+        for start in range(0, len(self.content), 4):
+            yield self.content[start:start + 4]
+
+
+class FakeStreamedResponse(object):
+
+    def __init__(self, url, content):
+        self.url = url
+        self.status_code = 200
+        self.headers = {"Content-Type": "application/json; charset=UTF-8", "Content-Encoding": "gzip",
+                        "Content-Length": str(len(content))}
+        self.raw = FakeRaw(content)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+    timeout = (3.05, 60)
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        self.response = FakeStreamedResponse(url + "?q=*:*", self.content)
+        return self.response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class PassthroughTest(SimpleTestCase):
+
+    def setUp(self):
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+            f.write(b'{"response": {"numFound": 2, "docs": []}}')
+        self.pool = FakePool(compressed.getvalue())
+        self.get_pool = views.get_pool
+        views.get_pool = lambda: self.pool
+        self.settings = override_settings(SEARCH_SLOW_QUERY_LOG={"ENABLED": False})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        views.get_pool = self.get_pool
+
+    def search(self, **params):
+        return self.client.get("/api/search/", dict(params, return_search_engine_original_response=1),
+                               HTTP_ACCEPT_ENCODING="gzip")
+
+    def test_solr_response_is_streamed_still_compressed(self):
+        response = self.search(search_engine="solr", search_engine_endpoint=SOLR_ENDPOINT, d_docs_limit=2)
+        self.assertEqual(b"".join(response.streaming_content), self.pool.content)
+        self.assertTrue(self.pool.response.closed)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Content-Length"], str(len(self.pool.content)))
+        self.assertEqual(response["X-Search-Engine-Request"], SOLR_ENDPOINT + "?q=*:*")
+        method, url, kwargs = self.pool.requests[0]
+        self.assertEqual((method, url), ("GET", SOLR_ENDPOINT))
+        self.assertEqual(kwargs["headers"], {"Accept-Encoding": "gzip"})
+        self.assertTrue(kwargs["stream"])
+        self.assertEqual(kwargs["params"]["rows"], 2)
+
+    def test_elasticsearch_body_is_posted(self):
+        response = self.search(search_engine="elasticsearch", search_engine_endpoint=ES_ENDPOINT, d_docs_limit=2)
+        self.assertEqual(b"".join(response.streaming_content), self.pool.content)
+        method, url, kwargs = self.pool.requests[0]
+        self.assertEqual((method, url), ("POST", ES_ENDPOINT))
+        self.assertEqual(kwargs["json"]["size"], 2)
+
+
+class CompiledQueryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.query = CompiledQuery(q_time=(datetime.datetime(2016, 1, 1), None), q_geo=(-10.0, -20.0, 10.0, 20.0))
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.query.q_geo = None
+        with self.assertRaises(AttributeError):
+            del self.query.q_time
+        self.assertEqual(self.query.q_geo, (-10.0, -20.0, 10.0, 20.0))
+
+    def test_replace_returns_a_changed_copy(self):
+        changed = self.query.replace(q_geo=None)
+        self.assertIsNone(changed.q_geo)
+        self.assertEqual(changed.q_time, self.query.q_time)
+        self.assertEqual(self.query.q_geo, (-10.0, -20.0, 10.0, 20.0))
+        self.assertNotEqual(changed, self.query)
+
+    def test_equal_queries_hash_alike(self):
+        same = CompiledQuery(q_time=(datetime.datetime(2016, 1, 1), None), q_geo=(-10.0, -20.0, 10.0, 20.0))
+        self.assertEqual(same, self.query)
+        self.assertEqual(hash(same), hash(self.query))
+        self.assertEqual(len({same, self.query}), 1)
+
+    def test_pickles(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.query, pickle.HIGHEST_PROTOCOL)), self.query)
+
+    def test_defaulted_time_facet_is_on_the_gap_grid(self):
+        now = datetime.datetime(2016, 5, 17, 12, 30)
+        self.assertEqual(resolve_time_facet(None, None, 90, now=now),
+                         ((datetime.datetime(2016, 2, 15), datetime.datetime(2016, 5, 23)), "+7DAYS"))
+        self.assertEqual(resolve_time_facet(None, None, 90, now=now + datetime.timedelta(hours=1)),
+                         resolve_time_facet(None, None, 90, now=now))
+
+    def test_given_gap_keeps_the_given_start(self):
+        now = datetime.datetime(2016, 5, 17, 12, 30)
+        time_range = (datetime.datetime(2016, 5, 4, 10), None)
+        self.assertEqual(resolve_time_facet(time_range, utils.parse_ISO8601("P1W"), 100, now=now),
+                         ((datetime.datetime(2016, 5, 4, 10), datetime.datetime(2016, 5, 23)), "+7DAYS"))
+
+    def test_time_buckets_are_calendar_aware(self):
+        self.assertEqual(time_buckets(datetime.datetime(2016, 1, 31), datetime.datetime(2016, 4, 1),
+                                      utils.parse_ISO8601("P1M")),
+                         ((datetime.datetime(2016, 1, 31), datetime.datetime(2016, 2, 29)),
+                          (datetime.datetime(2016, 2, 29), datetime.datetime(2016, 3, 31)),
+                          (datetime.datetime(2016, 3, 31), datetime.datetime(2016, 4, 1))))
+
+    def test_time_buckets_stop_after_max_buckets(self):
+        buckets = time_buckets(datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 10),
+                               utils.parse_ISO8601("P1D"), 3)
+        self.assertEqual(len(buckets), 4)
+
+    def test_compile_query(self):
+        q_time = (datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 3))
+        query = compile_query(q_time=q_time, a_time_limit=2, a_hm_limit=10)
+        self.assertEqual(query, CompiledQuery(q_time=q_time, a_time=q_time, a_time_gap="+1DAYS",
+                                              a_hm=(-90.0, -180.0, 90.0, 180.0)))
+        self.assertEqual(compile_query(q_time=q_time), CompiledQuery(q_time=q_time))
+
+    def test_serializer_compiles_the_query(self):
+        query = search_serializer(q_time="[2016-01-01 TO 2016-01-03]", q_geo="[-10,-20 TO 10,20]",
+                                  a_time_limit=2).validated_data["query"]
+        self.assertEqual(query.q_geo, (-10.0, -20.0, 10.0, 20.0))
+        self.assertEqual(query.a_time, (datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 3)))
+        self.assertEqual(query.a_time_gap, "+1DAYS")
+        self.assertIsNone(query.a_hm)
+
+
+# west half 2 docs, east half 1, as fake_solr answers.
+HALVES_HEATMAP = ["gridLevel", 1, "columns", 2, "rows", 1, "minX", -180.0, "maxX", 180.0, "minY", -90.0,
+                  "maxY", 90.0, "counts_ints2D", [[2, 1]]]
+
+
+class TilesTest(SimpleTestCase):
+
+    def test_tile_box(self):
+        min_lat, min_lon, max_lat, max_lon = tile_box(0, 0, 0)
+        self.assertEqual((min_lon, max_lon), (-180.0, 180.0))
+        self.assertAlmostEqual(max_lat, 85.0511, places=4)
+        self.assertAlmostEqual(min_lat, -85.0511, places=4)
+        min_lat, min_lon, max_lat, max_lon = tile_box(1, 1, 0)
+        self.assertEqual((min_lat, min_lon, max_lon), (0.0, 0.0, 180.0))
+
+    def test_is_tile(self):
+        self.assertTrue(is_tile(0, 0, 0))
+        self.assertTrue(is_tile(2, 3, 3))
+        self.assertFalse(is_tile(2, 4, 0))
+        self.assertFalse(is_tile(23, 0, 0))
+
+    def test_resample(self):
+        counts = resample(HALVES_HEATMAP, 0, 0, 0)
+        self.assertEqual(counts.shape, (256, 256))
+        self.assertTrue((counts[:, :128] == 2).all())
+        self.assertTrue((counts[:, 128:] == 1).all())
+        self.assertTrue((resample(HALVES_HEATMAP, 1, 1, 1, size=4) == 1).all())
+
+    def test_resample_rows_in_degrees_or_mercator(self):
+        # two rows split at 45 degrees north.
+        heatmap = ["gridLevel", 1, "columns", 1, "rows", 2, "minX", -180.0, "maxX", 180.0, "minY", 0.0,
+                   "maxY", 90.0, "counts_ints2D", [[1], [2]]]
+        # the pixel rows of tile 1/0/0 at 0.25 and 0.75 of its height are around 66.5 and 24.5 degrees north.
+        self.assertEqual(resample(heatmap, 1, 0, 0, size=2)[:, 0].tolist(), [1, 2])
+        # the same rows as mercator tiles are split at mercator y pi / 2, 66.5 degrees north.
+        self.assertEqual(resample(heatmap, 1, 0, 0, size=2, mercator_rows=True)[:, 0].tolist(), [2, 2])
+
+    def test_outside_the_heatmap_is_zero(self):
+        heatmap = ["gridLevel", 1, "columns", 1, "rows", 1, "minX", 0.0, "maxX", 180.0, "minY", -90.0,
+                   "maxY", 90.0, "counts_ints2D", [[5]]]
+        counts = resample(heatmap, 0, 0, 0, size=4)
+        self.assertEqual(counts.tolist(), [[0, 0, 5, 5]] * 4)
+
+    def test_colorize(self):
+        colors = colorize(numpy.array([[0, 1, 100]]))
+        self.assertEqual(colors[0, 0].tolist(), [0, 0, 0, 0])
+        self.assertGreater(colors[0, 1, 3], 0)
+        self.assertEqual(colors[0, 2].tolist(), [255, 0, 0, 240])
+        self.assertNotEqual(colorize(numpy.array([[100]]), max_count=1000)[0, 0].tolist(), [255, 0, 0, 240])
+        self.assertFalse(colorize(numpy.zeros((2, 2), dtype=int)).any())
+
+    def test_encode_png(self):
+        rgba = colorize(resample(HALVES_HEATMAP, 0, 0, 0, size=8))
+        png = encode_png(rgba)
+        self.assertEqual(png[:8], b"\x89PNG\r\n\x1a\n")
+        chunks, position = {}, 8
+        while position < len(png):
+            length, tag = struct.unpack(">I4s", png[position:position + 8])
+            data = png[position + 8:position + 8 + length]
+            crc, = struct.unpack(">I", png[position + 8 + length:position + 12 + length])
+            self.assertEqual(zlib.crc32(tag + data) & 0xffffffff, crc)
+            chunks[tag] = data
+            position += length + 12
+        self.assertEqual(struct.unpack(">IIBBBBB", chunks[b"IHDR"]), (8, 8, 8, 6, 0, 0, 0))
+        scanlines = numpy.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=numpy.uint8).reshape(8, 8 * 4 + 1)
+        self.assertFalse(scanlines[:, 0].any())
+        self.assertEqual(scanlines[:, 1:].tobytes(), rgba.tobytes())
+
+
+class TileViewTest(FakeSolrTestCase):
+    params = {"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT}
+
+    def test_png(self):
+        response = self.client.get("/api/heatmap/1/1/0.png", self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response.content[:8], b"\x89PNG\r\n\x1a\n")
+        self.assertEqual(response["Cache-Control"], "public, max-age=300")
+        self.assertEqual(self.sent[0]["rows"], 0)
+        self.assertEqual(self.sent[0]["facet.heatmap.geom"], tile_geom(1, 1, 0))
+        self.assertTrue(self.sent[0]["facet.heatmap.geom"].startswith("[0.0,0.0 TO 85.05"))
+
+    def test_bin(self):
+        response = self.client.get("/api/heatmap/0/0/0.bin", self.params)
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        self.assertEqual(response["X-Heatmap-Size"], "256x256")
+        counts = numpy.frombuffer(response.content, dtype=response["X-Heatmap-Dtype"]).reshape(256, 256)
+        self.assertTrue((counts[:, :128] == 2).all())
+        self.assertTrue((counts[:, 128:] == 1).all())
+
+    def test_etag(self):
+        etag = self.client.get("/api/heatmap/0/0/0.png", self.params)["ETag"]
+        response = self.client.get("/api/heatmap/0/0/0.png", self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_no_such_tile(self):
+        self.assertEqual(self.client.get("/api/heatmap/1/2/0.png", self.params).status_code, 404)
+        self.assertFalse(self.sent)
+
+    def test_tile_parameters_are_validated(self):
+        for params in [{"a_hm_limit": 65537}, {"a_hm_limit": 0}, {"max_count": 0}]:
+            response = self.client.get("/api/heatmap/0/0/0.png", dict(self.params, **params))
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(list(params)[0], json.loads(response.content.decode("utf-8")))
+
+
+class HeatmapStackTest(FakeSolrTestCase):
+    """
+    The heatmap of a frame is the fake_solr one times the day of the month its bucket starts.
+    """
+    params = {"q_time": "[2016-01-01 TO 2016-01-04]", "a_hm_limit": 100, "a_hm_time_gap": "P1D"}
+
+    def setUp(self):
+        super(HeatmapStackTest, self).setUp()
+        fake_fetch_json = views.fetch_json
+
+        def fetch_json(endpoint, params=None, json_body=None, deadline=None):
+            res, response, shared = fake_fetch_json(endpoint, params, json_body, deadline)
+            frame_fq = [fq for fq in params.get("fq", []) if fq.startswith("layer_date:") and fq.endswith("}")]
+            if frame_fq:
+                day = int(frame_fq[0][len("layer_date:[2016-01-"):][:2])
+                heatmap = response["facet_counts"]["facet_heatmaps"]["bbox"]
+                heatmap[-1] = [[count * day for count in row] for row in heatmap[-1]]
+            return res, response, shared
+
+        views.fetch_json = fetch_json
+
+    def search(self, **params):
+        response = self.client.get("/api/search/", dict(self.params, search_engine="solr",
+                                                        search_engine_endpoint=SOLR_ENDPOINT, **params))
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content.decode("utf-8"))
+
+    def stack_counts(self, stack):
+        dtype = {"uint8": "u1", "uint16le": "<u2", "int8": "i1", "int16le": "<i2"}[stack["dtype"]]
+        return numpy.frombuffer(zlib.decompress(base64.b64decode(stack["counts"])),
+                                dtype=dtype).reshape(stack["shape"])
+
+    def test_stack_of_daily_heatmaps(self):
+        stack = self.search()["a.hm.time"]
+        self.assertEqual(stack["frames"], ["2016-01-01T00:00:00Z", "2016-01-02T00:00:00Z", "2016-01-03T00:00:00Z"])
+        self.assertEqual((stack["start"], stack["end"], stack["gap"]),
+                         ("2016-01-01T00:00:00Z", "2016-01-04T00:00:00Z", "P1D"))
+        self.assertEqual((stack["rows"], stack["columns"], stack["shape"]), (1, 2, [3, 1, 2]))
+        self.assertEqual((stack["encoding"], stack["compression"]), ("raw", "zlib"))
+        self.assertEqual(self.stack_counts(stack).tolist(), [[[2, 1]], [[4, 2]], [[6, 3]]])
+        # the search itself and one heatmap only search per frame.
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(sorted(params["fq"][0] for params in self.sent if params["fq"][0].endswith("}")),
+                         ["layer_date:[2016-01-01T00:00:00Z TO 2016-01-02T00:00:00Z}",
+                          "layer_date:[2016-01-02T00:00:00Z TO 2016-01-03T00:00:00Z}",
+                          "layer_date:[2016-01-03T00:00:00Z TO 2016-01-04T00:00:00Z}"])
+
+    def test_delta_encoding(self):
+        stack = self.search(a_hm_time_encoding="delta")["a.hm.time"]
+        self.assertEqual(stack["encoding"], "delta")
+        deltas = self.stack_counts(stack)
+        self.assertEqual(deltas.tolist(), [[[2, 1]], [[2, 1]], [[2, 1]]])
+        self.assertEqual(numpy.cumsum(deltas, axis=0).tolist(), [[[2, 1]], [[4, 2]], [[6, 3]]])
+
+    def test_frames_outside_q_time_are_empty(self):
+        stack = self.search(a_time_filter="[2016-01-01 TO 2016-01-04]",
+                            q_time="[2016-01-02 TO 2016-01-03]")["a.hm.time"]
+        self.assertEqual(self.stack_counts(stack).tolist(), [[[0, 0]], [[4, 2]], [[0, 0]]])
+        self.assertEqual(len(self.sent), 2)
+
+    def test_columnar_stack(self):
+        stack = self.search()["a.hm.time"]
+        shaped = columnar_heatmap_stack(stack, bytes)
+        self.assertEqual(shaped["frames"], [1451606400000, 1451692800000, 1451779200000])
+        self.assertEqual((shaped["start"], shaped["end"]), (1451606400000, 1451865600000))
+        self.assertEqual(zlib.decompress(shaped["counts"]), zlib.decompress(base64.b64decode(stack["counts"])))
+
+    def test_stack_needs_a_heatmap(self):
+        serializer = SearchSerializer(data={"search_engine": "solr", "search_engine_endpoint": SOLR_ENDPOINT,
+                                            "a_hm_time_gap": "P1D"})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("a_hm_time_gap", serializer.errors)
+
+    def test_too_many_frames_are_rejected(self):
+        serializer = SearchSerializer(data=dict(self.params, search_engine="solr", search_engine_endpoint=SOLR_ENDPOINT,
+                                                q_time="[2016-01-01 TO 2017-01-01]"))
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("a_hm_time_gap", serializer.errors)
+
+
+# run in a fresh process: the settings module is loaded once per process.
+WSGI_API_SCRIPT = """
+import json, sys
+from wsgiref.util import setup_testing_defaults
+from hhypermap_searchlayers_api import wsgi_api
+from django.conf import settings
+
+
+def get(path, query=""):
+    environ = {"PATH_INFO": path, "QUERY_STRING": query}
+    setup_testing_defaults(environ)
+    statuses = []
+    body = b"".join(wsgi_api.application(environ, lambda status, headers: statuses.append(status)))
+    return statuses[0], body.decode("utf-8")
+
+
+metrics, search = get("/api/metrics"), get("/api/search/", "a_time_gap=P1X")
+print(json.dumps({"settings": settings.SETTINGS_MODULE, "metrics": metrics[0], "search": search,
+                  "modules": sorted(name for name in sys.modules if sys.modules[name] and name.startswith((
+                      "django.contrib.admin", "django.contrib.auth", "django.contrib.sessions",
+                      "rest_framework_swagger.urls")))}))
+"""
+
+
+class ApiSettingsTest(SimpleTestCase):
+
+    def test_only_the_apps_and_middleware_the_api_uses(self):
+        from hhypermap_searchlayers_api import settings_api
+        self.assertEqual(settings_api.DATABASES, {})
+        self.assertFalse([app for app in settings_api.INSTALLED_APPS if app.startswith(
+            ("django.contrib.admin", "django.contrib.auth", "django.contrib.sessions", "django.contrib.messages"))])
+        self.assertFalse([middleware for middleware in settings_api.MIDDLEWARE_CLASSES if "csrf" in middleware.lower()
+                          or "session" in middleware.lower() or "auth" in middleware.lower()])
+        # the search settings are inherited.
+        self.assertEqual(settings_api.SEARCH_TILE_MAX_AGE, 300)
+
+    def test_api_urls(self):
+        urlconf = "hhypermap_searchlayers_api.urls_api"
+        self.assertEqual(resolve("/api/search/", urlconf).func.__name__, "Search")
+        self.assertEqual(resolve("/api/heatmap/1/0/1.png", urlconf).kwargs,
+                         {"z": "1", "x": "0", "y": "1", "tile_format": "png"})
+        self.assertEqual(resolve("/docs/", urlconf).func, resolve("/docs/", "hhypermap_searchlayers_api.urls").func)
+
+    def test_wsgi_application(self):
+        env = dict(os.environ)
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        output = subprocess.check_output([sys.executable, "-c", WSGI_API_SCRIPT], env=env,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+        self.assertEqual(result["settings"], "hhypermap_searchlayers_api.settings_api")
+        self.assertEqual(result["metrics"], "200 OK")
+        self.assertEqual(result["search"][0], "400 Bad Request")
+        self.assertIn("a_time_gap", json.loads(result["search"][1]))
+        # neither the admin, auth and sessions apps nor the swagger docs, before a /docs/ request.
+        self.assertEqual(result["modules"], [])
@@ -0,0 +1,125 @@
+import math
+import struct
+import zlib
+
+import numpy
+
+from api.federation import pairs
+from api.renderers import heatmap_grid
+from api.utils import tile_x_to_lon, tile_y_to_lat
+
+TILE_SIZE = 256
+MAX_TILE_ZOOM = 22
+
+# heat ramp from transparent through blue, cyan, lime and yellow to red: (position, r, g, b, a).
+COLOR_STOPS = [
+    (0.0, 0, 0, 255, 0),
+    (0.01, 0, 0, 255, 96),
+    (0.25, 0, 255, 255, 144),
+    (0.5, 0, 255, 0, 176),
+    (0.75, 255, 255, 0, 208),
+    (1.0, 255, 0, 0, 240),
+]
+
+
+def _color_table(stops):
+    """
+    256 x RGBA uint8 lookup table interpolating the stops.
+    """
+    positions = numpy.linspace(0.0, 1.0, 256)
+    stops = numpy.array(stops, dtype=float)
+    table = numpy.empty((256, 4), dtype=numpy.uint8)
+    for channel in range(4):
+        table[:, channel] = numpy.round(numpy.interp(positions, stops[:, 0], stops[:, channel + 1]))
+    table[0] = 0  # no docs, fully transparent.
+    return table
+
+
+COLOR_TABLE = _color_table(COLOR_STOPS)
+
+
+def tile_box(z, x, y):
+    """
+    :return: (min_lat, min_lon, max_lat, max_lon) of the web mercator tile.
+    """
+    return tile_y_to_lat(y + 1, z), tile_x_to_lon(x, z), tile_y_to_lat(y, z), tile_x_to_lon(x + 1, z)
+
+
+def tile_geom(z, x, y):
+    """
+    The tile box in the a.hm.filter format, [min_lat,min_lon TO max_lat,max_lon].
+    """
+    return "[{0},{1} TO {2},{3}]".format(*tile_box(z, x, y))
+
+
+def is_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _mercator(lat_degrees):
+    return numpy.log(numpy.tan(numpy.pi / 4 + numpy.radians(lat_degrees) / 2))
+
+
+def resample(heatmap, z, x, y, size=TILE_SIZE, mercator_rows=False):
+    """
+    Nearest cell of the heatmap facet under the center of every pixel of the tile.
+    :param heatmap: solr alternating key/value heatmap facet.
+    :param mercator_rows: rows are web mercator tiles (elasticsearch geotile_grid) instead
+    of equal degrees (solr).
+    :return: size x size uint32 counts, row major from north to south.
+    """
+    facet = dict(pairs(heatmap))
+    rows, columns = facet["rows"], facet["columns"]
+    grid = heatmap_grid(facet.get("counts_ints2D"), rows, columns)
+    offsets = (numpy.arange(size) + 0.5) / size
+
+    lons = (x + offsets) / 2.0 ** z * 360.0 - 180.0
+    column_index = numpy.floor((lons - facet["minX"]) / (facet["maxX"] - facet["minX"]) * columns).astype(int)
+
+    # pixel centers are evenly spaced in mercator y, the grid rows in degrees or in mercator y.
+    pixel_y = numpy.pi * (1 - 2 * (y + offsets) / 2.0 ** z)
+    if mercator_rows:
+        top, bottom, positions = _mercator(facet["maxY"]), _mercator(facet["minY"]), pixel_y
+    else:
+        top, bottom, positions = facet["maxY"], facet["minY"], numpy.degrees(numpy.arctan(numpy.sinh(pixel_y)))
+    row_index = numpy.floor((top - positions) / (top - bottom) * rows).astype(int)
+
+    inside = (row_index >= 0) & (row_index < rows)
+    inside = inside[:, numpy.newaxis] & ((column_index >= 0) & (column_index < columns))[numpy.newaxis, :]
+    counts = grid[numpy.clip(row_index, 0, rows - 1)[:, numpy.newaxis],
+                  numpy.clip(column_index, 0, columns - 1)[numpy.newaxis, :]]
+    return numpy.where(inside, counts, 0).astype(grid.dtype)
+
+
+def colorize(counts, max_count=None):
+    """
+    Log scaled colours of the counts, 0 is transparent.
+    :param max_count: count of the hottest colour, the tile maximum by default. Give the same
+    value to neighbouring tiles so their colours match.
+    :return: counts shape + (4,) RGBA uint8.
+    """
+    max_count = max_count or counts.max()
+    if not max_count:
+        return numpy.zeros(counts.shape + (4,), dtype=numpy.uint8)
+    scaled = numpy.log1p(numpy.minimum(counts, max_count)) / math.log1p(max_count)
+    index = numpy.where(counts > 0, numpy.maximum(1, numpy.round(scaled * 255)), 0).astype(numpy.uint8)
+    return COLOR_TABLE[index]
+
+
+def _png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+def encode_png(rgba, level=6):
+    """
+    8 bit RGBA PNG of a height x width x 4 uint8 array, every scanline unfiltered.
+    """
+    height, width = rgba.shape[:2]
+    scanlines = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), level)),
+        _png_chunk(b"IEND", b""),
+    ])
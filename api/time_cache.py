@@ -0,0 +1,199 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from api.federation import pairs, unpairs
+from api.renderers import epoch_millis
+from api.signals import get_index_changes, search_index_changed
+from api.utils import EPOCH, parse_datetime, solr_gap_delta
+
+DEFAULT_TIME_CACHE_SETTINGS = {
+    "ENABLED": True,
+    "TTL": 24 * 60 * 60,
+    "SETTLE_SECONDS": 5 * 60,
+    "MAX_BUCKETS": 100000,
+}
+
+
+class TimeHistogramCache(object):
+    """
+    Counts of closed solr facet.range buckets by (filter set, gap, bucket start). A bucket is
+    closed once it ended SETTLE_SECONDS ago, its count does not change anymore unless the
+    index does (see search_index_changed, unannounced changes show after ttl), so a sliding
+    "up to now" histogram only asks solr for its open tail.
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, settle_seconds=5 * 60, max_buckets=100000):
+        self.ttl = ttl
+        self.settle_seconds = settle_seconds
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # (filters, gap, start epoch millis) -> (expires, count)
+        self._lock = threading.Lock()
+        self.cached = 0
+        self.fetched = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_TIME_CACHE_SETTINGS)
+        config.update(getattr(settings, "SEARCH_TIME_CACHE", {}))
+        return cls(ttl=config["TTL"], settle_seconds=config["SETTLE_SECONDS"], max_buckets=config["MAX_BUCKETS"])
+
+    def settled(self, now=None):
+        """
+        :return: buckets ending before this are closed.
+        """
+        return (now or datetime.datetime.utcnow()) - datetime.timedelta(seconds=self.settle_seconds)
+
+    def get(self, filters, gap, starts):
+        """
+        :param starts: bucket start datetimes.
+        :return: the cached counts of the leading buckets, up to the first missing one.
+        """
+        counts = []
+        now = time.time()
+        with self._lock:
+            for start in starts:
+                key = (filters, gap, epoch_millis(start))
+                entry = self._buckets.get(key)
+                if entry is None or entry[0] < now:
+                    break
+                self._buckets[key] = self._buckets.pop(key)  # most recently used goes last.
+                counts.append(entry[1])
+        return counts
+
+    def set(self, filters, gap, buckets):
+        """
+        :param buckets: (start datetime, count) of closed buckets.
+        """
+        expires = time.time() + self.ttl
+        with self._lock:
+            for start, count in buckets:
+                key = (filters, gap, epoch_millis(start))
+                self._buckets.pop(key, None)
+                self._buckets[key] = (expires, count)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+
+    def count(self, cached, fetched):
+        with self._lock:
+            self.cached += cached
+            self.fetched += fetched
+
+    def invalidate(self, endpoint=None, since=None):
+        """
+        Drops the buckets of an endpoint (every endpoint when None) that end after since
+        (every bucket when None), e.g. after reindexing.
+        """
+        with self._lock:
+            for key in list(self._buckets):
+                filters, gap, start = key
+                if endpoint is not None and filters[0] != endpoint:
+                    continue
+                if since is not None and EPOCH + datetime.timedelta(milliseconds=start) + solr_gap_delta(gap) <= since:
+                    continue
+                del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.cached + self.fetched
+            return {
+                "buckets": len(self._buckets),
+                "cached": self.cached,
+                "fetched": self.fetched,
+                "hit_ratio": float(self.cached) / total if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class TimeHistogramPlan(object):
+    """
+    How the time facet of one solr request is answered: the leading closed buckets from the
+    cache, and the request facet.range.start moved to the first bucket solr has to count. When
+    every bucket is cached the facet.range params are removed from the request.
+    """
+
+    def __init__(self, cache, filters, params, now=None):
+        self.cache = cache
+        self.filters = filters
+        self.field = params["facet.range"]
+        prefix = "f.{0}.facet.range.".format(self.field)
+        self.start = params[prefix + "start"]
+        self.gap = params[prefix + "gap"]
+        self.step = solr_gap_delta(self.gap)
+        self.settled = cache.settled(now)
+
+        start, end = parse_datetime(self.start), parse_datetime(params[prefix + "end"])
+        # solr adds the gap over and over to the previous bucket start, so do the same.
+        self.starts = []
+        while start < end:
+            self.starts.append(start)
+            start += self.step
+        self.cached = cache.get(filters, self.gap, self.starts)
+
+        if len(self.cached) == len(self.starts):
+            for name in ["facet.range"] + [prefix + key for key in ("start", "end", "gap")]:
+                params.pop(name, None)
+        elif self.cached:
+            params[prefix + "start"] = self.starts[len(self.cached)].isoformat() + 'Z'
+
+    @property
+    def hit(self):
+        return len(self.cached) == len(self.starts)
+
+    def resolve(self, date_facet, store=True):
+        """
+        :param date_facet: the solr facet_ranges entry of the request, None on a hit.
+        :param store: False for partial results, whose buckets are not cached.
+        :return: the facet of the whole range, solr's start/end/gap/counts shape.
+        """
+        labels = [start.isoformat() + 'Z' for start in self.starts[:len(self.cached)]]
+        counts = zip(labels, self.cached)
+        if date_facet is None:
+            end = (self.starts[-1] + self.step if self.starts else parse_datetime(self.start)).isoformat() + 'Z'
+            self.cache.count(len(counts), 0)
+            return {"start": self.start, "end": end, "gap": self.gap, "counts": unpairs(counts)}
+
+        fetched = pairs(date_facet.get("counts") or [])
+        closed = []
+        for label, count in fetched:
+            start = parse_datetime(label)
+            if start + self.step <= self.settled:
+                closed.append((start, count))
+        if store:
+            self.cache.set(self.filters, self.gap, closed)
+        self.cache.count(len(counts), len(fetched))
+        return {"start": self.start, "end": date_facet.get("end"), "gap": self.gap,
+                "counts": unpairs(counts + fetched)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_time_cache():
+    """
+    Process wide TimeHistogramCache configured by settings.SEARCH_TIME_CACHE, None when disabled.
+    Index changes published by other processes are applied to it first.
+    """
+    global _cache
+    if not getattr(settings, "SEARCH_TIME_CACHE", DEFAULT_TIME_CACHE_SETTINGS).get("ENABLED", True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TimeHistogramCache.from_settings()
+    get_index_changes().poll()
+    return _cache
+
+
+def _invalidate(sender, endpoint=None, since=None, **kwargs):
+    if _cache is not None:
+        _cache.invalidate(endpoint, since)
+
+
+search_index_changed.connect(_invalidate, dispatch_uid="api.time_cache")
@@ -3,7 +3,15 @@ from rest_framework.urlpatterns import format_suffix_patterns
 from api import views
 
 urlpatterns = [
-    url(r'^search/$', views.Search.as_view())
+    url(r'^search/$', views.Search.as_view()),
+    url(r'^search/export/$', views.Export.as_view()),
+    url(r'^search/batch/$', views.Batch.as_view())
 ]
 
-urlpatterns = format_suffix_patterns(urlpatterns)
\ No newline at end of file
+urlpatterns = format_suffix_patterns(urlpatterns)
+
+urlpatterns += [
+    url(r'^heatmap/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<tile_format>png|bin)$', views.Tile.as_view()),
+    url(r'^metrics$', views.Metrics.as_view()),
+    url(r'^replicas$', views.Replicas.as_view())
+]
\ No newline at end of file
@@ -1,12 +1,16 @@
 import re
 import urllib
 
+import _strptime  # noqa, strptime imports it on first call, which races in the executor threads on python 2.
 import datetime
-import isodate
+import json
 import math
 
-from dateutil.parser import parse
-from shapely.geometry import box
+# dateutil, isodate and shapely are imported by the functions using them, on first use,
+# so they stay out of the worker startup.
+
+
+SOLR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 
 def parse_datetime(date_str):
@@ -15,7 +19,21 @@ def parse_datetime(date_str):
     """
     if date_str == '*':
         return None  # open ended.
-    return parse(date_str)
+    if len(date_str) == 20:
+        # solr's own format, e.g. the facet labels, without the much slower dateutil.
+        try:
+            return datetime.datetime.strptime(date_str, SOLR_DATE_FORMAT)
+        except ValueError:
+            pass
+
+    from dateutil.parser import parse
+    from dateutil.tz import tzutc
+
+    date = parse(date_str)
+    if date.tzinfo is not None:
+        # UTC is implied everywhere else, keep the dates naive.
+        date = date.astimezone(tzutc()).replace(tzinfo=None)
+    return date
 
 
 def parse_solr_time_range_as_pair(time_filter):
@@ -58,6 +76,8 @@ def parse_ISO8601(time_gap):
     :param time_gap: ISO8601 string.
     :return: tuple with quantity and unit of time.
     """
+    import isodate
+
     matcher = None
 
     if time_gap.count("T"):
@@ -90,19 +110,104 @@ def parse_ISO8601(time_gap):
     return quantity, units.get(unit)
 
 
-def compute_gap(start, end, time_limit):
+# natural gaps from the finest, what compute_gap picks from. Gaps of hours divide a day, of
+# months a year, and 7 days are weeks starting on monday.
+NATURAL_GAPS = [
+    (1, "SECONDS"), (5, "SECONDS"), (10, "SECONDS"), (15, "SECONDS"), (30, "SECONDS"),
+    (1, "MINUTES"), (5, "MINUTES"), (10, "MINUTES"), (15, "MINUTES"), (30, "MINUTES"),
+    (1, "HOURS"), (2, "HOURS"), (3, "HOURS"), (6, "HOURS"), (12, "HOURS"),
+    (1, "DAYS"), (7, "DAYS"),
+    (1, "MONTHS"), (3, "MONTHS"), (6, "MONTHS"),
+    (1, "YEARS"), (2, "YEARS"), (5, "YEARS"), (10, "YEARS"), (20, "YEARS"), (50, "YEARS"), (100, "YEARS"),
+]
+SECONDS_PER_UNIT = {"SECONDS": 1, "MINUTES": 60, "HOURS": 60 * 60, "DAYS": 24 * 60 * 60, "WEEKS": 7 * 24 * 60 * 60}
+EPOCH = datetime.datetime(1970, 1, 1)
+# the calendar gaps an elasticsearch date_histogram counts as snap_to_gap aligns them.
+ELASTICSEARCH_CALENDAR_INTERVALS = {(1, "MONTHS"): "1M", (3, "MONTHS"): "1q", (1, "YEARS"): "1y"}
+# the natural gaps an elasticsearch date_histogram counts like solr.
+ELASTICSEARCH_GAPS = [(quantity, unit) for quantity, unit in NATURAL_GAPS
+                      if unit not in ("MONTHS", "YEARS") or (quantity, unit) in ELASTICSEARCH_CALENDAR_INTERVALS]
+FIRST_MONDAY = datetime.datetime(1970, 1, 5)
+
+
+def parse_solr_gap(gap):
+    """
+    +9DAYS to (9, "DAYS")
+    """
+    matcher = re.match("\\+(\\d+)(YEARS|MONTHS|WEEKS|DAYS|HOURS|MINUTES|SECONDS)$", gap)
+    if not matcher:
+        raise Exception("Does not match the pattern: {}".format(gap))
+    return int(matcher.group(1)), matcher.group(2)
+
+
+def solr_gap_delta(gap):
+    """
+    +9DAYS to relativedelta(days=9).
+    """
+    from dateutil.relativedelta import relativedelta
+
+    quantity, unit = parse_solr_gap(gap)
+    return relativedelta(**{unit.lower(): quantity})
+
+
+def snap_to_gap(date, gap, ceil=False):
     """
-    Compute a gap that seems reasonable, considering natural time units and limit.
-    # TODO: make it to be reasonable.
-    # TODO: make it to be small unit of time sensitive.
+    The start of the gap bucket holding date, or with ceil the end unless date is a bucket start.
+    Buckets of months and years are counted from year 0, so 10 years are decades and 3 months
+    quarters; multiples of 7 days from a monday; the other ones from the epoch, e.g. midnight for
+    +1DAYS and +6HOURS. A bucket end past the last representable date is datetime.max.
+    """
+    quantity, unit = parse_solr_gap(gap)
+    if unit in ("YEARS", "MONTHS"):
+        months = quantity * 12 if unit == "YEARS" else quantity
+        elapsed = date.year * 12 + date.month - 1
+        elapsed = max(12, elapsed - elapsed % months)
+        snapped = datetime.datetime(elapsed // 12, elapsed % 12 + 1, 1)
+    else:
+        seconds = quantity * SECONDS_PER_UNIT[unit]
+        origin = FIRST_MONDAY if seconds % SECONDS_PER_UNIT["WEEKS"] == 0 else EPOCH
+        elapsed = int(math.floor((date - origin).total_seconds()))
+        snapped = origin + datetime.timedelta(seconds=elapsed - elapsed % seconds)
+    if ceil and snapped != date:
+        try:
+            snapped += solr_gap_delta(gap)
+        except (OverflowError, ValueError):
+            snapped = datetime.datetime.max
+    return snapped
+
+
+def count_gaps(start, end, gap):
+    """
+    :return: how many gap buckets cover start to end once both are snapped to the gap.
+    """
+    quantity, unit = parse_solr_gap(gap)
+    start, end = snap_to_gap(start, gap), snap_to_gap(end, gap, ceil=True)
+    if unit in ("YEARS", "MONTHS"):
+        months = (end.year - start.year) * 12 + end.month - start.month
+        return months // (quantity * 12 if unit == "YEARS" else quantity)
+    return int((end - start).total_seconds()) // (quantity * SECONDS_PER_UNIT[unit])
+
+
+def compute_gap(start, end, time_limit, natural_gaps=None):
+    """
+    The finest natural gap making at most time_limit buckets from start to end snapped to it,
+    past NATURAL_GAPS whole centuries.
     :param start: datetime
     :param end: datetime
     :param time_limit: gaps count
+    :param natural_gaps: the gaps to pick from instead of NATURAL_GAPS, e.g. ELASTICSEARCH_GAPS,
+    past them the coarsest one, time_limit being a soft maximum.
     :return: solr's format duration.
     """
-    duration = end - start
-    unit = int(math.ceil(duration.days / float(time_limit)))
-    return "+{0}DAYS".format(unit)
+    time_limit = max(1, time_limit)
+    for quantity, unit in natural_gaps or NATURAL_GAPS:
+        gap = "+{0}{1}".format(quantity, unit)
+        if count_gaps(start, end, gap) <= time_limit:
+            return gap
+    if natural_gaps:
+        return gap
+    centuries = int(math.ceil((end.year - start.year + 1) / 100.0 / time_limit))
+    return "+{0}YEARS".format(centuries * 100)
 
 
 def gap_to_sorl(time_gap):
@@ -112,6 +217,15 @@ def gap_to_sorl(time_gap):
     :return: solr's format duration.
     """
     quantity, unit = parse_ISO8601(time_gap)
+    return iso8601_to_solr_gap(quantity, unit)
+
+
+def iso8601_to_solr_gap(quantity, unit):
+    """
+    (1, ("DAYS", ...)) to +1DAYS
+    :param quantity, unit: as returned by parse_ISO8601.
+    :return: solr's format duration.
+    """
     if unit[0] == "WEEKS":
         return "+{0}DAYS".format(quantity * 7)
     else:
@@ -137,15 +251,25 @@ def request_time_facet(field, time_filter, time_gap, time_limit=100):
     if not end:
         end = now
 
-    key_range_start = "f.{0}.facet.range.start".format(field)
-    key_range_end = "f.{0}.facet.range.end".format(field)
-    key_range_gap = "f.{0}.facet.range.gap".format(field)
-
     if time_gap:
         gap = gap_to_sorl(time_gap)
     else:
         gap = compute_gap(start, end, time_limit)
 
+    return time_facet_params(field, start, end, gap)
+
+
+def time_facet_params(field, start, end, gap):
+    """
+    time facet query builder from an already resolved range and gap.
+    :param start: datetime
+    :param end: datetime
+    :param gap: solr's format duration.
+    """
+    key_range_start = "f.{0}.facet.range.start".format(field)
+    key_range_end = "f.{0}.facet.range.end".format(field)
+    key_range_gap = "f.{0}.facet.range.gap".format(field)
+
     params = {
         'facet.range': field,
         key_range_start: start.isoformat() + 'Z',
@@ -179,6 +303,7 @@ def parse_geo_box(geo_box_str):
     :param geo_box_str:
     :return:
     """
+    from shapely.geometry import box
 
     from_point_str, to_point_str = parse_solr_geo_range_as_pair(geo_box_str)
     from_point = parse_lat_lon(from_point_str)
@@ -204,6 +329,15 @@ def request_heatmap_facet(field, hm_filter, hm_grid_level, hm_limit):
     if not hm_filter:
         hm_filter = '[-90,-180 TO 90,180]'
 
+    return heatmap_facet_params(field, hm_filter, parse_lat_lon_box(hm_filter), hm_grid_level, hm_limit)
+
+
+def heatmap_facet_params(field, hm_filter, hm_box, hm_grid_level, hm_limit):
+    """
+    heatmap facet query builder from an already parsed region.
+    :param hm_filter: the region as given, [-90,-180 TO 90,180]
+    :param hm_box: the region corners, (min_lat, min_lon, max_lat, max_lon)
+    """
     params = {
         'facet': 'on',
         'facet.heatmap': field,
@@ -215,8 +349,8 @@ def request_heatmap_facet(field, hm_filter, hm_grid_level, hm_limit):
         params['facet.heatmap.gridLevel'] = hm_grid_level
     else:
         # Calculate distErr that will approximate aHmLimit many cells as an upper bound
-        rectangle = parse_geo_box(hm_filter)
-        degrees_side_length = rectangle.length / 2
+        # (the latitude span, what parse_geo_box(hm_filter).length / 2 always measured).
+        degrees_side_length = abs(hm_box[2] - hm_box[0])
         cell_side_length = math.sqrt(float(hm_limit))
         cell_side_length_degrees = degrees_side_length / cell_side_length * 2
         params['facet.heatmap.distErr'] = str(float(cell_side_length_degrees))
@@ -227,4 +361,288 @@ def request_heatmap_facet(field, hm_filter, hm_grid_level, hm_limit):
 
 
 def request_field_facet(field, limit, ex_filter=True):
-    pass
\ No newline at end of file
+    pass
+
+
+def _field_facet_name(facet_field):
+    """
+    {! ex=layer_originator}layer_originator to layer_originator
+    """
+    return re.sub(r"^\{!.*?\}", "", facet_field)
+
+
+def split_facet_params(params):
+    """
+    Splits the params of a faceted solr request in independent sub requests that can run
+    concurrently: the docs with the match count, the range facet, the heatmap and one
+    request per facet.field. Facet sub requests don't return docs.
+    :param params: solr query params as built by views.solr.
+    :return: list of (label, params).
+    """
+    base = dict((key, value) for key, value in params.items()
+                if key != "facet" and not key.startswith("facet.") and not key.startswith("f."))
+    sub_requests = [("docs", base)]
+    facet_base = dict(base, rows=0, facet="on")
+
+    range_field = params.get("facet.range")
+    if params.get("facet") == "on" and range_field:
+        sub_params = dict(facet_base)
+        sub_params["facet.range"] = range_field
+        prefix = "f.{0}.facet.range.".format(range_field)
+        sub_params.update((key, value) for key, value in params.items() if key.startswith(prefix))
+        sub_requests.append(("facet.range." + range_field, sub_params))
+
+    heatmap_field = params.get("facet.heatmap")
+    if params.get("facet") == "on" and heatmap_field:
+        sub_params = dict(facet_base)
+        sub_params.update((key, value) for key, value in params.items() if key.startswith("facet.heatmap"))
+        sub_requests.append(("facet.heatmap." + heatmap_field, sub_params))
+
+    for facet_field in params.get("facet.field", []) if params.get("facet") == "on" else []:
+        field = _field_facet_name(facet_field)
+        sub_params = dict(facet_base)
+        sub_params["facet.field"] = [facet_field]
+        prefix = "f.{0}.facet.".format(field)
+        sub_params.update((key, value) for key, value in params.items() if key.startswith(prefix))
+        sub_requests.append(("facet.field." + field, sub_params))
+
+    return sub_requests
+
+
+def parse_lat_lon_box(geo_box_str):
+    """
+    parses [-90,-180 TO 90,180] to its corners.
+    :param geo_box_str:
+    :return: (min_lat, min_lon, max_lat, max_lon)
+    """
+    from_point_str, to_point_str = parse_solr_geo_range_as_pair(geo_box_str)
+    min_lat, min_lon = parse_lat_lon(from_point_str)
+    max_lat, max_lon = parse_lat_lon(to_point_str)
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def snap_lat_lon_box(geo_box, grid):
+    """
+    (min_lat, min_lon, max_lat, max_lon) grown out to multiples of grid degrees, within the world.
+    """
+    min_lat, min_lon, max_lat, max_lon = geo_box
+    # the epsilon keeps corners already on the grid, e.g. 0.29 / 0.01 is 28.999999999999996.
+    floor = lambda value: round(math.floor(value / grid + 1e-9) * grid, 9)
+    ceil = lambda value: round(math.ceil(value / grid - 1e-9) * grid, 9)
+    return max(-90.0, floor(min_lat)), max(-180.0, floor(min_lon)), min(90.0, ceil(max_lat)), min(180.0, ceil(max_lon))
+
+
+def snap_solr_geo_range(geo_box_str, grid):
+    """
+    [-33.8712,151.2046 TO -33.8601,151.2189] to [-33.88,151.2 TO -33.86,151.22] for a 0.01 grid.
+    """
+    return "[{0},{1} TO {2},{3}]".format(*snap_lat_lon_box(parse_lat_lon_box(geo_box_str), grid))
+
+
+def snap_solr_time_range(time_filter, gap):
+    """
+    Grows the ends of a solr time range out to the gap grid, keeping open ends and brackets:
+    [2013-03-01T10:07:31Z TO 2013-04-01T00:00:00.5Z} to [2013-03-01T10:07:00Z TO 2013-04-01T00:01:00Z}
+    for +1MINUTES.
+    """
+    pattern = "([\\[{])(.*) TO (.*)([\\]}])$"
+    matcher = re.match(pattern, time_filter)
+    if not matcher:
+        raise Exception("Regex {0} couldn't parse {1}".format(pattern, time_filter))
+    start, end = parse_datetime(matcher.group(2)), parse_datetime(matcher.group(3))
+    left = snap_to_gap(start, gap).isoformat() + 'Z' if start else '*'
+    right = snap_to_gap(end, gap, ceil=True).isoformat() + 'Z' if end else '*'
+    return "{0}{1} TO {2}{3}".format(matcher.group(1), left, right, matcher.group(4))
+
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def lon_to_tile_x(lon, zoom):
+    n = 2 ** zoom
+    return min(n - 1, max(0, int(math.floor((lon + 180.0) / 360.0 * n))))
+
+
+def lat_to_tile_y(lat, zoom):
+    n = 2 ** zoom
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    lat_rad = math.radians(lat)
+    y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n
+    return min(n - 1, max(0, int(math.floor(y))))
+
+
+def tile_x_to_lon(x, zoom):
+    return x / float(2 ** zoom) * 360.0 - 180.0
+
+
+def tile_y_to_lat(y, zoom):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / float(2 ** zoom)))))
+
+
+def geotile_range(geo_box, zoom):
+    """
+    Web mercator tiles at zoom covering a box, the cells of an elasticsearch geotile_grid.
+    :param geo_box: (min_lat, min_lon, max_lat, max_lon)
+    :return: (x0, y0, x1, y1) inclusive, y0 is the northern row.
+    """
+    min_lat, min_lon, max_lat, max_lon = geo_box
+    return (lon_to_tile_x(min_lon, zoom), lat_to_tile_y(max_lat, zoom),
+            lon_to_tile_x(max_lon, zoom), lat_to_tile_y(min_lat, zoom))
+
+
+def geotile_precision(geo_box, hm_limit, max_zoom=29):
+    """
+    Highest zoom whose tiles covering the box are at most hm_limit.
+    :param geo_box: (min_lat, min_lon, max_lat, max_lon)
+    """
+    zoom = 0
+    for candidate in range(1, max_zoom + 1):
+        x0, y0, x1, y1 = geotile_range(geo_box, candidate)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > hm_limit:
+            break
+        zoom = candidate
+    return zoom
+
+
+def _elasticsearch_duration(seconds):
+    """
+    604800 to 7d, 5400 to 90m: in the largest elasticsearch time unit dividing seconds.
+    """
+    for unit, unit_seconds in (("d", SECONDS_PER_UNIT["DAYS"]), ("h", SECONDS_PER_UNIT["HOURS"]),
+                               ("m", SECONDS_PER_UNIT["MINUTES"])):
+        if seconds % unit_seconds == 0:
+            return "{0}{1}".format(seconds // unit_seconds, unit)
+    return "{0}s".format(seconds)
+
+
+def gap_to_elasticsearch(gap, start=None):
+    """
+    The date_histogram interval counting the same buckets as solr from start. +1MONTHS,
+    +3MONTHS and +1YEARS to calendar months, quarters and years, so start has to be on one of
+    their boundaries, where snap_to_gap puts it. Other multiples of months or years have no
+    elasticsearch interval. Fixed gaps to a fixed_interval, which elasticsearch aligns on the
+    epoch, offset to start: +7DAYS from a monday to {"fixed_interval": "7d", "offset": "+4d"}.
+    :param gap: solr's format duration.
+    :param start: datetime of the first bucket.
+    :return: the interval params of the date_histogram.
+    """
+    quantity, unit = parse_solr_gap(gap)
+    if (quantity, unit) in ELASTICSEARCH_CALENDAR_INTERVALS:
+        if start is not None and snap_to_gap(start, gap) != start:
+            raise Exception("Elasticsearch counts {0} from calendar boundaries, not from {1}".format(
+                gap, start.isoformat()))
+        return {"calendar_interval": ELASTICSEARCH_CALENDAR_INTERVALS[(quantity, unit)]}
+    if unit in ("YEARS", "MONTHS"):
+        raise Exception("Elasticsearch has no interval for {0}, only +1MONTHS, +3MONTHS and +1YEARS".format(gap))
+    seconds = quantity * SECONDS_PER_UNIT[unit]
+    interval = {"fixed_interval": _elasticsearch_duration(seconds)}
+    offset = int(math.floor((start - EPOCH).total_seconds())) % seconds if start is not None else 0
+    if offset:
+        interval["offset"] = "+" + _elasticsearch_duration(offset)
+    return interval
+
+
+def _local_params(facet_field):
+    """
+    {! ex=layer_originator}layer_originator to {"ex": "layer_originator"}
+    """
+    matcher = re.search(r"^\{!(.*?)\}", facet_field)
+    if not matcher:
+        return {}
+    return dict(pair.split("=", 1) for pair in matcher.group(1).split() if "=" in pair)
+
+
+def compile_json_facet(params, options=None):
+    """
+    Compiles the legacy facet.range, facet.heatmap and facet.field params, with their
+    f.<field>.* overrides, into a single json.facet param computed by the solr JSON Facet API.
+    https://cwiki.apache.org/confluence/display/solr/JSON+Facet+API
+    :param params: solr query params as built by views.solr.
+    :param options: extra options per facet kind, e.g. {"terms": {"method": "dv"}, "range": {}, "heatmap": {}}.
+    :return: (params without legacy facet params, facet specs to decode the response with decode_json_facet).
+    """
+    options = options or {}
+    json_params = dict((key, value) for key, value in params.items()
+                       if key != "facet" and not key.startswith("facet.") and not key.startswith("f."))
+    specs = []
+    if params.get("facet") != "on":
+        return json_params, specs
+
+    facets = {}
+    range_field = params.get("facet.range")
+    if range_field:
+        prefix = "f.{0}.facet.range.".format(range_field)
+        facet = {
+            "type": "range",
+            "field": range_field,
+            "start": params[prefix + "start"],
+            "end": params[prefix + "end"],
+            "gap": params[prefix + "gap"],
+        }
+        facet.update(options.get("range", {}))
+        facets["range_" + range_field] = facet
+        specs.append(("range", range_field, "range_" + range_field, facet))
+
+    heatmap_field = params.get("facet.heatmap")
+    if heatmap_field:
+        facet = {"type": "heatmap", "field": heatmap_field, "geom": params.get("facet.heatmap.geom")}
+        if params.get("facet.heatmap.gridLevel"):
+            facet["gridLevel"] = params["facet.heatmap.gridLevel"]
+        if params.get("facet.heatmap.distErr"):
+            facet["distErr"] = float(params["facet.heatmap.distErr"])
+        facet.update(options.get("heatmap", {}))
+        facets["heatmap_" + heatmap_field] = facet
+        specs.append(("heatmap", heatmap_field, "heatmap_" + heatmap_field, facet))
+
+    for facet_field in params.get("facet.field", []):
+        field = _field_facet_name(facet_field)
+        # legacy facet.field defaults: 100 values, zero counts included.
+        facet = {
+            "type": "terms",
+            "field": field,
+            "limit": int(params.get("f.{0}.facet.limit".format(field), 100)),
+            "mincount": 0,
+        }
+        excluded = _local_params(facet_field).get("ex")
+        if excluded:
+            facet["domain"] = {"excludeTags": excluded}
+        facet.update(options.get("terms", {}))
+        facets["field_" + field] = facet
+        specs.append(("terms", field, "field_" + field, facet))
+
+    if facets:
+        json_params["json.facet"] = json.dumps(facets, sort_keys=True)
+    return json_params, specs
+
+
+def decode_json_facet(facets, specs):
+    """
+    Converts a JSON Facet API "facets" response to the legacy "facet_counts" one.
+    :param facets: the "facets" of the solr response.
+    :param specs: as returned by compile_json_facet.
+    :return: facet_counts dict with facet_ranges, facet_heatmaps and facet_fields.
+    """
+    facet_counts = {"facet_ranges": {}, "facet_heatmaps": {}, "facet_fields": {}}
+    for kind, field, key, facet in specs:
+        result = facets.get(key) or {}
+        if kind == "range":
+            counts = []
+            for bucket in result.get("buckets", []):
+                counts.extend([bucket["val"], bucket["count"]])
+            facet_counts["facet_ranges"][field] = {
+                "counts": counts,
+                "start": facet["start"],
+                "end": facet["end"],
+                "gap": facet["gap"],
+            }
+        elif kind == "heatmap":
+            heatmap = []
+            for name in ("gridLevel", "columns", "rows", "minX", "maxX", "minY", "maxY", "counts_ints2D"):
+                heatmap.extend([name, result.get(name)])
+            facet_counts["facet_heatmaps"][field] = heatmap
+        else:
+            counts = []
+            for bucket in result.get("buckets", []):
+                counts.extend([bucket["val"], bucket["count"]])
+            facet_counts["facet_fields"][field] = counts
+    return facet_counts
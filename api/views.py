@@ -1,9 +1,34 @@
-import requests
+import base64
+import datetime
+import hashlib
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from api.utils import parse_geo_box, request_time_facet, request_heatmap_facet
-from serializers import SearchSerializer
+from api.cache import cache_key, canonical_query, get_response_cache
+from api.connections import fetch_json, get_executor, get_flights, get_pool
+from api.deadline import DeadlineExceeded, request_client
+from api.export import EXPORT_FORMATS
+from api.federation import merge_counts, merge_docs, merge_heatmaps, merge_time, pairs
+from api.heatmap_cache import HeatmapPlan, get_heatmap_cache
+from api.metrics import clock, get_histograms, millis, record, set_labels, stage
+from api.query import WORLD
+from api.renderers import SEARCH_RENDERER_CLASSES, heatmap_grid, pack_grid
+from api.replicas import get_replica_router
+from api.slowlog import annotate, query_signature
+from api.tiles import TILE_SIZE, colorize, encode_png, is_tile, resample, tile_box, tile_geom
+from api.time_cache import TimeHistogramPlan, get_time_cache
+from api.utils import time_facet_params, heatmap_facet_params, split_facet_params, compile_json_facet, \
+    decode_json_facet, geotile_precision, geotile_range, tile_x_to_lon, tile_y_to_lat, gap_to_elasticsearch, \
+    parse_lat_lon_box, snap_lat_lon_box, snap_solr_geo_range, snap_solr_time_range
+from serializers import ExportSerializer, SearchSerializer, TileSerializer
 
 # - OPEN API specs
 # https://github.com/OAI/OpenAPI-Specification/blob/master/versions/1.2.md#parameterObject
@@ -15,86 +40,510 @@ USER_FIELD = "layer_originator"
 TEXT_FIELD = "title"
 TIME_SORT_FIELD = "layer_date"
 GEO_SORT_FIELD = "bbox"
+WORLD_FILTER = "[-90,-180 TO 90,180]"
+ID_FIELD = "id"
+ES_ID_FIELD = "_id"
+
+DEFAULT_EXPORT_PAGE_SIZE = 1000
+# csv columns of the exports without d_docs_fields, by search engine.
+DEFAULT_EXPORT_FIELDS = {
+    "solr": [ID_FIELD, TEXT_FIELD, "abstract", USER_FIELD, TIME_FILTER_FIELD, GEO_FILTER_FIELD],
+    "elasticsearch": [ES_ID_FIELD, TEXT_FIELD, "abstract", USER_FIELD, TIME_FILTER_FIELD, GEO_FILTER_FIELD],
+}
+DEFAULT_FEDERATED_WORKERS = 8
+DEFAULT_BATCH_CONCURRENCY = 8
+DEFAULT_BATCH_MAX_ITEMS = 100
+PASSTHROUGH_CHUNK_SIZE = 64 * 1024
+DEFAULT_TILE_HEATMAP_CELLS = 4096
+DEFAULT_TILE_MAX_AGE = 300
+DEFAULT_SOLR_FILTER_SETTINGS = {
+    "NORMALIZE": False,
+    "TIME_GRID": "+1MINUTES",
+    "GEO_GRID": 0.01,
+    "UNCACHED_OFF_GRID": False,
+    "UNCACHED": (),
+    "COST": {"user": 0, "time": 10, "geo": 100},
+}
+
+
+def elasticsearch_filters(validated_data, include_user=True):
+    """
+    bool filter clauses of an elasticsearch _search body for the q.* constraints.
+    """
+    filters = []
+    query = validated_data["query"]
+    if query.q_time:
+        start, end = query.q_time
+        time_range = {}
+        if start:
+            time_range["gte"] = start.isoformat() + 'Z'
+        if end:
+            time_range["lte"] = end.isoformat() + 'Z'
+        if time_range:
+            filters.append({"range": {TIME_FILTER_FIELD: time_range}})
+    if query.q_geo:
+        min_lat, min_lon, max_lat, max_lon = query.q_geo
+        filters.append({"geo_bounding_box": {GEO_FILTER_FIELD: {
+            "top_left": {"lat": max_lat, "lon": min_lon},
+            "bottom_right": {"lat": min_lat, "lon": max_lon}
+        }}})
+    q_user = validated_data.get("q_user")
+    if q_user and include_user:
+        filters.append({"term": {USER_FIELD: q_user}})
+    return filters
+
+
+def elasticsearch_query(validated_data, include_user=True):
+    """
+    The query clause of an elasticsearch _search body for the q.* constraints.
+    """
+    q_text = validated_data.get("q_text")
+    must = {"query_string": {"query": q_text}} if q_text else {"match_all": {}}
+    return {"bool": {"must": must, "filter": elasticsearch_filters(validated_data, include_user)}}
+
+
+def elasticsearch_filtered_agg(filters, agg):
+    """
+    Wraps agg in a filter aggregation, the result is under ["agg"] of its bucket.
+    """
+    if filters:
+        agg_filter = {"bool": {"filter": filters}}
+    else:
+        agg_filter = {"match_all": {}}
+    return {"filter": agg_filter, "aggs": {"agg": agg}}
+
+
+def elasticsearch_heatmap(hm_box, hm_grid_level, hm_limit, filters=()):
+    """
+    geotile_grid aggregation approximating the solr heatmap facet of the region.
+    :param hm_box: (min_lat, min_lon, max_lat, max_lon) of the region.
+    :param filters: more filter clauses the aggregated docs must match.
+    :return: (aggregation, (zoom, x0, y0, x1, y1) of the grid).
+    """
+    zoom = hm_grid_level or geotile_precision(hm_box, hm_limit)
+    x0, y0, x1, y1 = geotile_range(hm_box, zoom)
+    min_lat, min_lon, max_lat, max_lon = hm_box
+    agg = elasticsearch_filtered_agg(
+        list(filters) + [{"geo_bounding_box": {GEO_HEATMAP_FIELD: {
+            "top_left": {"lat": max_lat, "lon": min_lon},
+            "bottom_right": {"lat": min_lat, "lon": max_lon}
+        }}}],
+        {"geotile_grid": {"field": GEO_HEATMAP_FIELD, "precision": zoom,
+                          "size": (x1 - x0 + 1) * (y1 - y0 + 1)}})
+    return agg, (zoom, x0, y0, x1, y1)
+
+
+def elasticsearch_heatmap_facet(buckets, grid):
+    """
+    geotile_grid buckets to the solr heatmap facet format. Rows go from north to south,
+    like solr, but they are web mercator tiles, so their height in degrees is not uniform.
+    """
+    zoom, x0, y0, x1, y1 = grid
+    columns, rows = x1 - x0 + 1, y1 - y0 + 1
+    counts = [[0] * columns for _ in range(rows)]
+    for bucket in buckets:
+        _, x, y = map(int, bucket["key"].split("/"))
+        if x0 <= x <= x1 and y0 <= y <= y1:
+            counts[y - y0][x - x0] = bucket["doc_count"]
+    counts = [row if any(row) else None for row in counts]
+    if not any(counts):
+        counts = None
+    return [
+        "gridLevel", zoom,
+        "columns", columns,
+        "rows", rows,
+        "minX", tile_x_to_lon(x0, zoom),
+        "maxX", tile_x_to_lon(x1 + 1, zoom),
+        "minY", tile_y_to_lat(y1 + 1, zoom),
+        "maxY", tile_y_to_lat(y0, zoom),
+        "counts_ints2D", counts
+    ]
+
+
+def elasticsearch_terms_facet(buckets):
+    facet = []
+    for bucket in buckets:
+        facet.extend([bucket["key"], bucket["doc_count"]])
+    return facet
+
+
+def docs_fields(validated_data):
+    """
+    The stored fields of the d.docs of a validated search, None for all of them. The id and the
+    time sort field, which federated searches merge on, are always there.
+    """
+    fields = validated_data.get("d_docs_fields")
+    if not fields:
+        return None
+    required = [ID_FIELD] + ([TIME_SORT_FIELD] if validated_data.get("d_docs_sort") == "time" else [])
+    return required + [field for field in fields if field not in required]
+
+
+def resolve_search_engine_debug(validated_data):
+    """
+    True when solr is asked for indented responses with debug output, always for the original
+    response, which is for debugging.
+    """
+    if validated_data.get("return_search_engine_original_response"):
+        return True
+    debug = validated_data.get("search_engine_debug")
+    if debug is None:
+        debug = getattr(settings, "SEARCH_ENGINE_DEBUG", False)
+    return bool(debug)
+
+
+def elasticsearch_body(validated_data):
+    """
+    The _search body of a validated search: the docs, the match count and every a.* facet
+    as aggregations.
+    :return: (body, (start, end, gap) of the a.time buckets, geotile grid of a.hm).
+    """
+    query = validated_data["query"]
+    q_text = validated_data.get("q_text")
+    q_user = validated_data.get("q_user")
+    d_docs_limit = validated_data.get("d_docs_limit")
+    d_docs_sort = validated_data.get("d_docs_sort")
+    a_time_limit = validated_data.get("a_time_limit")
+    a_hm_limit = validated_data.get("a_hm_limit")
+    a_hm_gridlevel = validated_data.get("a_hm_gridlevel")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+    time_facet = None
+    hm_grid = None
+
+    # like the solr {!ex} user facet, q_user constrains the docs and every facet but a.user.
+    user_filters = [{"term": {USER_FIELD: q_user}}] if q_user else []
+    body = {
+        "query": elasticsearch_query(validated_data, include_user=False),
+        "size": d_docs_limit,
+        "track_total_hits": True,
+        "aggs": {}
+    }
+    if user_filters:
+        body["post_filter"] = {"bool": {"filter": user_filters}}
+    fields = docs_fields(validated_data)
+    if fields:
+        body["_source"] = fields
+
+    # docs ordering
+    if d_docs_sort == 'score' and q_text:
+        body["sort"] = ["_score"]
+    elif d_docs_sort == 'time':
+        body["sort"] = [{TIME_SORT_FIELD: "desc"}]
+    elif d_docs_sort == 'distance':
+        min_lat, min_lon, max_lat, max_lon = query.q_geo or WORLD
+        body["sort"] = [{"_geo_distance": {
+            GEO_SORT_FIELD: {"lat": (min_lat + max_lat) / 2.0, "lon": (min_lon + max_lon) / 2.0},
+            "order": "asc"
+        }}]
+
+    # aggregations
+    if a_time_limit > 0:
+        start, end = [date.isoformat() + 'Z' for date in query.a_time]
+        gap = query.a_time_gap
+        histogram = dict(gap_to_elasticsearch(gap, query.a_time[0]), **{
+            "field": TIME_FILTER_FIELD,
+            "format": "yyyy-MM-dd'T'HH:mm:ss'Z'",
+            "min_doc_count": 0,
+            "extended_bounds": {"min": start, "max": end}
+        })
+        time_facet = (start, end, gap)
+        body["aggs"]["a.time"] = elasticsearch_filtered_agg(
+            user_filters + [{"range": {TIME_FILTER_FIELD: {"gte": start, "lt": end}}}],
+            {"date_histogram": histogram})
+
+    if a_hm_limit > 0:
+        hm_agg, hm_grid = elasticsearch_heatmap(query.a_hm, a_hm_gridlevel, a_hm_limit, user_filters)
+        body["aggs"]["a.hm"] = hm_agg
+
+    if a_user_limit > 0:
+        body["aggs"]["a.user"] = elasticsearch_filtered_agg(
+            [], {"terms": {"field": USER_FIELD, "size": a_user_limit}})
+
+    if a_text_limit > 0:
+        body["aggs"]["a.text"] = elasticsearch_filtered_agg(
+            user_filters, {"terms": {"field": TEXT_FIELD, "size": a_text_limit}})
+
+    deadline = validated_data.get("deadline")
+    if deadline:
+        body["timeout"] = "{0}ms".format(deadline.engine_ms)
+
+    return body, time_facet, hm_grid
+
+
+def elasticsearch_data(validated_data, es_response, time_facet, hm_grid):
+    """
+    The search response, without timing, out of an elasticsearch _search response, shaped like the solr one.
+    :param time_facet, hm_grid: as returned by elasticsearch_body.
+    """
+    a_time_limit = validated_data.get("a_time_limit")
+    a_hm_limit = validated_data.get("a_hm_limit")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+
+    data = {"partialResults": bool(es_response.get("timed_out"))}
+
+    hits = es_response.get("hits")
+    total = hits.get("total")
+    data["a.matchDocs"] = total.get("value") if isinstance(total, dict) else total
+    if hits.get("hits"):
+        data["d.docs"] = hits.get("hits")
+
+    aggregations = es_response.get("aggregations", {})
+    if a_time_limit > 0:
+        buckets = aggregations["a.time"]["agg"]["buckets"]
+        start, end, gap = time_facet
+        data["a.time"] = {
+            "start": start,
+            "end": end,
+            "gap": gap,
+            "counts": elasticsearch_terms_facet(
+                [{"key": bucket["key_as_string"], "doc_count": bucket["doc_count"]} for bucket in buckets])
+        }
+
+    if a_hm_limit > 0:
+        data["a.hm"] = elasticsearch_heatmap_facet(aggregations["a.hm"]["agg"]["buckets"], hm_grid)
+
+    if a_user_limit > 0:
+        data["a.user"] = elasticsearch_terms_facet(aggregations["a.user"]["agg"]["buckets"])
+
+    if a_text_limit > 0:
+        data["a.text"] = elasticsearch_terms_facet(aggregations["a.text"]["agg"]["buckets"])
+
+    return data
 
 
 def elasticsearch(serializer):
     """
+    Search on elasticsearch endpoint with a single _search request: the docs, the match count
+    and every a.* facet as aggregations, shaped like the solr() response.
     https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
     :param serializer:
     :return:
     """
     search_engine_endpoint = serializer.validated_data.get("search_engine_endpoint")
-    q_text = serializer.validated_data.get("q_text")
     return_solr_original_response = serializer.validated_data.get("return_search_engine_original_response")
 
-    params = {
-        "q": q_text
-    }
-    res = requests.get(search_engine_endpoint, params=params)
-    es_response = res.json()
+    with stage("params"):
+        body, time_facet, hm_grid = elasticsearch_body(serializer.validated_data)
+    with stage("upstream"):
+        res, es_response, shared = fetch_json(search_engine_endpoint, json_body=body,
+                                              deadline=serializer.validated_data.get("deadline"))
+    annotate(upstream=res.url, qtime=es_response.get("took"))
 
     if return_solr_original_response:
         return es_response
 
-    data = {}
-
-    hits = es_response.get("hits")
-    data["a.matchDocs"] = hits.get("total")
-    data["d.docs"] = hits.get("hits")
+    shaping = clock()
+    data = elasticsearch_data(serializer.validated_data, es_response, time_facet, hm_grid)
+    data["timing"] = {
+        "label": "requests.post.elapsed",
+        "millis": millis(res.elapsed),
+        "subs": [{
+            "label": "took",
+            "millis": es_response.get("took")
+        }],
+        "timed_out": es_response.get("timed_out"),
+        "pool": get_pool().stats(),
+        "singleflight": dict(get_flights().stats(), shared=shared)
+    }
+    record("shape", shaping)
 
     return data
 
 
-def solr(serializer):
+def solr_filter_settings():
+    return dict(DEFAULT_SOLR_FILTER_SETTINGS, **getattr(settings, "SEARCH_SOLR_FILTERS", {}))
+
+
+def solr_q_filters(validated_data):
     """
-    Search on solr endpoint
-    :param serializer:
-    :return:
+    The q_time, q_geo and q_user solr strings of a validated search. When normalize_filters, or
+    otherwise the NORMALIZE setting, q_time is grown out to TIME_GRID and q_geo to GEO_GRID degrees,
+    so nearby searches of precision tolerant clients share solr's filterCache entries.
     """
-    search_engine_endpoint = serializer.validated_data.get("search_engine_endpoint")
-    q_time = serializer.validated_data.get("q_time")
-    q_geo = serializer.validated_data.get("q_geo")
-    q_text = serializer.validated_data.get("q_text")
-    q_user = serializer.validated_data.get("q_user")
-    d_docs_limit = serializer.validated_data.get("d_docs_limit")
-    d_docs_sort = serializer.validated_data.get("d_docs_sort")
-    a_time_limit = serializer.validated_data.get("a_time_limit")
-    a_time_gap = serializer.validated_data.get("a_time_gap")
-    a_time_filter = serializer.validated_data.get("a_time_filter")
-    a_hm_limit = serializer.validated_data.get("a_hm_limit")
-    a_hm_gridlevel = serializer.validated_data.get("a_hm_gridlevel")
-    a_hm_filter = serializer.validated_data.get("a_hm_filter")
-    a_text_limit = serializer.validated_data.get("a_text_limit")
-    a_user_limit = serializer.validated_data.get("a_user_limit")
-    return_search_engine_original_response = serializer.validated_data.get("return_search_engine_original_response")
+    q_time = validated_data.get("q_time")
+    q_geo = validated_data.get("q_geo")
+    normalize = validated_data.get("normalize_filters")
+    filter_settings = solr_filter_settings()
+    if normalize is None:
+        normalize = filter_settings["NORMALIZE"]
+    if normalize:
+        if q_time:
+            q_time = snap_solr_time_range(q_time, filter_settings["TIME_GRID"])
+        if q_geo:
+            q_geo = snap_solr_geo_range(q_geo, filter_settings["GEO_GRID"])
+    return q_time, q_geo, validated_data.get("q_user")
+
+
+def solr_filters(q_time, q_geo, q_user):
+    """
+    fq params for the q.* constraints, the cheapest COST of SEARCH_SOLR_FILTERS first. The kinds
+    in UNCACHED, and with UNCACHED_OFF_GRID the time and geo filters off the normalization grid,
+    likely one-offs, skip solr's filterCache with {!cache=false cost=N}.
+    """
+    filter_settings = solr_filter_settings()
+    filters = []  # (kind, off the grid, local params, query)
+    if q_time:
+        # TODO: when user sends incomplete dates like 2000, its completed: 2000-(TODAY-MONTH)-(TODAY-DAY)T00:00:00Z
+        # TODO: "Invalid Date in Date Math String:'[* TO 2000-12-05T00:00:00Z]'"
+        # Kotlin like: "{!field f=layer_date tag=layer_date}[* TO 2000-12-05T00:00:00Z]"
+        # then do it simple:
+        off_grid = snap_solr_time_range(q_time, filter_settings["TIME_GRID"]) != q_time
+        filters.append(("time", off_grid, [], "{0}:{1}".format(TIME_FILTER_FIELD, q_time)))
+    if q_geo:
+        geo_box = parse_lat_lon_box(q_geo)
+        off_grid = snap_lat_lon_box(geo_box, filter_settings["GEO_GRID"]) != geo_box
+        filters.append(("geo", off_grid, [], "{0}:{1}".format(GEO_FILTER_FIELD, q_geo)))
+    if q_user:
+        filters.append(("user", False, ["field", "f={0}".format(USER_FIELD), "tag={0}".format(USER_FIELD)], q_user))
+
+    costs = filter_settings["COST"]
+    fq = []
+    for kind, off_grid, local_params, query in sorted(filters, key=lambda f: costs.get(f[0], 0)):
+        if kind in filter_settings["UNCACHED"] or (off_grid and filter_settings["UNCACHED_OFF_GRID"]):
+            local_params = local_params + ["cache=false", "cost={0}".format(costs.get(kind, 0))]
+        fq.append("{{!{0}}}{1}".format(" ".join(local_params), query) if local_params else query)
+    return fq
+
+
+def solr_timing(elapsed, solr_response, label="requests.get.elapsed"):
+    """
+    Timing node of one solr request with the QTime and the debug=timing breakdown.
+    :param elapsed: seconds or timedelta of the request.
+    """
+    subs = []
+    for label_, values in solr_response.get("debug", {}).get("timing", {}).iteritems():
+        if type(values) is not dict:
+            continue
+        subs_data = {"label": label_, "subs": []}
+        for label_, values in values.iteritems():
+            if type(values) is not dict:
+                subs_data["millis"] = values
+                continue
+            subs_data["subs"].append({
+                "label": label_,
+                "millis": values.get("time")
+            })
+        subs.append(subs_data)
+
+    return {
+        "label": label,
+        "millis": millis(elapsed),
+        "subs": [{
+            "label": "QTime",
+            "millis": solr_response["responseHeader"].get("QTime"),
+            "subs": subs
+        }]
+    }
+
+
+def merge_solr_responses(solr_responses):
+    """
+    Merges the responses of split_facet_params sub requests in one solr response.
+    The docs request goes first. The given responses may be shared, they are not modified.
+    """
+    merged = dict(solr_responses[0])
+    if any(solr_response.get("responseHeader", {}).get("partialResults") for solr_response in solr_responses):
+        merged["responseHeader"] = dict(merged.get("responseHeader", {}), partialResults=True)
+    facet_counts = {}
+    for solr_response in solr_responses:
+        for kind, facets in solr_response.get("facet_counts", {}).iteritems():
+            if isinstance(facets, dict):
+                facet_counts.setdefault(kind, {}).update(facets)
+    merged["facet_counts"] = facet_counts
+    return merged
+
+
+def resolve_solr_facet_api(validated_data):
+    return validated_data.get("solr_facet_api") or getattr(settings, "SEARCH_SOLR_FACET_API", "legacy")
+
+
+def solr_fetch(search_engine_endpoint, params, facet_api="legacy", deadline=None):
+    """
+    Sends the solr request. With the "json" facet api the legacy facet params are compiled
+    into one json.facet param and the response facets decoded back into facet_counts.
+    :param deadline: Deadline of the search, the read timeout.
+    :return: (response, solr response, True when shared with another caller).
+    """
+    if facet_api != "json":
+        return fetch_json(search_engine_endpoint, params, deadline=deadline)
+
+    json_params, specs = compile_json_facet(params, getattr(settings, "SEARCH_SOLR_JSON_FACET_OPTIONS", {}))
+    res, solr_response, shared = fetch_json(search_engine_endpoint, json_params, deadline=deadline)
+    if specs:
+        # the response may be shared, decode into a copy.
+        solr_response = dict(solr_response, facet_counts=decode_json_facet(solr_response.get("facets", {}), specs))
+    return res, solr_response, shared
+
+
+def solr_parallel(search_engine_endpoint, params, facet_api="legacy", deadline=None):
+    """
+    Runs the docs and every facet of params as concurrent solr requests on the bounded
+    executor and merges them back.
+    :return: (merged solr response, timing, True when any sub request was shared).
+    """
+    started = time.time()
+    futures = [
+        (label, get_executor().submit(solr_fetch, search_engine_endpoint, sub_params, facet_api, deadline))
+        for label, sub_params in split_facet_params(params)
+    ]
+    results = [(label, future.result()) for label, future in futures]
+
+    solr_response = merge_solr_responses([body for label, (res, body, shared) in results])
+    solr_response["solr_request"] = [res.url for label, (res, body, shared) in results]
+    timing = {
+        "label": "parallel.elapsed",
+        "millis": millis(time.time() - started),
+        "subs": [
+            solr_timing(res.elapsed, body, label="requests.get.elapsed." + label)
+            for label, (res, body, shared) in results
+        ]
+    }
+    shared = any(shared for label, (res, body, shared) in results)
+    return solr_response, timing, shared
+
 
-    print serializer.validated_data
+def solr_params(validated_data):
+    """
+    Query params of the solr request for a validated search.
+    """
+    query = validated_data["query"]
+    q_text = validated_data.get("q_text")
+    d_docs_limit = validated_data.get("d_docs_limit")
+    d_docs_sort = validated_data.get("d_docs_sort")
+    a_time_limit = validated_data.get("a_time_limit")
+    a_hm_limit = validated_data.get("a_hm_limit")
+    a_hm_gridlevel = validated_data.get("a_hm_gridlevel")
+    a_hm_filter = validated_data.get("a_hm_filter")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
 
-    # query params to be sent via restful solr
+    # query params to be sent via restful solr, lean unless debugging: no indentation, no debug output.
     params = {
         "q": "*:*",
-        "indent": "on",
         "wt": "json",
         "rows": d_docs_limit,
         "facet": "off",
         "facet.field": [],
-        "debug": "timing"
     }
+    if resolve_search_engine_debug(validated_data):
+        params["debug"] = "timing"
+        params["indent"] = "on"
     if q_text:
         params["q"] = q_text
+    fields = docs_fields(validated_data)
+    if validated_data.get("d_docs_score"):
+        # solr only returns the score asked for, federated score sorts merge the shards on it.
+        params["fl"] = ",".join((fields or ["*"]) + ["score"])
+    elif fields:
+        params["fl"] = ",".join(fields)
+    deadline = validated_data.get("deadline")
+    if deadline:
+        params["timeAllowed"] = deadline.engine_ms
 
     # query params for filters
-    filters = []
-    if q_time:
-        # TODO: when user sends incomplete dates like 2000, its completed: 2000-(TODAY-MONTH)-(TODAY-DAY)T00:00:00Z
-        # TODO: "Invalid Date in Date Math String:'[* TO 2000-12-05T00:00:00Z]'"
-        # Kotlin like: "{!field f=layer_date tag=layer_date}[* TO 2000-12-05T00:00:00Z]"
-        # then do it simple:
-        filters.append("{0}:{1}".format(TIME_FILTER_FIELD, q_time))
-    if q_geo:
-        filters.append("{0}:{1}".format(GEO_FILTER_FIELD, q_geo))
-    if q_user:
-        filters.append("{{!field f={0} tag={0}}}{1}".format(USER_FIELD, q_user))
+    filters = solr_filters(*solr_q_filters(validated_data))
     if filters: params["fq"] = filters
 
     # query params for ordering
@@ -103,21 +552,22 @@ def solr(serializer):
     elif d_docs_sort == 'time':
         params["sort"] = '{} desc'.format(TIME_SORT_FIELD)
     elif d_docs_sort == 'distance':
-        rectangle = parse_geo_box(q_geo)
+        min_lat, min_lon, max_lat, max_lon = query.q_geo or WORLD
         params["sort"] = 'geodist() asc'
         params["sfield"] = GEO_SORT_FIELD
-        params["pt"] = '{0},{1}'.format(rectangle.centroid.x, rectangle.centroid.y)
+        params["pt"] = '{0},{1}'.format((min_lat + max_lat) / 2.0, (min_lon + max_lon) / 2.0)
 
     # query params for facets
     if a_time_limit > 0:
         params["facet"] = 'on'
-        time_filter = a_time_filter or q_time or None
-        facet_parms = request_time_facet(TIME_FILTER_FIELD, time_filter, a_time_gap, a_time_limit)
+        start, end = query.a_time
+        facet_parms = time_facet_params(TIME_FILTER_FIELD, start, end, query.a_time_gap)
         params.update(facet_parms)
 
     if a_hm_limit > 0:
         params["facet"] = 'on'
-        hm_facet_params = request_heatmap_facet(GEO_HEATMAP_FIELD, a_hm_filter, a_hm_gridlevel, a_hm_limit)
+        hm_facet_params = heatmap_facet_params(GEO_HEATMAP_FIELD, a_hm_filter or WORLD_FILTER, query.a_hm,
+                                               a_hm_gridlevel, a_hm_limit)
         params.update(hm_facet_params)
 
     if a_text_limit > 0:
@@ -130,20 +580,85 @@ def solr(serializer):
         params["facet.field"].append("{{! ex={0}}}{0}".format(USER_FIELD))
         params["f.{}.facet.limit".format(USER_FIELD)] = a_user_limit
 
-    res = requests.get(
-        search_engine_endpoint, params=params
-    )
+    return params
+
+
+def solr(serializer):
+    """
+    Search on solr endpoint
+    :param serializer:
+    :return:
+    """
+    search_engine_endpoint = serializer.validated_data.get("search_engine_endpoint")
+    return_search_engine_original_response = serializer.validated_data.get("return_search_engine_original_response")
+    deadline = serializer.validated_data.get("deadline")
+    parallel_facets = serializer.validated_data.get("parallel_facets")
+    if parallel_facets is None:
+        parallel_facets = getattr(settings, "SEARCH_PARALLEL_FACETS", False)
+    solr_facet_api = resolve_solr_facet_api(serializer.validated_data)
+
+    with stage("params"):
+        params = solr_params(serializer.validated_data)
+
+    hm_plan, time_plan = solr_plans(serializer.validated_data, params)
 
-    print '>', res.url
+    with stage("upstream"):
+        if parallel_facets:
+            solr_response, timing, shared = solr_parallel(search_engine_endpoint, params, solr_facet_api, deadline)
+        else:
+            res, solr_response, shared = solr_fetch(search_engine_endpoint, params, solr_facet_api, deadline)
+            timing = solr_timing(res.elapsed, solr_response)
+            # the response may be shared, the url goes in a copy.
+            solr_response = dict(solr_response, solr_request=res.url)
 
-    solr_response = res.json()
-    solr_response["solr_request"] = res.url
+    annotate(upstream=solr_response["solr_request"], qtime=solr_response.get("responseHeader", {}).get("QTime"))
 
     if return_search_engine_original_response > 0:
-        return Response(solr_response)
+        return solr_response
 
-    # create the response dict following the swagger model:
-    data = {}
+    shaping = clock()
+    data = solr_data(serializer.validated_data, solr_response, timing, hm_plan, time_plan)
+    timing["pool"] = get_pool().stats()
+    timing["singleflight"] = dict(get_flights().stats(), shared=shared)
+    record("shape", shaping)
+
+    return data
+
+
+def solr_plans(validated_data, params):
+    """
+    The heatmap and time histogram cache plans of a solr search.
+    :return: (HeatmapPlan or None, TimeHistogramPlan or None), None when not cached.
+    """
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+    if validated_data.get("return_search_engine_original_response"):
+        return None, None
+    q_time, q_geo, q_user = solr_q_filters(validated_data)
+    q_filters = (q_time, q_geo, validated_data.get("q_text"), q_user)
+    heatmap_cache = get_heatmap_cache()
+    hm_plan = None
+    if validated_data.get("a_hm_limit") > 0 and heatmap_cache:
+        hm_plan = HeatmapPlan(heatmap_cache, ((search_engine_endpoint, GEO_HEATMAP_FIELD),) + q_filters, params)
+    time_cache = get_time_cache()
+    time_plan = None
+    if validated_data.get("a_time_limit") > 0 and time_cache:
+        time_plan = TimeHistogramPlan(time_cache, (search_engine_endpoint, TIME_FILTER_FIELD) + q_filters, params)
+    return hm_plan, time_plan
+
+
+def solr_data(validated_data, solr_response, timing, hm_plan=None, time_plan=None):
+    """
+    The search response following the swagger model out of the solr response and the cache plans.
+    Partial results (solr timeAllowed exceeded) are not cached.
+    :param timing: timing node of the solr request(s), the cache stats are added to it.
+    """
+    a_time_limit = validated_data.get("a_time_limit")
+    a_hm_limit = validated_data.get("a_hm_limit")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+
+    partial = bool(solr_response.get("responseHeader", {}).get("partialResults"))
+    data = {"partialResults": partial}
     response = solr_response["response"]
     data["a.matchDocs"] = response.get("numFound")
 
@@ -151,7 +666,12 @@ def solr(serializer):
         data["d.docs"] = response.get("docs")
 
     if a_time_limit > 0:
-        date_facet = solr_response["facet_counts"]["facet_ranges"][TIME_FILTER_FIELD]
+        if time_plan and time_plan.hit:
+            date_facet = time_plan.resolve(None)
+        else:
+            date_facet = solr_response["facet_counts"]["facet_ranges"][TIME_FILTER_FIELD]
+            if time_plan:
+                date_facet = time_plan.resolve(date_facet, store=not partial)
         a_time = {
             "start": date_facet.get("start"),
             "end": date_facet.get("end"),
@@ -162,7 +682,12 @@ def solr(serializer):
 
     if a_hm_limit > 0:
         # TODO: organize this
-        hm_facet = solr_response["facet_counts"]["facet_heatmaps"][GEO_HEATMAP_FIELD]
+        if hm_plan and hm_plan.hit:
+            hm_facet = hm_plan.resolve(None)
+        else:
+            hm_facet = solr_response["facet_counts"]["facet_heatmaps"][GEO_HEATMAP_FIELD]
+            if hm_plan:
+                hm_facet = hm_plan.resolve(hm_facet, store=not partial)
         data["a.hm"] = hm_facet
 
     if a_user_limit > 0:
@@ -173,37 +698,437 @@ def solr(serializer):
         text_facet = solr_response["facet_counts"]["facet_fields"][TEXT_FIELD]
         data["a.text"] = text_facet
 
-    subs = []
-    for label, values in solr_response["debug"]["timing"].iteritems():
-        if type(values) is not dict:
-            continue
-        subs_data = {"label": label, "subs": []}
-        for label, values in values.iteritems():
-            if type(values) is not dict:
-                subs_data["millis"] = values
-                continue
-            subs_data["subs"].append({
-                "label": label,
-                "millis": values.get("time")
-            })
-        subs.append(subs_data)
+    if hm_plan:
+        timing["heatmap_cache"] = dict(hm_plan.cache.stats(), hit=hm_plan.hit)
+    if time_plan:
+        timing["time_cache"] = dict(time_plan.cache.stats(), hit=time_plan.hit)
 
-    timing = {
-        "label": "requests.get.elapsed",
-        "millis": res.elapsed,
-        "subs": [{
-            "label": "QTime",
-            "millis": solr_response["responseHeader"].get("QTime"),
-            "subs": subs
-        }]
+    data["timing"] = timing
+
+    return data
+
+
+def solr_export(validated_data, page_size):
+    """
+    Pages through every matching doc with solr cursorMark, time descending.
+    Only one page is held in memory at a time.
+    https://cwiki.apache.org/confluence/display/solr/Pagination+of+Results
+    :return: generator of docs.
+    """
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+    q_text = validated_data.get("q_text")
+    params = {
+        "q": q_text or "*:*",
+        "wt": "json",
+        "rows": page_size,
+        "sort": "{0} desc,{1} asc".format(TIME_SORT_FIELD, ID_FIELD),
+        "cursorMark": "*",
     }
+    fields = docs_fields(validated_data)
+    if fields:
+        params["fl"] = ",".join(fields)
+    filters = solr_filters(*solr_q_filters(validated_data))
+    if filters:
+        params["fq"] = filters
 
-    data["timing"] = timing
+    while True:
+        res = get_pool().get(search_engine_endpoint, params=params)
+        res.raise_for_status()
+        solr_response = res.json()
+        docs = solr_response["response"].get("docs", [])
+        for doc in docs:
+            yield doc
+        next_cursor_mark = solr_response.get("nextCursorMark")
+        if not docs or next_cursor_mark is None or next_cursor_mark == params["cursorMark"]:
+            return
+        params["cursorMark"] = next_cursor_mark
+
+
+def elasticsearch_export(validated_data, page_size):
+    """
+    Pages through every matching doc with elasticsearch search_after, time descending.
+    Only one page is held in memory at a time.
+    https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-search-after.html
+    :return: generator of docs, the _source with its _id.
+    """
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+    body = {
+        "query": elasticsearch_query(validated_data),
+        "size": page_size,
+        "sort": [{TIME_SORT_FIELD: "desc"}, {ES_ID_FIELD: "asc"}],
+    }
+    fields = docs_fields(validated_data)
+    if fields:
+        body["_source"] = fields[1:]
+
+    while True:
+        res = get_pool().post(search_engine_endpoint, json=body)
+        res.raise_for_status()
+        hits = res.json()["hits"]["hits"]
+        for hit in hits:
+            doc = dict(hit.get("_source", {}))
+            doc[ES_ID_FIELD] = hit.get(ES_ID_FIELD)
+            yield doc
+        if len(hits) < page_size:
+            return
+        body["search_after"] = hits[-1]["sort"]
+
+
+def export_fields(validated_data):
+    """
+    The csv columns of an export: the id and d_docs_fields, else the SEARCH_EXPORT_FIELDS of the
+    search engine. Fixed, the docs are sparse and streamed, their keys are not known up front.
+    """
+    search_engine = validated_data.get("search_engine")
+    fields = docs_fields(validated_data)
+    if not fields:
+        return list(getattr(settings, "SEARCH_EXPORT_FIELDS", DEFAULT_EXPORT_FIELDS)[search_engine])
+    if search_engine == "elasticsearch":
+        return [ES_ID_FIELD] + fields[1:]
+    return fields
+
+
+def limit_docs(docs, limit):
+    for count, doc in enumerate(docs):
+        if limit and count >= limit:
+            return
+        yield doc
+
+
+class ShardQuery(object):
+    """
+    Stands for the serializer of one shard of a federated search: solr() and elasticsearch()
+    only read its validated_data.
+    """
+
+    def __init__(self, validated_data):
+        self.validated_data = validated_data
+
+
+def search_shard(search_engine, validated_data):
+    started = time.time()
+    try:
+        if search_engine == 'solr':
+            data = solr(ShardQuery(validated_data))
+        else:
+            data = elasticsearch(ShardQuery(validated_data))
+        return data, None, time.time() - started
+    except Exception as e:
+        return None, "{0}: {1}".format(type(e).__name__, e), time.time() - started
+
+
+def doc_sort_value(doc, field):
+    """
+    Value of field in a solr doc or an elasticsearch hit.
+    """
+    if field in doc:
+        return doc[field]
+    return doc.get("_source", {}).get(field)
+
+
+def federated(serializer):
+    """
+    Runs the search concurrently on search_engine_endpoint and every search_engine_shards
+    entry, solr and elasticsearch can be mixed, and merges the results: match counts and
+    time buckets are summed, heatmaps added cell by cell, user/text facets merged as top-k
+    and docs merge sorted by d_docs_sort. Failed shards are left out and reported in timing.
+    """
+    validated_data = dict(serializer.validated_data)
+    shards = [(validated_data.get("search_engine"), validated_data.get("search_engine_endpoint"))]
+    shards.extend(validated_data.get("search_engine_shards"))
+    validated_data["search_engine_shards"] = []
+    if validated_data.get("d_docs_sort") == 'score' and validated_data.get("q_text"):
+        validated_data["d_docs_score"] = True
+
+    # every shard shares the compiled query, so they bucket the same resolved time range.
+
+    started = time.time()
+    workers = min(len(shards), getattr(settings, "SEARCH_FEDERATED_WORKERS", DEFAULT_FEDERATED_WORKERS))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [
+            executor.submit(search_shard, search_engine,
+                            dict(validated_data, search_engine=search_engine, search_engine_endpoint=endpoint))
+            for search_engine, endpoint in shards
+        ]
+        results = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False)
+
+    shard_timings = []
+    responses = []
+    for (search_engine, endpoint), (data, error, elapsed) in zip(shards, results):
+        shard_timing = {"label": endpoint, "engine": search_engine,
+                        "millis": millis(elapsed), "subs": []}
+        if error:
+            shard_timing["error"] = error
+        else:
+            responses.append(data)
+            if "timing" in data:
+                shard_timing["subs"].append(data["timing"])
+        shard_timings.append(shard_timing)
+
+    data = {
+        "a.matchDocs": sum(response.get("a.matchDocs") or 0 for response in responses),
+        # failed shards are missing from the results too.
+        "partialResults": len(responses) < len(shards) or any(
+            response.get("partialResults") for response in responses),
+    }
+
+    time_facets = [response["a.time"] for response in responses if "a.time" in response]
+    if time_facets:
+        data["a.time"] = merge_time(time_facets)
+
+    heatmaps = [response["a.hm"] for response in responses if "a.hm" in response]
+    if heatmaps:
+        data["a.hm"], skipped = merge_heatmaps(heatmaps)
+        if skipped:
+            data["a.hm.skipped"] = len(skipped)
+
+    for key, limit in (("a.user", validated_data.get("a_user_limit")),
+                       ("a.text", validated_data.get("a_text_limit"))):
+        facets = [response[key] for response in responses if key in response]
+        if facets:
+            data[key] = merge_counts(facets, limit)
+
+    d_docs_sort = validated_data.get("d_docs_sort")
+    if d_docs_sort == 'time':
+        sort_key, reverse = lambda doc: doc_sort_value(doc, TIME_SORT_FIELD), True
+    elif d_docs_sort == 'score' and validated_data.get("q_text"):
+        sort_key, reverse = lambda doc: doc.get("score", doc.get("_score")), True
+    else:
+        # distances are not returned by the shards, keep their order interleaved.
+        sort_key, reverse = None, False
+    docs = merge_docs([response["d.docs"] for response in responses if response.get("d.docs")],
+                      sort_key, reverse, validated_data.get("d_docs_limit"))
+    if docs:
+        data["d.docs"] = docs
+
+    data["timing"] = {
+        "label": "federated.elapsed",
+        "millis": millis(time.time() - started),
+        "subs": shard_timings,
+        "shards": len(shards),
+        "failed": len(shards) - len(responses),
+    }
+    return data
+
+
+def fetch_heatmap(validated_data):
+    """
+    Only the a.hm facet of a validated search, without docs nor the other facets.
+    :return: (solr format heatmap facet, True when its rows are web mercator tiles)
+    """
+    validated_data = dict(validated_data, d_docs_limit=0, a_time_limit=0, a_text_limit=0, a_user_limit=0)
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+
+    if validated_data.get("search_engine") == 'solr':
+        res, solr_response, shared = solr_fetch(search_engine_endpoint, solr_params(validated_data),
+                                                resolve_solr_facet_api(validated_data), validated_data.get("deadline"))
+        return solr_response["facet_counts"]["facet_heatmaps"][GEO_HEATMAP_FIELD], False
+
+    body, time_facet, hm_grid = elasticsearch_body(validated_data)
+    res, es_response, shared = fetch_json(search_engine_endpoint, json_body=body,
+                                          deadline=validated_data.get("deadline"))
+    return elasticsearch_heatmap_facet(es_response["aggregations"]["a.hm"]["agg"]["buckets"], hm_grid), True
+
+
+def tile_heatmap(validated_data, z, x, y):
+    """
+    The heatmap facet of a map tile, searched like the a.hm of a search whose a.hm.filter is the tile box.
+    :return: (solr format heatmap facet, True when its rows are web mercator tiles)
+    """
+    hm_limit = validated_data.get("a_hm_limit") or getattr(
+        settings, "SEARCH_TILE_HEATMAP_CELLS", DEFAULT_TILE_HEATMAP_CELLS)
+    return fetch_heatmap(dict(validated_data, a_hm_limit=hm_limit, a_hm_filter=tile_geom(z, x, y),
+                              query=validated_data["query"].replace(a_hm=tile_box(z, x, y))))
+
+
+def heatmap_frame(validated_data, bucket):
+    """
+    The heatmap of one time bucket of the a.hm.time stack, None when the bucket is outside q.time.
+    """
+    query = validated_data["query"]
+    q_start, q_end = query.q_time or (None, None)
+    start, end = bucket
+    start, end = max(start, q_start or start), min(end, q_end or end)
+    if start >= end:
+        return None
+    # solr filters with the q_time string, end exclusive, elasticsearch with the compiled range, end inclusive.
+    q_time = "[{0}Z TO {1}Z}}".format(start.isoformat(), end.isoformat())
+    frame_query = query.replace(q_time=(start, end - datetime.timedelta(milliseconds=1)))
+    heatmap, mercator_rows = fetch_heatmap(dict(validated_data, q_time=q_time, query=frame_query))
+    return heatmap
+
+
+def heatmap_stack(validated_data, frames):
+    """
+    The a.hm.time stack: frames x rows x columns counts packed like the columnar a.hm, zlib
+    compressed and base64 encoded, with the grid of the frames. The "delta" encoding keeps the
+    first frame and then the difference of every frame from the previous one, mostly zeros
+    that compress well.
+    :param frames: the heatmap of every bucket of query.a_hm_time, as returned by heatmap_frame.
+    """
+    buckets = validated_data["query"].a_hm_time
+    grid_keys = ("gridLevel", "columns", "rows", "minX", "maxX", "minY", "maxY")
+    grids = [dict(pairs(frame)) for frame in frames if frame is not None]
+    stack = dict((key, grids[0][key]) for key in grid_keys) if grids else dict((key, None) for key in grid_keys)
+    if any(grid[key] != stack[key] for grid in grids for key in grid_keys):
+        raise ValueError("The a.hm.time frames came back on different grids")
+
+    counts = numpy.zeros((len(buckets), stack["rows"] or 0, stack["columns"] or 0), dtype=numpy.int64)
+    for position, frame in enumerate(frames):
+        if frame is not None:
+            counts[position] = heatmap_grid(dict(pairs(frame)).get("counts_ints2D"), stack["rows"], stack["columns"])
+    encoding = validated_data.get("a_hm_time_encoding") or "raw"
+    if encoding == "delta":
+        counts[1:] = numpy.diff(counts, axis=0)
+    buffer, stack["dtype"] = pack_grid(counts)
+
+    stack.update({
+        "start": buckets[0][0].isoformat() + 'Z',
+        "end": buckets[-1][1].isoformat() + 'Z',
+        "gap": validated_data.get("a_hm_time_gap"),
+        "frames": [start.isoformat() + 'Z' for start, end in buckets],
+        "shape": list(counts.shape),
+        "encoding": encoding,
+        "compression": "zlib",
+        "counts": base64.b64encode(zlib.compress(buffer)),
+    })
+    return stack
+
+
+def stream_upstream(res):
+    """
+    The raw upstream bytes, still compressed if they were, in chunks. Releases the connection at the end.
+    """
+    try:
+        for chunk in res.raw.stream(PASSTHROUGH_CHUNK_SIZE, decode_content=False):
+            yield chunk
+    finally:
+        res.close()
+
+
+def passthrough(serializer, accept_encoding=None):
+    """
+    Streams the original search engine response to the client without decoding it. The
+    upstream request url goes in the X-Search-Engine-Request header.
+    :param accept_encoding: the client Accept-Encoding, forwarded so compression is kept end to end.
+    :return: StreamingHttpResponse
+    """
+    validated_data = serializer.validated_data
+    search_engine_endpoint = validated_data.get("search_engine_endpoint")
+    headers = {"Accept-Encoding": accept_encoding or "identity"}
+    kwargs = {}
+    if validated_data.get("deadline"):
+        kwargs["timeout"] = validated_data["deadline"].timeout(get_pool().timeout[0])
+
+    if validated_data.get("search_engine") == 'solr':
+        params = solr_params(validated_data)
+        if resolve_solr_facet_api(validated_data) == "json":
+            params, specs = compile_json_facet(params, getattr(settings, "SEARCH_SOLR_JSON_FACET_OPTIONS", {}))
+        res = get_pool().get(search_engine_endpoint, params=params, headers=headers, stream=True, **kwargs)
+    else:
+        body, time_facet, hm_grid = elasticsearch_body(validated_data)
+        res = get_pool().post(search_engine_endpoint, json=body, headers=headers, stream=True, **kwargs)
+
+    response = StreamingHttpResponse(stream_upstream(res), status=res.status_code,
+                                     content_type=res.headers.get("Content-Type", "application/json"))
+    for header in ("Content-Encoding", "Content-Length"):
+        if header in res.headers:
+            response[header] = res.headers[header]
+    response["X-Search-Engine-Request"] = res.url
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Expose-Headers"] = "X-Search-Engine-Request"
+    return response
+
+
+def search_engine_label(validated_data):
+    if validated_data.get("search_engine_shards"):
+        return "federated"
+    return validated_data.get("search_engine")
+
+
+def search_facets_label(validated_data):
+    """
+    The a.* facets of a search, e.g. "time+hm+user", or "none".
+    """
+    facets = [name for name, limit in (("time", "a_time_limit"), ("hm", "a_hm_limit"), ("text", "a_text_limit"),
+                                       ("user", "a_user_limit")) if validated_data.get(limit) > 0]
+    if validated_data.get("a_hm_time_gap"):
+        facets.append("hm.time")
+    return "+".join(facets) or "none"
+
+
+def search(serializer):
+    """
+    Runs a validated SearchSerializer on its search engine(s) behind the response cache.
+    """
+    search_engine = serializer.validated_data.get("search_engine")
+    return_search_engine_original_response = serializer.validated_data.get(
+        "return_search_engine_original_response")
+
+    response_cache = get_response_cache()
+    key = None
+    data = None
+    if response_cache and not return_search_engine_original_response:
+        key = cache_key(serializer, response_cache.prefix)
+        data = response_cache.get(key)
+    cache_hit = data is not None
+
+    if not cache_hit:
+        # the a.hm.time frames are searched concurrently with the search itself.
+        buckets = serializer.validated_data["query"].a_hm_time
+        frames = None
+        if buckets and not return_search_engine_original_response and \
+                not serializer.validated_data.get("search_engine_shards"):
+            started = time.time()
+            frames = [get_executor().submit(heatmap_frame, serializer.validated_data, bucket) for bucket in buckets]
+
+        if serializer.validated_data.get("search_engine_shards"):
+            data = federated(serializer)
+        elif search_engine == 'solr':
+            data = solr(serializer)
+        else:
+            data = elasticsearch(serializer)
+
+        if frames:
+            data["a.hm.time"] = heatmap_stack(serializer.validated_data, [frame.result() for frame in frames])
+            data["timing"]["a.hm.time"] = {
+                "label": "a.hm.time.elapsed",
+                "millis": millis(time.time() - started),
+                "frames": len(frames),
+            }
+        if key and not data.get("partialResults"):
+            response_cache.set(key, search_engine, data)
+
+    if key:
+        # never mutate the cached entry, just report the cache state in a copy.
+        data = dict(data)
+        data["timing"] = dict(data.get("timing", {}))
+        data["timing"]["cache"] = dict(response_cache.stats(), hit=cache_hit)
 
     return data
 
 
+def search_batch_item(item, client=None):
+    """
+    :param client: the client of the batch, its default deadline applies to every item.
+    :return: the result of one batch item, {"status": 200, "data": ...} or its errors.
+    """
+    serializer = SearchSerializer(data=item, context={"client": client})
+    if not serializer.is_valid():
+        return {"status": 400, "errors": serializer.errors}
+    try:
+        return {"status": 200, "data": search(serializer)}
+    except DeadlineExceeded as e:
+        return {"status": 504, "errors": {"search_engine": [str(e)]}}
+    except Exception as e:
+        return {"status": 502, "errors": {"search_engine": ["{0}: {1}".format(type(e).__name__, e)]}}
+
+
 class Search(APIView):
+    renderer_classes = SEARCH_RENDERER_CLASSES
 
     def get(self, request):
         """
@@ -211,6 +1136,10 @@ class Search(APIView):
         The d. params control returning the documents. The a. params are faceting/aggregations on a field of the documents.
         The .limit params limit how many top values/docs to return. Some of the formatting and response structure
         has strong similarities with Apache Solr, unsurprisingly.
+        Besides json the response can be negotiated (Accept header or format=) as columnar json
+        (application/vnd.hhypermap.columnar+json) or MessagePack (application/x-msgpack): facets as parallel
+        labels/counts arrays, a.time buckets as epoch milliseconds and a.hm as a packed little endian buffer of the
+        smallest unsigned type (dtype) holding its counts.
         ---
         parameters:
         - name: search_engine
@@ -254,6 +1183,12 @@ class Search(APIView):
           required: false
           type: string
           paramType: query
+        - name: normalize_filters
+          in: query
+          description: When 1 q.time and q.geo are grown out to the server time and geo grids before searching solr, so nearby searches reuse its cached filters. Only for clients tolerating the looser filters. Defaults to the server setting.
+          required: false
+          type: integer
+          paramType: query
         - name: d_docs_limit
           description: How many documents to return.
           in: query
@@ -269,8 +1204,14 @@ class Search(APIView):
           paramType: query
           defaultValue: "score"
           enum: [ "score", "time", "distance" ]
+        - name: d_docs_fields
+          description: Comma separated fields of the documents to return, e.g. id,title,layer_date, sent as solr fl or elasticsearch _source. Defaults to every stored field. The id, and layer_date when sorting by time, are always returned.
+          in: query
+          required: false
+          type: string
+          paramType: query
         - name: a_time_limit
-          description: Non-0 triggers time/date range faceting. This value is the maximum number of time ranges to return when a.time.gap is unspecified. This is a soft maximum; less will usually be returned. A suggested value is 100. Note that a.time.gap effectively ignores this value. See Solr docs for more details on the query/response format.
+          description: Non-0 triggers time/date range faceting. This value is the maximum number of time ranges to return when a.time.gap is unspecified. This is a soft maximum; less will usually be returned. A suggested value is 100. The gap is then the finest natural one (e.g. 5 minutes, 1 hour, 1 day, 1 week, 1 month, 1 year, a decade) giving at most this many ranges, with the range snapped out to it. Elasticsearch counts 6 months and multiple years unlike solr, there the gap is at most 1 year. Note that a.time.gap effectively ignores this value. See Solr docs for more details on the query/response format.
           in: query
           required: false
           type: integer
@@ -313,6 +1254,20 @@ class Search(APIView):
           required: false
           type: string
           paramType: query
+        - name: a_hm_time_gap
+          description: Non-empty returns a.hm.time, a stack of heatmaps (frames x rows x columns), one per consecutive time interval of this gap over a.time.filter, q.time or otherwise 90 days, searched concurrently. Same ISO-8601 duration subset as a.time.gap. Needs a.hm.limit.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: a_hm_time_encoding
+          description: "How the a.hm.time counts are packed, a zlib compressed dtype little endian buffer (base64 in json): 'raw' frames or 'delta', every frame but the first as its difference from the previous one."
+          in: query
+          required: false
+          type: string
+          paramType: query
+          defaultValue: "raw"
+          enum: [ "raw", "delta" ]
         - name: a_text_limit
           description: "Returns the most frequently occurring words. WARNING: There is usually a significant performance hit in this due to the extremely high cardinality."
           in: query
@@ -328,30 +1283,398 @@ class Search(APIView):
           paramType: query
           defaultValue: "0"
         - name: return_search_engine_original_response
-          description: Just for debugging purposes when 1 will return the original solr response.
+          description: Just for debugging purposes when 1 will stream the original search engine response as is, the search engine request url goes in the X-Search-Engine-Request header.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+          defaultValue: "0"
+        - name: search_engine_shards
+          description: "Federated search. More endpoints searched together with search_engine_endpoint as engine:url, e.g. solr:http://host:8983/solr/2016/select. Repeat the parameter for every shard."
+          in: query
+          required: false
+          type: string
+          paramType: query
+          allowMultiple: true
+        - name: parallel_facets
+          description: When 1 the docs and every facet are requested as concurrent sub requests. Defaults to the server setting.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: solr_facet_api
+          description: "How solr facets are requested: 'legacy' facet.* params or a single 'json' facet (JSON Facet API). Defaults to the server setting."
+          in: query
+          required: false
+          type: string
+          paramType: query
+          enum: [ "legacy", "json" ]
+        - name: search_engine_debug
+          description: When 1 solr is asked for indented responses with its debug=timing breakdown, in the timing of the response. Defaults to the server setting, off for lean upstream responses.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: deadline_ms
+          description: Time budget of the search in milliseconds, given to solr as timeAllowed and to elasticsearch as timeout, less some headroom. What they found by then is returned with partialResults true. Defaults to the budget of the X-Search-Client client, else the server one.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: X-Search-Client
+          description: Name of the calling client, whose default deadline applies.
+          in: header
+          required: false
+          type: string
+          paramType: header
+
+        responseMessages:
+          - code: 200
+            message: Search completed, partialResults tells whether the deadline cut it short.
+          - code: 400
+            message: Validation errors.
+          - code: 504
+            message: The search engine did not answer within the deadline.
+        """
+
+        serializer = SearchSerializer(data=request.GET, context={"client": request_client(request)})
+        with stage("validate"):
+            valid = serializer.is_valid(raise_exception=True)
+        if valid:
+            engine = search_engine_label(serializer.validated_data)
+            facets = search_facets_label(serializer.validated_data)
+            set_labels(engine=engine, facets=facets)
+            query = dict((name, value) for name, value in canonical_query(serializer) if value)
+            annotate(engine=engine, facets=facets, query=query, signature=query_signature(query))
+            if serializer.validated_data.get("return_search_engine_original_response") and \
+                    not serializer.validated_data.get("search_engine_shards"):
+                return passthrough(serializer, request.META.get("HTTP_ACCEPT_ENCODING"))
+
+            try:
+                data = search(serializer)
+            except DeadlineExceeded as e:
+                annotate(deadline_exceeded=True)
+                return Response({"search_engine": [str(e)]}, status=504, headers={'Access-Control-Allow-Origin': '*'})
+            annotate(partial=data.get("partialResults", False))
+            return Response(data, headers={'Access-Control-Allow-Origin': '*'})
+
+
+class Batch(APIView):
+
+    def post(self, request):
+        """
+        Runs many searches in one call, e.g. the charts of a small multiples view. The body is a
+        json array of objects with the same parameters as the search endpoint. They are validated
+        and searched concurrently, bounded by the server batch concurrency, and the response is an
+        array in the same order where every item has a status and either its data or its errors.
+        ---
+        parameters:
+        - name: body
+          description: 'Array of search parameter objects, e.g. [{"search_engine": "solr", "search_engine_endpoint": "http://54.221.223.91:8983/solr/hypermap2/select", "q_user": "bob"}]'
+          required: true
+          type: string
+          paramType: body
+
+        responseMessages:
+          - code: 200
+            message: Batch completed, see the status of every item.
+          - code: 400
+            message: The body is not an array or has too many items.
+        """
+
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"detail": "Expected a json array of search parameter objects."}, status=400)
+        max_items = getattr(settings, "SEARCH_BATCH_MAX_ITEMS", DEFAULT_BATCH_MAX_ITEMS)
+        if len(items) > max_items:
+            return Response({"detail": "A batch has at most {0} items.".format(max_items)}, status=400)
+
+        results = []
+        if items:
+            workers = min(len(items), getattr(settings, "SEARCH_BATCH_CONCURRENCY", DEFAULT_BATCH_CONCURRENCY))
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                client = request_client(request)
+                results = list(executor.map(search_batch_item, items, [client] * len(items)))
+            finally:
+                executor.shutdown(wait=False)
+
+        return Response(results, headers={'Access-Control-Allow-Origin': '*'})
+
+
+class Export(APIView):
+
+    def get(self, request):
+        """
+        Bulk doc retrieval. Documents come back sorted by time descending and are streamed
+        page by page from the search engine (solr cursorMark, elasticsearch search_after),
+        so memory stays flat whatever the number of matching documents.
+        ---
+        parameters:
+        - name: search_engine
+          description: Where will be running the search.
+          in: query
+          required: true
+          type: string
+          paramType: query
+          defaultValue: "elasticsearch"
+          enum: [ "solr", "elasticsearch" ]
+        - name: search_engine_endpoint
+          description: "Endpoint url (test in SOLR http://54.221.223.91:8983/solr/hypermap2/select)"
+          in: query
+          required: true
+          type: string
+          paramType: query
+          defaultValue: "http://52.41.158.6:9200/hypermap/_search"
+        - name: q_time
+          description: Constrains docs by time range. Either side can be '*' to signify open-ended. Otherwise it must be in either format as given in the example. UTC time zone is implied.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: q_geo
+          description: A rectangular geospatial filter in decimal degrees going from the lower-left to the upper-right. The coordinates are in lat,lon format.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: q_text
+          in: query
+          description: Constrains docs by keyword search query.
+          required: false
+          type: string
+          paramType: query
+        - name: q_user
+          in: query
+          description: Constrains docs by matching exactly a certain user
+          required: false
+          type: string
+          paramType: query
+        - name: normalize_filters
+          in: query
+          description: When 1 q.time and q.geo are grown out to the server time and geo grids before searching solr, so nearby searches reuse its cached filters. Only for clients tolerating the looser filters. Defaults to the server setting.
+          required: false
+          type: integer
+          paramType: query
+        - name: d_docs_limit
+          description: How many documents to export. 0 exports every matching document.
           in: query
           required: false
           type: integer
           paramType: query
           defaultValue: "0"
+        - name: d_docs_page_size
+          description: How many documents to fetch from the search engine per page.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: d_docs_fields
+          description: Comma separated fields of the documents to export, e.g. id,title,layer_date, also the csv columns. Defaults to every stored field and to the server csv columns of the search engine. The id is always exported.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: export_format
+          description: text/csv with a header row or newline delimited json.
+          in: query
+          required: false
+          type: string
+          paramType: query
+          defaultValue: "csv"
+          enum: [ "csv", "ndjson" ]
+
+        responseMessages:
+          - code: 200
+            message: Export streamed.
+          - code: 400
+            message: Validation errors.
+        """
+
+        serializer = ExportSerializer(data=request.GET)
+        with stage("validate"):
+            valid = serializer.is_valid(raise_exception=True)
+        if valid:
+            validated_data = serializer.validated_data
+            set_labels(engine=validated_data.get("search_engine"), facets="export")
+            page_size = validated_data.get("d_docs_page_size") or getattr(
+                settings, "SEARCH_EXPORT_PAGE_SIZE", DEFAULT_EXPORT_PAGE_SIZE)
+
+            if validated_data.get("search_engine") == 'solr':
+                docs = solr_export(validated_data, page_size)
+            else:
+                docs = elasticsearch_export(validated_data, page_size)
+            docs = limit_docs(docs, validated_data.get("d_docs_limit"))
+
+            export_format = validated_data.get("export_format")
+            encode, content_type = EXPORT_FORMATS[export_format]
+            rows = encode(docs, export_fields(validated_data)) if export_format == "csv" else encode(docs)
+            response = StreamingHttpResponse(rows, content_type=content_type)
+            response['Access-Control-Allow-Origin'] = '*'
+            return response
+
+
+class Tile(APIView):
+
+    def get(self, request, z, x, y, tile_format):
+        """
+        XYZ web mercator heatmap tile of the matching documents, rendered on the server: a 256x256
+        PNG, or with .bin the 256x256 counts as a row major little endian buffer whose unsigned
+        type is in the X-Heatmap-Dtype header. The counts come from a heatmap facet on the tile box.
+        Tiles carry Cache-Control and ETag headers.
+        ---
+        parameters:
+        - name: z
+          description: Zoom level.
+          required: true
+          type: integer
+          paramType: path
+        - name: x
+          description: Tile column, from the west.
+          required: true
+          type: integer
+          paramType: path
+        - name: y
+          description: Tile row, from the north.
+          required: true
+          type: integer
+          paramType: path
+        - name: search_engine
+          description: Where will be running the search.
+          in: query
+          required: true
+          type: string
+          paramType: query
+          defaultValue: "elasticsearch"
+          enum: [ "solr", "elasticsearch" ]
+        - name: search_engine_endpoint
+          description: "Endpoint url (test in SOLR http://54.221.223.91:8983/solr/hypermap2/select)"
+          in: query
+          required: true
+          type: string
+          paramType: query
+          defaultValue: "http://52.41.158.6:9200/hypermap/_search"
+        - name: q_time
+          description: Constrains docs by time range. Either side can be '*' to signify open-ended. Otherwise it must be in either format as given in the example. UTC time zone is implied.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: q_geo
+          description: A rectangular geospatial filter in decimal degrees going from the lower-left to the upper-right. The coordinates are in lat,lon format.
+          in: query
+          required: false
+          type: string
+          paramType: query
+        - name: q_text
+          in: query
+          description: Constrains docs by keyword search query.
+          required: false
+          type: string
+          paramType: query
+        - name: q_user
+          in: query
+          description: Constrains docs by matching exactly a certain user
+          required: false
+          type: string
+          paramType: query
+        - name: normalize_filters
+          in: query
+          description: When 1 q.time and q.geo are grown out to the server time and geo grids before searching solr, so nearby searches reuse its cached filters. Only for clients tolerating the looser filters. Defaults to the server setting.
+          required: false
+          type: integer
+          paramType: query
+        - name: a_hm_limit
+          description: Soft maximum on the number of heatmap cells fetched for the tile. Defaults to the server setting.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: a_hm_gridlevel
+          description: To explicitly specify the grid level of the tile heatmap. Ignores a.hm.limit.
+          in: query
+          required: false
+          type: integer
+          paramType: query
+        - name: max_count
+          description: Count of the hottest colour, the tile maximum by default. Give neighbouring tiles the same value so their colours match.
+          in: query
+          required: false
+          type: integer
+          paramType: query
 
         responseMessages:
           - code: 200
-            message: Search completed.
+            message: Tile rendered.
+          - code: 304
+            message: Not modified since the ETag given in If-None-Match.
           - code: 400
             message: Validation errors.
+          - code: 404
+            message: No such tile.
         """
 
-        serializer = SearchSerializer(data=request.GET)
-        if serializer.is_valid(raise_exception=True):
+        z, x, y = int(z), int(x), int(y)
+        if not is_tile(z, x, y):
+            return Response({"detail": "No tile {0}/{1}/{2}.".format(z, x, y)}, status=404)
 
-            search_engine = serializer.validated_data.get("search_engine")
+        serializer = TileSerializer(data=request.GET)
+        with stage("validate"):
+            valid = serializer.is_valid(raise_exception=True)
+        if valid:
+            set_labels(engine=serializer.validated_data.get("search_engine"), facets="tile")
+            heatmap, mercator_rows = tile_heatmap(serializer.validated_data, z, x, y)
+            counts = resample(heatmap, z, x, y, mercator_rows=mercator_rows)
+            headers = {}
+            if tile_format == "png":
+                body = encode_png(colorize(counts, serializer.validated_data.get("max_count")))
+                content_type = "image/png"
+            else:
+                body, headers["X-Heatmap-Dtype"] = pack_grid(counts)
+                headers["X-Heatmap-Size"] = "{0}x{0}".format(TILE_SIZE)
+                content_type = "application/octet-stream"
 
-            if search_engine == 'solr':
-                data = solr(serializer)
+            etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+            if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+                response = HttpResponseNotModified()
             else:
-                data = elasticsearch(serializer)
-            return Response(data, headers={'Access-Control-Allow-Origin': '*'})
+                response = HttpResponse(body, content_type=content_type)
+                for header, value in headers.items():
+                    response[header] = value
+            response["ETag"] = etag
+            response["Cache-Control"] = "public, max-age={0}".format(
+                getattr(settings, "SEARCH_TILE_MAX_AGE", DEFAULT_TILE_MAX_AGE))
+            response["Access-Control-Allow-Origin"] = "*"
+            response["Access-Control-Expose-Headers"] = "ETag, X-Heatmap-Dtype, X-Heatmap-Size"
+            return response
+
+
+class Metrics(APIView):
+
+    def get(self, request):
+        """
+        Latency histograms of the api request stages (validate, params, upstream, decode, shape, render
+        and total) by search engine and facets, and the counters of the replicated endpoints, in the
+        Prometheus text format.
+        ---
+        responseMessages:
+          - code: 200
+            message: Metrics in the Prometheus text format.
+        """
+        return HttpResponse(get_histograms().prometheus() + get_replica_router().prometheus(),
+                            content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
+class Replicas(APIView):
 
+    def get(self, request):
+        """
+        Health of the replicas of every endpoint in settings.SEARCH_REPLICAS: circuit breaker state,
+        error ratio, latency (ewma), requests in flight and hedges won, with the hedge delay and the
+        hedges and failovers of the endpoint.
+        ---
+        responseMessages:
+          - code: 200
+            message: One entry per replicated endpoint.
+        """
+        return Response(get_replica_router().stats())
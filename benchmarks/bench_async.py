@@ -0,0 +1,195 @@
+"""
+Throughput and latency of /api/search/ under concurrent load: the wsgi application on a fixed
+number of worker threads against the asynchronous server (hhypermap_searchlayers_api.async_server)
+in a single thread.
+
+    python -m benchmarks.bench_async [--latency 0.1] [--workers 8] [--concurrency 10 100 200] [--requests 1000]
+                                     [--query "a_time_limit=100&a_user_limit=50&d_docs_limit=10"]
+
+The stub engine, each server and the load generator run in their own processes. The stub
+answers after --latency seconds, like a loaded search engine, and the response cache is
+disabled, so every request waits on the upstream. The async server only helps while the
+searches mostly wait: once the api side cpu (decoding, shaping, rendering) saturates its
+thread, scale it out with processes like the wsgi workers.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+STUB = """
+import sys, time
+from benchmarks.stub_engine import StubEngine
+stub = StubEngine(latency=float(sys.argv[1])).start()
+print stub.solr_url
+sys.stdout.flush()
+while True:
+    time.sleep(3600)
+"""
+
+SETTINGS = """
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hhypermap_searchlayers_api.settings_api")
+import django
+django.setup()
+from django.conf import settings
+settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+settings.SEARCH_SINGLEFLIGHT = False
+settings.SEARCH_ENGINE_POOL = dict(settings.SEARCH_ENGINE_POOL, POOL_MAXSIZE=1000)
+settings.SEARCH_ASYNC = {"MAX_CLIENTS": 1000, "CURL": True}
+"""
+
+SYNC_SERVER = SETTINGS + """
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from hhypermap_searchlayers_api.wsgi_api import application
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    # worker threads, like the threads of the wsgi workers.
+    request_queue_size = 1024
+    workers = ThreadPoolExecutor(max_workers=int(sys.argv[2]))
+
+    def process_request(self, request, client_address):
+        self.workers.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+server = make_server("127.0.0.1", int(sys.argv[1]), application, PooledWSGIServer, QuietHandler)
+print "ready"
+sys.stdout.flush()
+server.serve_forever()
+"""
+
+ASYNC_SERVER = SETTINGS + """
+import logging, sys
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from hhypermap_searchlayers_api.async_server import application, poll_index_changes
+logging.getLogger("tornado.access").disabled = True
+HTTPServer(application).add_sockets(bind_sockets(int(sys.argv[1]), "127.0.0.1", backlog=1024))
+poll_index_changes()
+print "ready"
+sys.stdout.flush()
+IOLoop.current().start()
+"""
+
+LOAD = """
+import json, sys, time
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+url, concurrency, total = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+AsyncHTTPClient.configure(None, max_clients=concurrency)
+latencies = []
+errors = [0]
+
+
+@gen.coroutine
+def client(remaining):
+    http = AsyncHTTPClient()
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        started = time.time()
+        res = yield http.fetch(url, raise_error=False, request_timeout=120)
+        if res.code != 200:
+            errors[0] += 1
+        latencies.append((time.time() - started) * 1000)
+
+
+@gen.coroutine
+def run():
+    remaining = [total]
+    yield [client(remaining) for _ in range(concurrency)]
+
+started = time.time()
+IOLoop.current().run_sync(run)
+elapsed = time.time() - started
+latencies.sort()
+print json.dumps({
+    "rps": total / elapsed,
+    "p50": latencies[len(latencies) // 2],
+    "p99": latencies[int(len(latencies) * 0.99) - 1],
+    "errors": errors[0],
+})
+"""
+
+
+def free_port():
+    import socket
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def spawn(code, *args):
+    process = subprocess.Popen([sys.executable, "-c", code] + [str(arg) for arg in args],
+                               stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    ready = process.stdout.readline().strip()
+    if not ready:
+        raise RuntimeError("{0} exited with {1}".format(code.strip().splitlines()[-1], process.wait()))
+    return process, ready
+
+
+def load(url, concurrency, requests):
+    import json
+    output = subprocess.check_output([sys.executable, "-c", LOAD, url, str(concurrency), str(requests)])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.1, help="stub engine latency in seconds")
+    parser.add_argument("--workers", type=int, default=8, help="worker threads of the wsgi server")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 200])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--query", default="a_time_limit=100&a_user_limit=50&d_docs_limit=10",
+                        help="search params besides the engine, e.g. add a_hm_limit=1000 for a cpu bound search")
+    args = parser.parse_args()
+
+    stub, solr_url = spawn(STUB, args.latency)
+    query = "search_engine=solr&search_engine_endpoint={0}&{1}".format(solr_url, args.query)
+    servers = [
+        ("wsgi, {0} threads".format(args.workers), SYNC_SERVER, [args.workers]),
+        ("async, 1 thread", ASYNC_SERVER, []),
+    ]
+    print "stub latency {0} s, {1} requests per run".format(args.latency, args.requests)
+    print "{0:<20} {1:>12} {2:>10} {3:>10} {4:>10} {5:>8}".format(
+        "", "concurrency", "req/s", "p50 ms", "p99 ms", "errors")
+    try:
+        for label, code, extra in servers:
+            port = free_port()
+            server, ready = spawn(code, port, *extra)
+            try:
+                url = "http://127.0.0.1:{0}/api/search/?{1}".format(port, query)
+                load(url, 1, 20)  # warm up
+                for concurrency in args.concurrency:
+                    stats = load(url, concurrency, args.requests)
+                    print "{0:<20} {1:>12} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>8}".format(
+                        label, concurrency, stats["rps"], stats["p50"], stats["p99"], stats["errors"])
+            finally:
+                server.kill()
+                time.sleep(0.2)
+    finally:
+        stub.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Latency of /api/search/ under concurrent load when a fraction of the searches is pathological,
+without a deadline and with deadline_ms.
+
+    python -m benchmarks.bench_deadline [--requests 400] [--concurrency 8] [--slow-fraction 0.05]
+
+The local stub engine answers in --latency seconds, and the --slow-fraction of the requests in
+--slow-latency seconds, unless its timeAllowed / timeout cuts them short with partial results.
+The searches go through the django test client from --concurrency threads, the response cache
+disabled.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=3.0)
+    parser.add_argument("--slow-fraction", type=float, default=0.05)
+    parser.add_argument("--deadline-ms", type=int, default=500)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.test import Client
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_SINGLEFLIGHT = False
+    settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+    settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+    settings.SEARCH_DEADLINE = {"DEFAULT_MS": None}
+    stub = StubEngine(latency=args.latency, slow_latency=args.slow_latency, slow_fraction=args.slow_fraction).start()
+    query = dict(search_engine="solr", search_engine_endpoint=stub.solr_url, a_time_limit=100, a_user_limit=50,
+                 d_docs_limit=10)
+
+    def search(params):
+        started = time.time()
+        response = Client().get("/api/search/", params)
+        partial = response.status_code == 200 and response.data.get("partialResults")
+        return (time.time() - started) * 1000, response.status_code, partial
+
+    print "stub latency {0} s, {1:.0%} at {2} s, {3} requests from {4} threads".format(
+        args.latency, args.slow_fraction, args.slow_latency, args.requests, args.concurrency)
+    print "{0:<24} {1:>10} {2:>10} {3:>10} {4:>10} {5:>9} {6:>6}".format(
+        "", "req/s", "p50 ms", "p99 ms", "max ms", "partial", "504")
+    for label, params in [("no deadline", query),
+                          ("deadline_ms={0}".format(args.deadline_ms), dict(query, deadline_ms=args.deadline_ms))]:
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        started = time.time()
+        results = list(executor.map(search, [params] * args.requests))
+        elapsed = time.time() - started
+        executor.shutdown()
+        samples = sorted(millis for millis, status, partial in results)
+        print "{0:<24} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>9} {6:>6}".format(
+            label, len(results) / elapsed, samples[len(samples) // 2], samples[int(len(samples) * 0.99) - 1],
+            samples[-1], sum(1 for millis, status, partial in results if partial),
+            sum(1 for millis, status, partial in results if status == 504))
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Bytes moved and decode time of the upstream docs request per search, with the debug output and
+every stored field, lean, and lean with d_docs_fields, each uncompressed and gzipped.
+
+    python -m benchmarks.bench_docs_projection [--docs 100] [--fields id,title,layer_date] [--repeat 200]
+
+The local stub engine answers like solr and elasticsearch, gzipping the responses when compression
+is on. Wire bytes are what the engine sends, decode is gunzip plus json decoding, api is the whole
+/api/search/ request through the django test client, the response cache disabled.
+"""
+import argparse
+import json
+import time
+import zlib
+
+from benchmarks.common import measure, search_serializer, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--fields", default="id,title,layer_date")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    import requests
+    from django.conf import settings
+    from django.test import Client
+    from api import connections
+    from api.views import elasticsearch_body, solr_params
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_SINGLEFLIGHT = False
+    settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+    settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+    stub = StubEngine(compress=True).start()
+    modes = [
+        # solr only, elasticsearch has no debug output to drop.
+        ("debug, all fields", {"search_engine_debug": 1}),
+        ("lean, all fields", {}),
+        ("lean, " + args.fields, {"d_docs_fields": args.fields}),
+    ]
+
+    print "{0} docs, {1} repeats".format(args.docs, args.repeat)
+    print "{0:<14} {1:<36} {2:>6} {3:>12} {4:>12} {5:>10} {6:>10}".format(
+        "", "", "gzip", "wire bytes", "json bytes", "decode ms", "api ms")
+    for search_engine, endpoint in (("solr", stub.solr_url), ("elasticsearch", stub.es_url)):
+        for label, extra in modes[search_engine == "elasticsearch":]:
+            params = dict(search_engine=search_engine, search_engine_endpoint=endpoint, d_docs_limit=args.docs,
+                          d_docs_sort="time", **extra)
+            validated_data = search_serializer(**params).validated_data
+            for compression in (False, True):
+                headers = {"Accept-Encoding": "gzip" if compression else "identity"}
+                if search_engine == "solr":
+                    send = lambda: requests.get(endpoint, params=solr_params(validated_data), headers=headers,
+                                                stream=True)
+                else:
+                    body = elasticsearch_body(validated_data)[0]
+                    send = lambda: requests.post(endpoint, json=body, headers=headers, stream=True)
+                raw = send().raw.read(decode_content=False)
+
+                def decode():
+                    json.loads(zlib.decompress(raw, 16 + zlib.MAX_WBITS) if compression else raw)
+
+                settings.SEARCH_ENGINE_POOL = dict(settings.SEARCH_ENGINE_POOL, COMPRESSION=compression)
+                connections._pool = None
+                client = Client()
+                api = measure(lambda: client.get("/api/search/", params), repeat=args.repeat)
+                text = zlib.decompress(raw, 16 + zlib.MAX_WBITS) if compression else raw
+                print "{0:<14} {1:<36} {2:>6} {3:>12} {4:>12} {5:>10.3f} {6:>10.2f}".format(
+                    search_engine, label, "on" if compression else "off", len(raw), len(text),
+                    measure(decode, repeat=args.repeat)["p50"], api["p50"])
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Heatmap grid cache over a simulated pan and zoom session: solr requests avoided, hit
+ratio, bytes held and the time to answer from the cache.
+
+    python -m benchmarks.bench_heatmap_cache [--steps 500]
+
+Solr is modelled in process by a quad tree heatmap (level L has 2^L x 2^L cells over the
+world, distErr picks the first level whose cells are at most that wide), so the numbers
+count the requests and cells that would have reached solr.
+"""
+import argparse
+import math
+import random
+import time
+
+from benchmarks.common import search_serializer, setup_django
+
+FINEST_LEVEL = 9
+
+
+def quad_tree_solr(world):
+    from api.utils import parse_lat_lon_box
+
+    def heatmap(params):
+        if "facet.heatmap.gridLevel" in params:
+            level = int(params["facet.heatmap.gridLevel"])
+        else:
+            dist_err = float(params["facet.heatmap.distErr"])
+            level = next((level for level in range(1, FINEST_LEVEL) if 360.0 / 2 ** level <= dist_err),
+                         FINEST_LEVEL)
+        ratio = 2 ** (FINEST_LEVEL - level)
+        grid = world.reshape(2 ** level, ratio, 2 ** level, ratio).sum(axis=(1, 3))
+        width, height = 360.0 / 2 ** level, 180.0 / 2 ** level
+        min_lat, min_lon, max_lat, max_lon = parse_lat_lon_box(params["facet.heatmap.geom"])
+        column, end_column = int(math.floor((min_lon + 180) / width)), int(math.ceil((max_lon + 180) / width))
+        row, end_row = int(math.floor((90 - max_lat) / height)), int(math.ceil((90 - min_lat) / height))
+        counts = [values if any(values) else None for values in grid[row:end_row, column:end_column].tolist()]
+        return ["gridLevel", level, "columns", end_column - column, "rows", end_row - row,
+                "minX", -180.0 + column * width, "maxX", -180.0 + end_column * width,
+                "minY", 90.0 - end_row * height, "maxY", 90.0 - row * height, "counts_ints2D", counts]
+    return heatmap
+
+
+def session(steps, seed=7):
+    """
+    Viewports of a user panning by a fraction of the view and sometimes zooming.
+    """
+    rng = random.Random(seed)
+    lat, lon, span = 20.0, 0.0, 40.0
+    for _ in range(steps):
+        if rng.random() < 0.15:
+            span = min(160.0, max(5.0, span * rng.choice([0.5, 2.0])))
+        lat = min(80.0 - span / 4, max(-80.0 + span / 4, lat + rng.uniform(-0.2, 0.2) * span / 2))
+        lon = min(175.0 - span / 2, max(-175.0 + span / 2, lon + rng.uniform(-0.2, 0.2) * span))
+        yield "[{0},{1} TO {2},{3}]".format(lat - span / 4, lon - span / 2, lat + span / 4, lon + span / 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=1000, help="a_hm_limit of every viewport")
+    args = parser.parse_args()
+
+    setup_django()
+    import numpy
+    from api import views
+    from api.federation import pairs
+    from api.heatmap_cache import HeatmapCache, HeatmapPlan
+
+    numpy.random.seed(1)
+    solr = quad_tree_solr(numpy.random.randint(0, 3, size=(2 ** FINEST_LEVEL, 2 ** FINEST_LEVEL)))
+    cache = HeatmapCache()
+    filters = (("http://localhost:8983/solr/hypermap/select", views.GEO_HEATMAP_FIELD), None, None, None, None)
+    solr_requests, solr_cells, direct_cells, mismatches, hit_seconds = 0, 0, 0, 0, 0.0
+    for hm_filter in session(args.steps):
+        params = views.solr_params(search_serializer(
+            search_engine="solr", search_engine_endpoint=filters[0][0], a_hm_limit=args.limit,
+            a_hm_filter=hm_filter).validated_data)
+        direct = solr(dict(params))
+        direct_cells += dict(pairs(direct))["rows"] * dict(pairs(direct))["columns"]
+
+        started = time.time()
+        plan = HeatmapPlan(cache, filters, params)
+        if plan.hit:
+            heatmap = plan.resolve(None)
+            hit_seconds += time.time() - started
+        else:
+            fetched = solr(params)
+            solr_requests += 1
+            solr_cells += dict(pairs(fetched))["rows"] * dict(pairs(fetched))["columns"]
+            heatmap = plan.resolve(fetched)
+        mismatches += heatmap != direct
+
+    stats = cache.stats()
+    print "{0} viewports, a_hm_limit {1}".format(args.steps, args.limit)
+    print "solr requests          {0:>10} (without the cache {1})".format(solr_requests, args.steps)
+    print "cells from solr        {0:>10} (without the cache {1})".format(solr_cells, direct_cells)
+    print "hit ratio              {0:>10.3f}".format(stats["hit_ratio"])
+    print "bytes held             {0:>10} in {1} blocks".format(stats["bytes"], stats["blocks"])
+    print "mean ms per hit        {0:>10.3f}".format(hit_seconds * 1000 / max(1, stats["hits"]))
+    print "responses not matching solr: {0}".format(mismatches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+A heatmap animation: one search per time slice, as browsers do it, versus a single search
+with a_hm_time_gap whose frames are searched concurrently on the server.
+
+    python -m benchmarks.bench_heatmap_stack [--frames 24 --latency 0.02]
+
+Against the local stub engine, which answers every request after --latency seconds.
+"""
+import argparse
+import datetime
+
+from benchmarks.common import measure, report, search_serializer, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub engine seconds per request")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+    import json
+    from django.conf import settings
+    from api import views
+    from api.connections import get_pool
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_RESPONSE_CACHE = dict(settings.SEARCH_RESPONSE_CACHE, ENABLED=False)
+    settings.SEARCH_HEATMAP_CACHE = dict(settings.SEARCH_HEATMAP_CACHE, ENABLED=False)
+    settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+    stub = StubEngine(latency=args.latency).start()
+    start = datetime.datetime(2015, 1, 1)
+    query = dict(search_engine="solr", search_engine_endpoint=stub.solr_url, a_hm_limit=1000)
+
+    def slice_time(position):
+        return "[{0} TO {1}]".format((start + datetime.timedelta(days=position)).isoformat(),
+                                     (start + datetime.timedelta(days=position + 1)).isoformat())
+
+    slices = [search_serializer(q_time=slice_time(position), **query) for position in range(args.frames)]
+    stacks = dict((encoding, search_serializer(
+        q_time="[{0} TO {1}]".format(start.isoformat(), (start + datetime.timedelta(days=args.frames)).isoformat()),
+        a_hm_time_gap="P1D", a_hm_time_encoding=encoding, **query)) for encoding in ("raw", "delta"))
+
+    print "json bytes: {0} searches {1}, a.hm.time raw {2}, delta {3}".format(
+        args.frames, sum(len(json.dumps(views.search(serializer), default=str)) for serializer in slices),
+        len(json.dumps(views.search(stacks["raw"]), default=str)),
+        len(json.dumps(views.search(stacks["delta"]), default=str)))
+    report("{0} heatmap frames, {1} s per upstream request".format(args.frames, args.latency), [
+        ("one search per frame", measure(lambda: [views.search(serializer) for serializer in slices],
+                                         repeat=args.repeat, warmup=1)),
+        ("a_hm_time_gap", measure(lambda: views.search(stacks["raw"]), repeat=args.repeat, warmup=1)),
+    ])
+    get_pool().close()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
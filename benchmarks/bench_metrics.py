@@ -0,0 +1,58 @@
+"""
+Cost of the per stage timings on /api/search/: without the timing middleware, with
+SEARCH_METRICS disabled and enabled, and the Server-Timing header of a search.
+
+    python -m benchmarks.bench_metrics [--repeat 300]
+
+The searches go through the django test client to the local stub engine with every facet,
+the response cache disabled, so every request runs all the stages.
+"""
+import argparse
+
+from benchmarks.common import measure, report, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=300)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.test import Client
+    from django.test.utils import override_settings
+    from api.connections import get_pool
+    from api.metrics import get_histograms
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_SINGLEFLIGHT = False
+    settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+    settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+    stub = StubEngine().start()
+    query = dict(search_engine="solr", search_engine_endpoint=stub.solr_url, q_time="[2013-01-01 TO 2016-01-01]",
+                 a_time_limit=100, a_hm_limit=1000, a_user_limit=50, a_text_limit=50, d_docs_limit=10)
+    without_middleware = [name for name in settings.MIDDLEWARE_CLASSES if name != "api.metrics.TimingMiddleware"]
+
+    modes = [
+        ("without the middleware", dict(MIDDLEWARE_CLASSES=without_middleware)),
+        ("SEARCH_METRICS disabled", dict(SEARCH_METRICS={"ENABLED": False})),
+        ("SEARCH_METRICS enabled", dict(SEARCH_METRICS={"ENABLED": True})),
+    ]
+    rows = []
+    server_timing = None
+    for label, overrides in modes:
+        with override_settings(**overrides):
+            client = Client()  # a new handler loads the middleware with the overridden settings.
+            response = client.get("/api/search/", query)
+            server_timing = response.get("Server-Timing", server_timing)
+            rows.append((label, measure(lambda: client.get("/api/search/", query), repeat=args.repeat)))
+
+    report("GET /api/search/ with every facet, {0} requests each".format(args.repeat), rows)
+    print "Server-Timing: {0}".format(server_timing)
+    print "/api/metrics series lines: {0}".format(get_histograms().prometheus().count("_count{"))
+    get_pool().close()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
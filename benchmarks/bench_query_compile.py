@@ -0,0 +1,59 @@
+"""
+Per request parsing of the q.* and a.* strings: parsed again at every step (validation,
+time facet, heatmap facet, distance sort) versus parsed once into a CompiledQuery.
+
+    python -m benchmarks.bench_query_compile
+"""
+import argparse
+
+from benchmarks.common import measure, report, search_serializer, setup_django
+
+Q_TIME = "[2013-03-01 TO 2013-04-01T00:00:00]"
+Q_GEO = "[-10.5,-20.25 TO 30.125,40.5]"
+A_TIME_GAP = "P1D"
+A_HM_LIMIT = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from api import utils, views
+    from api.query import compile_query
+
+    def reparsed():
+        # what validation and the solr param building parsed before the CompiledQuery.
+        utils.parse_datetime_range(Q_TIME)
+        utils.parse_geo_box(Q_GEO)
+        utils.parse_datetime_range(Q_TIME)
+        utils.request_time_facet(views.TIME_FILTER_FIELD, Q_TIME, A_TIME_GAP, 100)
+        utils.request_heatmap_facet(views.GEO_HEATMAP_FIELD, Q_GEO, None, A_HM_LIMIT)
+        utils.parse_geo_box(Q_GEO).centroid
+
+    def compiled():
+        q_time = utils.parse_datetime_range(Q_TIME)
+        q_geo = utils.parse_lat_lon_box(Q_GEO)
+        query = compile_query(q_time=q_time, q_geo=q_geo, a_time_limit=100, a_time_filter=q_time,
+                              a_time_gap=utils.parse_ISO8601(A_TIME_GAP), a_hm_limit=A_HM_LIMIT, a_hm_filter=q_geo)
+        start, end = query.a_time
+        utils.time_facet_params(views.TIME_FILTER_FIELD, start, end, query.a_time_gap)
+        utils.heatmap_facet_params(views.GEO_HEATMAP_FIELD, Q_GEO, query.a_hm, None, A_HM_LIMIT)
+
+    def serializer_and_params():
+        serializer = search_serializer(
+            search_engine="solr", search_engine_endpoint="http://localhost:8983/solr/hypermap/select",
+            q_time=Q_TIME, q_geo=Q_GEO, a_time_filter=Q_TIME, a_time_gap=A_TIME_GAP, a_time_limit=100,
+            a_hm_limit=A_HM_LIMIT, a_hm_filter=Q_GEO, d_docs_sort="distance")
+        views.solr_params(serializer.validated_data)
+
+    report("query string parsing per request, {0} requests".format(args.repeat), [
+        ("parsed at every step", measure(reparsed, repeat=args.repeat)),
+        ("parsed once, CompiledQuery", measure(compiled, repeat=args.repeat)),
+        ("SearchSerializer + solr_params", measure(serializer_and_params, repeat=args.repeat)),
+    ])
+
+
+if __name__ == "__main__":
+    main()
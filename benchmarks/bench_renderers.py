@@ -0,0 +1,84 @@
+"""
+Payload size and serialization time of a search response rendered as json (the default),
+columnar json and MessagePack.
+
+    python -m benchmarks.bench_renderers [--columns 256 --rows 128 --buckets 1000]
+
+The response is synthetic, shaped like a solr one: a heatmap grid with null rows, time
+buckets, user/text facets and a few docs. Decoding is measured with json.loads and
+msgpack.unpackb, the closest server side stand-in for the client parse.
+"""
+import argparse
+import datetime
+import json
+import random
+
+from benchmarks.common import measure, report, setup_django
+
+
+def search_response(columns, rows, buckets, terms=100, docs=10):
+    rng = random.Random(42)
+    grid = []
+    for _ in range(rows):
+        if rng.random() < 0.3:
+            grid.append(None)
+        else:
+            grid.append([rng.randint(0, 5000) if rng.random() < 0.5 else 0 for _ in range(columns)])
+    start = datetime.datetime(2013, 1, 1)
+    counts = []
+    for bucket in range(buckets):
+        counts.extend([(start + datetime.timedelta(days=bucket)).isoformat() + "Z", rng.randint(0, 10000)])
+
+    def facet(prefix):
+        alternating = []
+        for term in range(terms):
+            alternating.extend([u"{0}{1}".format(prefix, term), rng.randint(0, 10000)])
+        return alternating
+
+    return {
+        "a.matchDocs": 123456,
+        "d.docs": [{u"id": u"doc{0}".format(doc), u"title": u"layer {0}".format(doc),
+                    u"layer_date": u"2014-02-0{0}T00:00:00Z".format(doc % 9 + 1)} for doc in range(docs)],
+        "a.time": {"start": "2013-01-01T00:00:00Z", "end": counts[-2], "gap": "+1DAYS", "counts": counts},
+        "a.hm": ["gridLevel", 5, "columns", columns, "rows", rows, "minX", -180.0, "maxX", 180.0,
+                 "minY", -90.0, "maxY", 90.0, "counts_ints2D", grid],
+        "a.user": facet(u"user"),
+        "a.text": facet(u"word"),
+        "timing": {"label": "requests.get.elapsed", "millis": datetime.timedelta(milliseconds=42)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--rows", type=int, default=128)
+    parser.add_argument("--buckets", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    setup_django()
+    import msgpack
+    from rest_framework.renderers import JSONRenderer
+    from api.renderers import ColumnarJSONRenderer, MessagePackRenderer
+
+    data = search_response(args.columns, args.rows, args.buckets)
+    formats = [
+        ("json", JSONRenderer(), json.loads),
+        ("columnar json", ColumnarJSONRenderer(), json.loads),
+        ("msgpack", MessagePackRenderer(), lambda payload: msgpack.unpackb(payload, raw=False)),
+    ]
+    render_rows = []
+    decode_rows = []
+    for label, renderer, decode in formats:
+        payload = renderer.render(data)
+        print "{0:<20} {1:>10} bytes".format(label, len(payload))
+        render_rows.append((label, measure(lambda: renderer.render(data), repeat=args.repeat)))
+        decode_rows.append((label, measure(lambda: decode(payload), repeat=args.repeat)))
+
+    report("render, {0}x{1} heatmap and {2} time buckets".format(args.columns, args.rows, args.buckets),
+           render_rows)
+    report("decode", decode_rows)
+
+
+if __name__ == "__main__":
+    main()
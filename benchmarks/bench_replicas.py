@@ -0,0 +1,81 @@
+"""
+Latency of /api/search/ under concurrent load against one endpoint and against replicas of it,
+without and with hedged requests, and with one replica dead.
+
+    python -m benchmarks.bench_replicas [--requests 400] [--concurrency 8] [--slow-fraction 0.05]
+
+Every replica is a local stub engine answering in --latency seconds, and a random --slow-fraction
+of the requests in --slow-latency seconds, the tail of a garbage collection or a merge. The
+searches go through the django test client from --concurrency threads, the response cache disabled.
+The dead replica refuses connections: its circuit breaker opens and the searches fail over.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--slow-fraction", type=float, default=0.05)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.test import Client
+    from api import replicas
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_SINGLEFLIGHT = False
+    settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+    settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+    settings.SEARCH_DEADLINE = {"DEFAULT_MS": None}
+    stubs = [StubEngine(latency=args.latency, slow_latency=args.slow_latency,
+                        slow_fraction=args.slow_fraction).start() for _ in range(args.replicas)]
+    endpoint = "http://index.invalid/solr/hypermap/select"
+    dead = "http://127.0.0.1:1/solr/hypermap/select"
+    query = dict(search_engine="solr", a_time_limit=100, a_user_limit=50, d_docs_limit=10)
+
+    def search(params):
+        started = time.time()
+        response = Client().get("/api/search/", params)
+        return (time.time() - started) * 1000, response.status_code
+
+    runs = [
+        ("one endpoint", stubs[0].solr_url, {}),
+        ("replicas", endpoint, {"INDEXES": {endpoint: [stub.solr_url for stub in stubs]}, "HEDGE_BUDGET": 0}),
+        ("replicas, hedged", endpoint, {"INDEXES": {endpoint: [stub.solr_url for stub in stubs]}}),
+        ("hedged, one dead", endpoint, {"INDEXES": {endpoint: [dead] + [stub.solr_url for stub in stubs]}}),
+    ]
+    print "{0} replicas at {1} s, {2:.0%} at {3} s, {4} requests from {5} threads".format(
+        args.replicas, args.latency, args.slow_fraction, args.slow_latency, args.requests, args.concurrency)
+    print "{0:<20} {1:>8} {2:>8} {3:>8} {4:>8} {5:>7} {6:>9} {7:>7}".format(
+        "", "req/s", "p50 ms", "p99 ms", "max ms", "errors", "hedges", "opened")
+    for label, search_engine_endpoint, replica_settings in runs:
+        settings.SEARCH_REPLICAS = replica_settings
+        replicas._router = None
+        params = dict(query, search_engine_endpoint=search_engine_endpoint)
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        started = time.time()
+        results = list(executor.map(search, [params] * args.requests))
+        elapsed = time.time() - started
+        executor.shutdown()
+        samples = sorted(millis for millis, status in results)
+        stats = replicas.get_replica_router().stats()
+        print "{0:<20} {1:>8.1f} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>7} {6:>9} {7:>7}".format(
+            label, len(results) / elapsed, samples[len(samples) // 2], samples[int(len(samples) * 0.99) - 1],
+            samples[-1], sum(1 for millis, status in results if status != 200),
+            sum(s["hedges"] for s in stats), sum(r["opened"] for s in stats for r in s["replicas"]))
+
+    for stub in stubs:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Legacy facet.* params versus a single JSON Facet API request for the same search.
+
+    python -m benchmarks.bench_solr_facets [--endpoint http://localhost:8983/solr/hypermap/select]
+
+Without --endpoint the local stub engine is used, which measures the api side only
+(param compiling, request size, decoding and shaping), the stub computes both in no time.
+Against a real solr the numbers include the single pass gain of the JSON Facet API.
+"""
+import argparse
+
+from benchmarks.common import measure, report, search_serializer, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--endpoint", help="solr select url, the local stub engine when missing")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from api import views
+    from api.connections import get_pool
+    from benchmarks.stub_engine import StubEngine
+
+    settings.SEARCH_SINGLEFLIGHT = False
+    stub = None
+    endpoint = args.endpoint
+    if not endpoint:
+        stub = StubEngine().start()
+        endpoint = stub.solr_url
+
+    query = dict(search_engine="solr", search_engine_endpoint=endpoint, q_time="[2013-01-01 TO 2016-01-01]",
+                 a_time_limit=100, a_hm_limit=1000, a_user_limit=50, a_text_limit=50, d_docs_limit=10)
+    rows = []
+    outputs = []
+    for facet_api in ("legacy", "json"):
+        serializer = search_serializer(solr_facet_api=facet_api, **query)
+        data = views.solr(serializer)
+        data.pop("timing")
+        outputs.append(data)
+        rows.append((facet_api, measure(lambda: views.solr(serializer), repeat=args.repeat)))
+
+    report("solr() with every facet, {0} requests each".format(args.repeat), rows)
+    print "identical a.* output:", outputs[0] == outputs[1]
+    get_pool().close()
+    if stub:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Solr filterCache hit rate of the q.* filters over dashboards polling "the last day" of a
+slightly moving viewport: raw filters, raw filters with the off grid ones uncached, and
+normalized filters.
+
+    python -m benchmarks.bench_solr_filters [--polls 5000] [--clients 50] [--size 512]
+
+Solr is modelled in process by an LRU filterCache of --size entries keyed by the fq string,
+fq with cache=false are computed without it, so the numbers count the filters solr would
+have computed.
+"""
+import argparse
+import datetime
+import random
+from collections import OrderedDict
+
+from benchmarks.common import search_serializer, setup_django
+
+
+class FilterCache(object):
+    """
+    solr.search.LRUCache of the filter queries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lookups = self.hits = self.evictions = self.uncached = 0
+
+    def filter(self, fq):
+        if "cache=false" in fq.partition("}")[0]:
+            self.uncached += 1
+            return
+        self.lookups += 1
+        if fq in self.entries:
+            self.hits += 1
+            self.entries[fq] = self.entries.pop(fq)
+            return
+        self.entries[fq] = True
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+def polls(count, clients, seed=3):
+    """
+    (q_time, q_geo) of dashboards polling every few seconds: the last day up to now, and the
+    client's viewport redrawn with float noise in the last decimals.
+    """
+    rng = random.Random(seed)
+    views = [(rng.uniform(-60, 60), rng.uniform(-170, 170), rng.choice([1.0, 5.0, 20.0])) for _ in range(clients)]
+    now = datetime.datetime(2016, 6, 1)
+    for _ in range(count):
+        now += datetime.timedelta(seconds=rng.randint(1, 5))
+        lat, lon, span = rng.choice(views)
+        noise = lambda: rng.uniform(-1e-5, 1e-5)
+        q_geo = "[{0:.6f},{1:.6f} TO {2:.6f},{3:.6f}]".format(
+            lat + noise(), lon + noise(), lat + span / 2 + noise(), lon + span + noise())
+        q_time = "[{0} TO {1}]".format((now - datetime.timedelta(days=1)).isoformat(), now.isoformat())
+        yield q_time, q_geo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--polls", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--size", type=int, default=512, help="filterCache entries, solr's default is 512")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test.utils import override_settings
+    from api import views
+
+    modes = [
+        ("raw", {"UNCACHED_OFF_GRID": False}, 0),
+        ("raw, off grid uncached", {}, 0),
+        ("normalized", {}, 1),
+    ]
+    print "{0} polls of {1} clients, filterCache of {2}".format(args.polls, args.clients, args.size)
+    print "{0:<24} {1:>9} {2:>10} {3:>10} {4:>10}".format("", "hit rate", "evictions", "uncached", "computed")
+    for label, filter_settings, normalize in modes:
+        cache = FilterCache(args.size)
+        with override_settings(SEARCH_SOLR_FILTERS=filter_settings):
+            for q_time, q_geo in polls(args.polls, args.clients):
+                validated_data = search_serializer(
+                    search_engine="solr", search_engine_endpoint="http://localhost:8983/solr/hypermap/select",
+                    q_time=q_time, q_geo=q_geo, q_user="user1", normalize_filters=normalize).validated_data
+                for fq in views.solr_filters(*views.solr_q_filters(validated_data)):
+                    cache.filter(fq)
+        print "{0:<24} {1:>9.3f} {2:>10} {3:>10} {4:>10}".format(
+            label, float(cache.hits) / max(1, cache.lookups), cache.evictions, cache.uncached,
+            cache.lookups - cache.hits + cache.uncached)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Worker startup and per request overhead of the api-only settings and wsgi entry point
+(hhypermap_searchlayers_api.wsgi_api) against the default ones (hhypermap_searchlayers_api.wsgi).
+
+    python -m benchmarks.bench_startup [--runs 5] [--repeat 500]
+
+Every run is a fresh python process calling the wsgi application directly: the time to
+import it, to answer the first request (the urlconf and views are imported then), and the
+mean of repeated GET /api/metrics (framework and middleware only) and of /api/search/
+against the local stub engine without facets.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+WSGI_MODULES = [
+    ("default settings", "hhypermap_searchlayers_api.wsgi"),
+    ("api-only settings", "hhypermap_searchlayers_api.wsgi_api"),
+]
+
+CHILD = """
+import json, sys, time
+from wsgiref.util import setup_testing_defaults
+
+started = time.time()
+application = __import__(sys.argv[1], fromlist=["application"]).application
+imported = time.time()
+
+
+def get(path, query=""):
+    environ = {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": "GET"}
+    setup_testing_defaults(environ)
+    body = b"".join(application(environ, lambda status, headers: None))
+    return body
+
+
+get("/api/metrics")
+first = time.time()
+
+from benchmarks.stub_engine import StubEngine
+from django.conf import settings
+settings.SEARCH_RESPONSE_CACHE = {"ENABLED": False}
+settings.SEARCH_SLOW_QUERY_LOG = {"ENABLED": False}
+stub = StubEngine().start()
+search = "search_engine=solr&search_engine_endpoint=" + stub.solr_url
+get("/api/search/", search)
+
+
+def mean_ms(path, query, repeat):
+    began = time.time()
+    for _ in range(repeat):
+        get(path, query)
+    return (time.time() - began) * 1000 / repeat
+
+repeat = int(sys.argv[2])
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_response_ms": (first - started) * 1000,
+    "metrics_ms": mean_ms("/api/metrics", "", repeat),
+    "search_ms": mean_ms("/api/search/", search, max(1, repeat // 5)),
+    "modules": len(sys.modules),
+}))
+stub.stop()
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    print "{0} processes each, mean of the runs".format(args.runs)
+    print "{0:<20} {1:>10} {2:>16} {3:>12} {4:>12} {5:>8}".format(
+        "", "import ms", "1st response ms", "metrics ms", "search ms", "modules")
+    for label, module in WSGI_MODULES:
+        runs = []
+        for _ in range(args.runs):
+            with open(os.devnull, "w") as devnull:
+                output = subprocess.check_output([sys.executable, "-c", CHILD, module, str(args.repeat)],
+                                                 stderr=devnull)
+            # the stub engine may print its shutdown errors after the results.
+            runs.append(json.loads(next(line for line in output.splitlines() if line.startswith("{"))))
+        mean = lambda key: sum(run[key] for run in runs) / float(len(runs))
+        print "{0:<20} {1:>10.1f} {2:>16.1f} {3:>12.3f} {4:>12.3f} {5:>8.0f}".format(
+            label, mean("import_ms"), mean("first_response_ms"), mean("metrics_ms"), mean("search_ms"),
+            mean("modules"))
+
+
+if __name__ == "__main__":
+    main()
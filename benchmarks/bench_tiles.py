@@ -0,0 +1,63 @@
+"""
+Server side rendering of a heatmap tile: resampling the facet grid to 256x256, colouring and
+PNG encoding, vectorized with numpy versus a per pixel python loop.
+
+    python -m benchmarks.bench_tiles [--cells 64]
+"""
+import argparse
+import random
+
+from benchmarks.common import measure, report, setup_django
+
+
+def heatmap_facet(cells):
+    rng = random.Random(42)
+    grid = [None if rng.random() < 0.2 else [rng.randint(0, 3000) for _ in range(cells)] for _ in range(cells)]
+    return ["gridLevel", 6, "columns", cells, "rows", cells, "minX", -180.0, "maxX", 0.0,
+            "minY", 0.0, "maxY", 85.0511287798066, "counts_ints2D", grid]
+
+
+def resample_loop(heatmap, z, x, y, size):
+    """
+    Reference per pixel implementation of api.tiles.resample.
+    """
+    import math
+    from api.federation import pairs
+    facet = dict(pairs(heatmap))
+    rows, columns, grid = facet["rows"], facet["columns"], facet["counts_ints2D"]
+    counts = []
+    for pixel_row in range(size):
+        lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + (pixel_row + 0.5) / size) / 2.0 ** z))))
+        row = int(math.floor((facet["maxY"] - lat) / (facet["maxY"] - facet["minY"]) * rows))
+        line = []
+        for pixel_column in range(size):
+            lon = (x + (pixel_column + 0.5) / size) / 2.0 ** z * 360.0 - 180.0
+            column = int(math.floor((lon - facet["minX"]) / (facet["maxX"] - facet["minX"]) * columns))
+            inside = 0 <= row < rows and 0 <= column < columns and grid[row] is not None
+            line.append(grid[row][column] if inside else 0)
+        counts.append(line)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cells", type=int, default=64, help="heatmap grid side")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    from api.tiles import TILE_SIZE, colorize, encode_png, resample
+
+    heatmap = heatmap_facet(args.cells)
+    assert resample(heatmap, 1, 0, 0).tolist() == resample_loop(heatmap, 1, 0, 0, TILE_SIZE)
+
+    report("tile 1/0/0 from a {0}x{0} heatmap, {1} tiles".format(args.cells, args.repeat), [
+        ("resample, python loop", measure(lambda: resample_loop(heatmap, 1, 0, 0, TILE_SIZE), repeat=args.repeat)),
+        ("resample, numpy", measure(lambda: resample(heatmap, 1, 0, 0), repeat=args.repeat)),
+        ("resample + colorize + png, numpy",
+         measure(lambda: encode_png(colorize(resample(heatmap, 1, 0, 0))), repeat=args.repeat)),
+    ])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Time histogram cache over a dashboard polling the default "last 90 days up to now" a.time:
+buckets solr has to count, hit ratio and the time to plan and stitch a response.
+
+    python -m benchmarks.bench_time_cache [--polls 1440] [--every 60]
+
+Solr is modelled in process by facet.range counts over documents indexed as time goes by
+(a document exists once its timestamp has passed), so the numbers count the buckets that
+would have been computed by solr.
+"""
+import argparse
+import datetime
+import time
+
+
+def range_solr(timestamps):
+    import numpy
+    from api.renderers import epoch_millis
+    from api.utils import parse_datetime, solr_gap_delta
+
+    def date_facet(params, now):
+        field = params["facet.range"]
+        prefix = "f.{0}.facet.range.".format(field)
+        gap = params[prefix + "gap"]
+        start, end = parse_datetime(params[prefix + "start"]), parse_datetime(params[prefix + "end"])
+        indexed = timestamps[:numpy.searchsorted(timestamps, epoch_millis(now), side="right")]
+        counts = []
+        while start < end:
+            bucket_end = min(start + solr_gap_delta(gap), end)
+            low, high = numpy.searchsorted(indexed, [epoch_millis(start), epoch_millis(bucket_end)])
+            counts += [start.isoformat() + 'Z', int(high - low)]
+            start += solr_gap_delta(gap)
+        return {"start": params[prefix + "start"], "end": params[prefix + "end"], "gap": gap, "counts": counts}
+    return date_facet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--polls", type=int, default=1440)
+    parser.add_argument("--every", type=int, default=60, help="seconds between polls")
+    parser.add_argument("--limit", type=int, default=100, help="a_time_limit of every poll")
+    args = parser.parse_args()
+
+    from benchmarks.common import setup_django
+    setup_django()
+    import numpy
+    from api import views
+    from api.query import resolve_time_facet
+    from api.time_cache import TimeHistogramCache, TimeHistogramPlan
+    from api.utils import time_facet_params
+
+    started_at = datetime.datetime(2016, 7, 1, 8, 30)
+    numpy.random.seed(1)
+    first = int((started_at - datetime.datetime(1970, 1, 1)).total_seconds() * 1000) - 120 * 86400 * 1000
+    timestamps = numpy.sort(numpy.random.randint(first, first + 122 * 86400 * 1000, size=200000))
+    solr = range_solr(timestamps)
+    cache = TimeHistogramCache()
+    filters = ("http://localhost:8983/solr/hypermap/select", views.TIME_FILTER_FIELD, None, None, None, None)
+
+    direct_buckets, mismatches, plan_seconds = 0, 0, 0.0
+    for poll in range(args.polls):
+        now = started_at + datetime.timedelta(seconds=poll * args.every)
+        (start, end), gap = resolve_time_facet(None, None, args.limit, now=now)
+        params = time_facet_params(views.TIME_FILTER_FIELD, start, end, gap)
+        direct = solr(dict(params), now)
+        direct_buckets += len(direct["counts"]) // 2
+
+        began = time.time()
+        plan = TimeHistogramPlan(cache, filters, params, now=now)
+        plan_seconds += time.time() - began
+        fetched = None if plan.hit else solr(params, now)
+        began = time.time()
+        date_facet = plan.resolve(fetched)
+        plan_seconds += time.time() - began
+        mismatches += date_facet["counts"] != direct["counts"] or date_facet["end"] != direct["end"]
+
+    stats = cache.stats()
+    print "{0} polls every {1}s, a_time_limit {2}, gap {3}".format(args.polls, args.every, args.limit, gap)
+    print "buckets from solr      {0:>10} (without the cache {1})".format(stats["fetched"], direct_buckets)
+    print "hit ratio              {0:>10.3f}".format(stats["hit_ratio"])
+    print "buckets held           {0:>10}".format(stats["buckets"])
+    print "mean ms per poll       {0:>10.3f} (plan and stitch)".format(plan_seconds * 1000 / args.polls)
+    print "responses not matching solr: {0}".format(mismatches)
+
+
+if __name__ == "__main__":
+    main()
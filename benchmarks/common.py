@@ -0,0 +1,50 @@
+"""
+Helpers shared by the benchmarks: django setup, validated queries and timing.
+Run the benchmarks from the project root, e.g. python -m benchmarks.bench_solr_facets
+"""
+import os
+import time
+
+
+def setup_django(settings_module="hhypermap_searchlayers_api.settings"):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+    django.setup()
+
+
+def search_serializer(**params):
+    from api.serializers import SearchSerializer
+    serializer = SearchSerializer(data=params)
+    serializer.is_valid(raise_exception=True)
+    return serializer
+
+
+def measure(fn, repeat=100, warmup=5):
+    """
+    :return: dict with the mean, p50, p95 and max milliseconds of fn over repeat calls.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.time()
+        fn()
+        samples.append((time.time() - started) * 1000)
+    samples.sort()
+    return {
+        "mean": sum(samples) / len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[int(len(samples) * 0.95) - 1],
+        "max": samples[-1],
+    }
+
+
+def report(title, rows):
+    """
+    Prints rows of (label, measure dict) as a table.
+    """
+    print title
+    print "{0:<40} {1:>10} {2:>10} {3:>10} {4:>10}".format("", "mean ms", "p50 ms", "p95 ms", "max ms")
+    for label, stats in rows:
+        print "{0:<40} {1:>10.3f} {2:>10.3f} {3:>10.3f} {4:>10.3f}".format(
+            label, stats["mean"], stats["p50"], stats["p95"], stats["max"])
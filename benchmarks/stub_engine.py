@@ -0,0 +1,251 @@
+"""
+A local Solr-like (and Elasticsearch-like) stub engine for the benchmarks.
+
+It understands the params the api sends, legacy facets and the JSON Facet API, and answers
+with deterministic, realistically sized responses after an optional simulated latency, so
+the api side costs can be measured without a search engine. Point the benchmarks at a real
+engine with --endpoint to measure the engine side.
+"""
+import BaseHTTPServer
+import gzip
+import json
+import random
+import SocketServer
+import StringIO
+import threading
+import time
+import urlparse
+
+DOCS_FOUND = 123456
+
+
+def _doc(index):
+    return {
+        "id": "doc-{0}".format(index),
+        "title": "Layer title {0}".format(index),
+        "abstract": "Abstract text " * 40,
+        "layer_originator": "user{0}".format(index % 50),
+        "layer_date": "2015-{0:02d}-{1:02d}T00:00:00Z".format(index % 12 + 1, index % 28 + 1),
+        "bbox": "ENVELOPE(-{0}, {0}, 45, -45)".format(index % 180),
+        "layer_geoshape": "POLYGON((" + ", ".join("{0} {1}".format(x, x / 2) for x in range(30)) + "))",
+    }
+
+
+def _gzip(payload):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as f:
+        f.write(payload)
+    return buf.getvalue()
+
+
+def _grid(rows, columns, seed):
+    rnd = random.Random(seed)
+    return [None if rnd.random() < 0.2 else [rnd.randint(0, 500) for _ in range(columns)] for _ in range(rows)]
+
+
+def _grid_size(grid_level):
+    grid_level = int(grid_level or 4)
+    return min(256, 2 ** (grid_level - 1)), min(512, 2 ** grid_level)
+
+
+def _terms(limit):
+    return [("value{0}".format(i), 1000 - i) for i in range(int(limit))]
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes, keep-alive clients would wait on delayed acks.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(parts.query)
+        self.server.record(parts.path, params)
+        partial = self.server.wait(params.get("timeAllowed", [None])[0])
+        response = self.server.solr_response(params)
+        if partial:
+            response["responseHeader"]["partialResults"] = True
+        self.send_json(response)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length") or 0)) or "{}")
+        self.server.record(urlparse.urlsplit(self.path).path, body)
+        partial = self.server.wait(body.get("timeout", "").rstrip("ms") or None)
+        response = self.server.es_response(body)
+        response["timed_out"] = partial
+        self.send_json(response)
+
+    def send_json(self, body):
+        indent = 2 if body.pop("_indent", False) else None
+        payload = json.dumps(body, indent=indent)
+        gzipped = self.server.compress and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            payload = _gzip(payload)
+        self.server.sent(len(payload))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubEngine(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # concurrent load benchmarks open hundreds of connections at once.
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=0.0, slow_latency=0.0, slow_fraction=0.0, compress=False):
+        """
+        :param latency: seconds every request takes.
+        :param slow_latency: seconds the slow_fraction of the requests take instead, e.g. pathological queries.
+        :param compress: gzip the responses of the clients accepting it, like solr behind a jetty GzipHandler.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_fraction = slow_fraction
+        self.compress = compress
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def solr_url(self):
+        return "http://127.0.0.1:{0}/solr/stub/select".format(self.server_address[1])
+
+    @property
+    def es_url(self):
+        return "http://127.0.0.1:{0}/stub/_search".format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients hang up on slow requests, e.g. the losing hedges, when they are done.
+        pass
+
+    def wait(self, allowed_ms=None):
+        """
+        Simulates the latency of a request, cut at allowed_ms (solr timeAllowed, elasticsearch timeout).
+        :return: True when it was cut, the results are partial.
+        """
+        latency = self.latency
+        if self.slow_fraction and random.random() < self.slow_fraction:
+            latency = self.slow_latency
+        partial = allowed_ms is not None and latency > int(allowed_ms) / 1000.0
+        if partial:
+            latency = int(allowed_ms) / 1000.0
+        if latency:
+            time.sleep(latency)
+        return partial
+
+    def record(self, path, params):
+        with self.lock:
+            self.requests += 1
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def solr_response(self, params):
+        first = lambda key, default=None: params.get(key, [default])[0]
+        rows = int(first("rows", 10))
+        response = {
+            "responseHeader": {"status": 0, "QTime": 7},
+            "response": {"numFound": DOCS_FOUND, "start": 0, "docs": [_doc(i) for i in range(rows)]},
+            "_indent": first("indent") == "on",
+        }
+        fl = first("fl")
+        if fl:
+            fields = fl.split(",")
+            response["response"]["docs"] = [dict((k, v) for k, v in doc.items() if k in fields)
+                                            for doc in response["response"]["docs"]]
+        if first("cursorMark"):
+            response["nextCursorMark"] = first("cursorMark")
+        if first("debug") == "timing":
+            response["debug"] = {"timing": {"time": 7.0, "prepare": {"time": 1.0, "query": {"time": 1.0}},
+                                            "process": {"time": 6.0, "query": {"time": 3.0},
+                                                        "facet": {"time": 3.0}}}}
+        if first("facet") == "on":
+            facet_counts = {"facet_queries": {}, "facet_ranges": {}, "facet_heatmaps": {}, "facet_fields": {}}
+            range_field = first("facet.range")
+            if range_field:
+                counts = []
+                for i in range(100):
+                    counts.extend(["2015-01-01T00:{0:02d}:00Z".format(i % 60), i])
+                facet_counts["facet_ranges"][range_field] = {
+                    "counts": counts,
+                    "gap": first("f.{0}.facet.range.gap".format(range_field)),
+                    "start": first("f.{0}.facet.range.start".format(range_field)),
+                    "end": first("f.{0}.facet.range.end".format(range_field)),
+                }
+            heatmap_field = first("facet.heatmap")
+            if heatmap_field:
+                rows_, columns = _grid_size(first("facet.heatmap.gridLevel"))
+                facet_counts["facet_heatmaps"][heatmap_field] = [
+                    "gridLevel", 4, "columns", columns, "rows", rows_,
+                    "minX", -180.0, "maxX", 180.0, "minY", -90.0, "maxY", 90.0,
+                    "counts_ints2D", _grid(rows_, columns, columns)]
+            for facet_field in params.get("facet.field", []):
+                field = facet_field.split("}")[-1]
+                limit = first("f.{0}.facet.limit".format(field), 100)
+                counts = []
+                for value, count in _terms(limit):
+                    counts.extend([value, count])
+                facet_counts["facet_fields"][field] = counts
+            response["facet_counts"] = facet_counts
+        json_facet = first("json.facet")
+        if json_facet:
+            facets = {"count": DOCS_FOUND}
+            for key, facet in json.loads(json_facet).items():
+                if facet["type"] == "range":
+                    facets[key] = {"buckets": [{"val": "2015-01-01T00:{0:02d}:00Z".format(i % 60), "count": i}
+                                               for i in range(100)]}
+                elif facet["type"] == "heatmap":
+                    rows_, columns = _grid_size(facet.get("gridLevel"))
+                    facets[key] = {"gridLevel": 4, "columns": columns, "rows": rows_, "minX": -180.0,
+                                   "maxX": 180.0, "minY": -90.0, "maxY": 90.0,
+                                   "counts_ints2D": _grid(rows_, columns, columns)}
+                else:
+                    facets[key] = {"buckets": [{"val": value, "count": count}
+                                               for value, count in _terms(facet.get("limit", 10))]}
+            response["facets"] = facets
+        return response
+
+    def es_response(self, body):
+        size = int(body.get("size", 10))
+        hits = [{"_index": "stub", "_id": str(i), "_score": 1.0, "_source": _doc(i), "sort": [i, str(i)]}
+                for i in range(size)]
+        source = body.get("_source")
+        if isinstance(source, list):
+            for hit in hits:
+                hit["_source"] = dict((k, v) for k, v in hit["_source"].items() if k in source)
+        aggregations = {}
+        for name, agg in body.get("aggs", {}).items():
+            inner = agg.get("aggs", {}).get("agg", agg)
+            if "terms" in inner:
+                buckets = [{"key": value, "doc_count": count} for value, count in _terms(inner["terms"]["size"])]
+            elif "date_histogram" in inner:
+                buckets = [{"key": i, "key_as_string": "2015-01-01T00:{0:02d}:00Z".format(i % 60), "doc_count": i}
+                           for i in range(100)]
+            else:
+                zoom = inner["geotile_grid"]["precision"]
+                buckets = [{"key": "{0}/{1}/{2}".format(zoom, x, y), "doc_count": x + y}
+                           for x in range(min(2 ** zoom, 64)) for y in range(min(2 ** zoom, 32))]
+            aggregations[name] = {"doc_count": DOCS_FOUND, "agg": {"buckets": buckets}}
+        return {"took": 7, "timed_out": False,
+                "hits": {"total": {"value": DOCS_FOUND, "relation": "eq"}, "hits": hits},
+                "aggregations": aggregations}
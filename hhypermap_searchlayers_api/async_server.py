@@ -0,0 +1,53 @@
+"""
+Asynchronous entry point of the search api: /api/search/ is served non blocking on a tornado
+IOLoop (api.async_search) and every other url by the django WSGI application, on the same port.
+
+    python -m hhypermap_searchlayers_api.async_server --port 8000
+
+Uses the api-only settings unless DJANGO_SETTINGS_MODULE says otherwise. The WSGI fallback runs
+on the loop itself, so keep the blocking endpoints (export, batch, tiles) on the wsgi workers
+in front of which this server is meant to sit for the searches.
+"""
+
+import argparse
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hhypermap_searchlayers_api.settings_api")
+
+import django  # noqa
+
+django.setup()
+
+from django.core.wsgi import get_wsgi_application  # noqa
+from tornado import web, wsgi  # noqa
+from tornado.httpserver import HTTPServer  # noqa
+from tornado.ioloop import IOLoop  # noqa
+
+from api.async_search import SearchHandler, configure_http_client, poll_index_changes  # noqa
+
+
+def make_application():
+    configure_http_client()
+    fallback = wsgi.WSGIContainer(get_wsgi_application())
+    return web.Application([
+        (r"/api/search/?", SearchHandler),
+        (r".*", web.FallbackHandler, {"fallback": fallback}),
+    ])
+
+
+application = make_application()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Asynchronous search api server.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--address", default="")
+    args = parser.parse_args()
+
+    HTTPServer(application, xheaders=True).listen(args.port, args.address)
+    poll_index_changes()
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -41,10 +41,13 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework_swagger',
     'django_extensions',
-    'corsheaders'
+    'corsheaders',
+    'api',
 ]
 
 MIDDLEWARE_CLASSES = [
+    'api.metrics.TimingMiddleware',
+    'api.slowlog.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -127,3 +130,198 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 CORS_ORIGIN_ALLOW_ALL = True
+# the django-cors-headers defaults and the header naming the client of SEARCH_DEADLINE.
+CORS_ALLOW_HEADERS = (
+    'x-requested-with',
+    'content-type',
+    'accept',
+    'origin',
+    'authorization',
+    'x-csrftoken',
+    'user-agent',
+    'accept-encoding',
+    'x-search-client',
+)
+
+# Pooled keep-alive sessions to the search engines, one per endpoint host. COMPRESSION asks for gzipped
+# responses (solr behind a jetty GzipHandler, elasticsearch http.compression), off for 'identity'.
+SEARCH_ENGINE_POOL = {
+    'POOL_CONNECTIONS': 10,
+    'POOL_MAXSIZE': 20,
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0.1,
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 60,
+    'KEEP_ALIVE': True,
+    'COMPRESSION': True,
+}
+
+# Response cache in front of the search view, keyed by the normalized query.
+# BACKEND 'local' is per process, 'django' shares entries through CACHES[CACHE_ALIAS].
+# A TTL of 0 disables the cache for that search engine.
+SEARCH_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'BACKEND': 'local',
+    'CACHE_ALIAS': 'default',
+    'KEY_PREFIX': 'search',
+    'TTL': {'solr': 60, 'elasticsearch': 60},
+    'MAX_ENTRIES': 1000,
+    'MAX_BYTES': 64 * 1024 * 1024,
+}
+
+# Coalesce identical in-flight upstream searches into one request.
+SEARCH_SINGLEFLIGHT = True
+
+# Docs fetched per upstream page by /api/search/export/ when d_docs_page_size is not given.
+SEARCH_EXPORT_PAGE_SIZE = 1000
+# csv columns of the exports without d_docs_fields, by search engine.
+SEARCH_EXPORT_FIELDS = {
+    'solr': ['id', 'title', 'abstract', 'layer_originator', 'layer_date', 'bbox'],
+    'elasticsearch': ['_id', 'title', 'abstract', 'layer_originator', 'layer_date', 'bbox'],
+}
+
+# Split solr requests in concurrent docs/facet sub requests unless parallel_facets says otherwise.
+SEARCH_PARALLEL_FACETS = False
+# Threads running concurrent upstream sub requests.
+SEARCH_PARALLEL_WORKERS = 8
+
+# Maximum shards searched concurrently by a federated search.
+SEARCH_FEDERATED_WORKERS = 8
+
+# /api/search/batch/ limits: items per call and items searched concurrently per call.
+SEARCH_BATCH_MAX_ITEMS = 100
+SEARCH_BATCH_CONCURRENCY = 8
+
+# Solr facets as legacy facet.* params or one JSON Facet API request ('legacy' or 'json'),
+# and the extra JSON facet options per facet type, e.g. {'terms': {'method': 'dv'}}.
+SEARCH_SOLR_FACET_API = 'legacy'
+SEARCH_SOLR_JSON_FACET_OPTIONS = {
+    'range': {},
+    'heatmap': {},
+    'terms': {},
+}
+
+# The stored fields d_docs_fields may name, e.g. ['id', 'title', 'abstract', 'layer_date'], others are
+# rejected. None accepts any field name.
+SEARCH_DOCS_FIELDS = None
+
+# Ask solr for indented responses with their debug=timing breakdown unless search_engine_debug says
+# otherwise. Off, the responses are lean; the original responses are always indented and debugged.
+SEARCH_ENGINE_DEBUG = False
+
+# Solr fq of the q.* constraints. NORMALIZE (or normalize_filters=1) grows q.time out to TIME_GRID
+# and q.geo to GEO_GRID degrees, so nearby searches share filterCache entries. Filters off those
+# grids (with UNCACHED_OFF_GRID) and the kinds in UNCACHED ('time', 'geo', 'user') are likely
+# one-offs or expensive and skip the filterCache with {!cache=false cost=N}; fq go cheapest COST first.
+# Both are off by default, so the fq of clients not normalizing stay as they were.
+SEARCH_SOLR_FILTERS = {
+    'NORMALIZE': False,
+    'TIME_GRID': '+1MINUTES',
+    'GEO_GRID': 0.01,
+    'UNCACHED_OFF_GRID': False,
+    'UNCACHED': (),
+    'COST': {'user': 0, 'time': 10, 'geo': 100},
+}
+
+# /api/heatmap/{z}/{x}/{y}.png: heatmap cells fetched per tile unless a_hm_limit says otherwise,
+# and the Cache-Control max-age of the tiles in seconds.
+SEARCH_TILE_HEATMAP_CELLS = 4096
+SEARCH_TILE_MAX_AGE = 300
+
+# Solr heatmap grids cached by filter set, grid level and region; viewports inside a cached
+# region, also at coarser levels, are sliced/summed from it. Misses fetch the region grown to
+# multiples of ALIGN cells, up to MAX_CELLS.
+SEARCH_HEATMAP_CACHE = {
+    'ENABLED': True,
+    'TTL': 60,
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'ALIGN': 16,
+    'MAX_CELLS': 100000,
+}
+
+# Maximum number of heatmaps in an a.hm.time stack.
+SEARCH_HM_TIME_MAX_FRAMES = 100
+
+# Counts of closed time facet buckets, those that ended SETTLE_SECONDS ago, by filter set and
+# gap; a sliding "up to now" a.time only asks solr for the buckets after the cached ones.
+# Reindexing does not reach them unless announced (see SEARCH_INDEX_CHANGES): until then they
+# may be stale for up to TTL seconds, like the heatmaps of SEARCH_HEATMAP_CACHE for its TTL.
+SEARCH_TIME_CACHE = {
+    'ENABLED': True,
+    'TTL': 24 * 60 * 60,
+    'SETTLE_SECONDS': 5 * 60,
+    'MAX_BUCKETS': 100000,
+}
+
+# Reindex announcements: `manage.py search_index_changed [--endpoint URL] [--since DATE]`, or
+# api.signals.get_index_changes().publish(endpoint, since), records the change in CACHES[CACHE_ALIAS],
+# every api process drops its cached time buckets and heatmaps of the endpoint within POLL_SECONDS.
+# The alias must be shared by the processes (memcached, redis, database), the default local memory
+# cache only reaches its own process. Changes are kept for TTL seconds, the longest cached count.
+SEARCH_INDEX_CHANGES = {
+    'CACHE_ALIAS': 'default',
+    'KEY_PREFIX': 'search_index_changed',
+    'POLL_SECONDS': 1,
+    'TTL': 24 * 60 * 60,
+}
+
+# Per stage timings of the api requests (Server-Timing header) and their latency histograms by
+# search engine and facets on /api/metrics, in the Prometheus text format. BUCKETS are seconds.
+# Disabled, the timing middleware is not loaded at all.
+SEARCH_METRICS = {
+    'ENABLED': True,
+    'BUCKETS': (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
+
+# Slow query log: searches slower than THRESHOLD_MS, and a SAMPLE_RATE fraction of the others,
+# as one json record per line in PATH, rotated at MAX_BYTES keeping BACKUP_COUNT files.
+# python manage.py slow_queries reports the top parameter combinations out of them.
+SEARCH_SLOW_QUERY_LOG = {
+    'ENABLED': True,
+    'PATH': os.path.join(BASE_DIR, 'logs', 'slow_queries.ndjson'),
+    'THRESHOLD_MS': 1000,
+    'SAMPLE_RATE': 0.01,
+    'MAX_BYTES': 16 * 1024 * 1024,
+    'BACKUP_COUNT': 5,
+}
+
+# Time budget of the searches (deadline_ms), by default DEFAULT_MS, or the one of the client in CLIENTS
+# named by the CLIENT_HEADER header, e.g. {'dashboard': 2000}, at most MAX_MS. Solr gets it as timeAllowed
+# and elasticsearch as timeout, less HEADROOM_MS, and return what they found by then; the
+# time left is the upstream read timeout. None for no deadline.
+SEARCH_DEADLINE = {
+    'DEFAULT_MS': 30000,
+    'MAX_MS': 60000,
+    'HEADROOM_MS': 100,
+    'CLIENT_HEADER': 'X-Search-Client',
+    'CLIENTS': {},
+}
+
+# Asynchronous /api/search/ of hhypermap_searchlayers_api.async_server: upstream requests in flight
+# at once per process (more queue), through libcurl keep-alive connections when CURL and pycurl is installed.
+SEARCH_ASYNC = {
+    'MAX_CLIENTS': 100,
+    'CURL': True,
+}
+
+# Replicas of the search engine endpoints: INDEXES maps the search_engine_endpoint of the searches to
+# equivalent replica endpoints, e.g. {'http://solr/solr/hypermap/select': ['http://solr1:8983/solr/hypermap/select',
+# 'http://solr2:8983/solr/hypermap/select']}. A search goes to the fastest, least loaded of them; when it has
+# not answered after HEDGE_DELAY_MS (None: the observed HEDGE_PERCENTILE latency) a duplicate goes to the
+# next one, for at most a HEDGE_BUDGET fraction of the searches (0: no hedging), on HEDGE_WORKERS threads. A replica failing
+# ERROR_RATIO of its last WINDOW requests (errors, or answers slower than SLOW_MS) gets no traffic for
+# OPEN_SECONDS. Health at /api/replicas, counters at /api/metrics.
+SEARCH_REPLICAS = {
+    'INDEXES': {},
+    'HEDGE_DELAY_MS': None,
+    'HEDGE_PERCENTILE': 0.95,
+    'DEFAULT_HEDGE_DELAY_MS': 100,
+    'MIN_HEDGE_DELAY_MS': 5,
+    'HEDGE_BUDGET': 0.1,
+    'HEDGE_WORKERS': 32,
+    'WINDOW': 20,
+    'MIN_REQUESTS': 10,
+    'ERROR_RATIO': 0.5,
+    'SLOW_MS': 2000,
+    'OPEN_SECONDS': 10,
+}
@@ -0,0 +1,54 @@
+"""
+Production settings of the stateless search api, used by hhypermap_searchlayers_api.wsgi_api.
+
+Only the apps and middleware the api uses: no admin, sessions, csrf, auth, messages nor
+clickjacking middleware, no database. The swagger docs are imported by the first /docs/ request.
+"""
+
+from hhypermap_searchlayers_api.settings import *  # noqa
+
+DEBUG = False
+
+SECRET_KEY = os.environ.get('SECRET_KEY', SECRET_KEY)
+
+ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '*').split(',')
+
+INSTALLED_APPS = [
+    'django.contrib.staticfiles',
+
+    'rest_framework',
+    'rest_framework_swagger',
+    'corsheaders',
+    'api',
+]
+
+MIDDLEWARE_CLASSES = [
+    'api.metrics.TimingMiddleware',
+    'api.slowlog.SlowQueryMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'hhypermap_searchlayers_api.urls_api'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+            ],
+        },
+    },
+]
+
+DATABASES = {}
+
+# requests are anonymous, DRF does not need django.contrib.auth.
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': [],
+    'UNAUTHENTICATED_USER': None,
+}
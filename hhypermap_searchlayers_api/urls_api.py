@@ -0,0 +1,12 @@
+"""
+URLs of the api-only settings (hhypermap_searchlayers_api.settings_api): no admin, and the
+swagger docs urlconf imported by the first /docs/ request.
+"""
+from django.conf.urls import url, include
+from django.core.urlresolvers import RegexURLResolver
+
+urlpatterns = [
+    url(r'^api/', include('api.urls')),
+    # include() would import the urlconf now, the resolver imports it on first use.
+    RegexURLResolver(r'^docs/', 'rest_framework_swagger.urls'),
+]
@@ -0,0 +1,14 @@
+"""
+WSGI config of the search api in production, with the api-only settings.
+
+It exposes the WSGI callable as a module-level variable named ``application``, e.g.
+gunicorn hhypermap_searchlayers_api.wsgi_api
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hhypermap_searchlayers_api.settings_api")
+
+application = get_wsgi_application()